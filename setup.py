@@ -55,7 +55,8 @@ setup(name = 'vezda',
                       'vzspectra = vezda.plotSpectra:cli',
                       'vzsvd = vezda.plotSVD:cli',
                       'vzwiggles = vezda.plotWiggles:cli',
-                      'vzwindow = vezda.setWindow:cli'
+                      'vzwindow = vezda.setWindow:cli',
+                      'vzbench = vezda.runBenchmarks:cli'
                       ]
               },
       zip_safe = False)
@@ -15,7 +15,9 @@
 
 import numpy as np
 from scipy.sparse.linalg import LinearOperator
-from vezda.math_utils import nextPow2
+from vezda.math_utils import convolution_length, complex_dtype
+from vezda.profile_utils import count
+from vezda.trace_utils import SegmentedTraces
 
 #==============================================================================
 def asConvolutionalOperator(kernel):
@@ -24,7 +26,8 @@ def asConvolutionalOperator(kernel):
     for both the forward and adjoint convolution operators. The convolutional operator
     can either be the near-field operator (NFO) or the Lippmann-Schwinger operator (LSO).
     
-    Input: a three-dimensional data array of shape Nr x Nm x Ns
+    Input: a three-dimensional data array of shape Nr x Nm x Ns (in the time
+           domain also SegmentedTraces, see trace_utils)
     
     matvec: Definition of the forward matrix-vector product
     rmatvec: Definition of the adjoint matrix-vector product
@@ -48,67 +51,93 @@ def asConvolutionalOperator(kernel):
     shape(x) = (Nm * Nr) x 1 for adjoint operator
     
     Output: the operator M such that y = Mx
+    
+    The operator has the precision of the kernel: a single-precision kernel
+    (float32/complex64) gives a single-precision operator.
     '''
     
     Nr, Nm, Ns = kernel.shape
     if np.issubdtype(kernel.dtype, np.floating):
         # input data are real (time domain)
-    
-        # get the next power of 2 greater than or equal to 2*Nm
-        # for efficient circular convolution via FFT
-        N = nextPow2(2 * Nm)
         
-        # Fourier transform the data over the time axis=1
-        U = np.fft.rfft(kernel, n=N, axis=1)
+        # length of the FFTs: long enough for the full linear convolution
+        # (so the circular convolution does not wrap around) and fast
+        N = convolution_length(Nm)
+        M = 2 * Nm - 1
         
-        def forwardOperator(x):        
-            # definition of the forward convolutional operator
+        # Fourier transform the data over the time axis=1 and arrange the
+        # transform as Nf blocks of shape Nr x Ns, so that each product is a
+        # batch of small matrix-vector products over frequency. The adjoint
+        # uses the transposed view of the same blocks and applies the
+        # conjugation to the (much smaller) vectors instead.
+        if isinstance(kernel, SegmentedTraces):
+            # transformed from the segments of the traces
+            U = kernel.rfft(N)
+        else:
+            U = np.fft.rfft(kernel, n=N, axis=1)
+        U = U.astype(complex_dtype(kernel.dtype), copy=False)
+        U = np.ascontiguousarray(np.transpose(U, (1, 0, 2)))
+        Uh = np.transpose(U, (0, 2, 1))
+        
+        def forwardBlock(X):
+            # forward operator applied to the p columns of X, which are
+            # transformed and multiplied together as a batch
+            p = X.shape[1]
             
-            #reshape x into a matrix and FFT over time axis=0
-            x = x.reshape((2*Nm-1, Ns), order='F')
-            x = np.fft.rfft(x, n=N, axis=0)
+            #reshape X into an array (time x sources x columns) and FFT over time axis=0
+            X = X.reshape((M, Ns, p), order='F')
+            X = np.fft.rfft(X, n=N, axis=0).astype(U.dtype, copy=False)
             
-            # initialize the output array y for the range of Matrix
-            y = np.zeros((2*Nm-1, Nr), dtype=kernel.dtype)
-                
-            for i in range(Nr):
-                # Compute the matrix-vector product for Matrix * x
-                circularConvolution = np.fft.irfft(U[i, :, :] * x, axis=0)
-                circularConvolution = circularConvolution[:(2*Nm-1), :]
-                y[:, i] = np.sum(circularConvolution, axis=1) # sum over sources
-                
-            y = y.reshape(((2*Nm-1) * Nr, 1), order='F')
+            # sum over sources in the frequency domain, then a single
+            # inverse FFT for all receivers
+            Y = np.matmul(U, X)
+            Y = np.fft.irfft(Y, n=N, axis=0)[:M].astype(kernel.dtype, copy=False)
+            
+            return Y.reshape((M * Nr, p), order='F')
         
-            return y
+        def adjointBlock(Y):
+            # adjoint operator applied to the p columns of Y
+            p = Y.shape[1]
+            
+            #reshape Y into an array (time x receivers x columns) and FFT over time axis=0
+            Y = Y.reshape((M, Nr, p), order='F')
+            Y = np.fft.rfft(Y, n=N, axis=0).astype(U.dtype, copy=False)
+            
+            # sum over receivers in the frequency domain (conj(U)^T y is
+            # computed as conj(U^T conj(y))), then a single inverse FFT
+            X = np.matmul(Uh, Y.conj()).conj()
+            X = np.fft.irfft(X, n=N, axis=0)[:M].astype(kernel.dtype, copy=False)
+            
+            return X.reshape((M * Ns, p), order='F')
+        
+        def forwardOperator(x):        
+            # definition of the forward convolutional operator
+            count('matvec')
+            return forwardBlock(x.reshape((M * Ns, 1)))
     
         def adjointOperator(y):               
             # definition of the adjoint convolutional operator
- 
-            #reshape y into a matrix and FFT over time axis=0
-            y = y.reshape((2*Nm-1, Nr), order='F')
-            y = np.fft.rfft(y, n=N, axis=0)
+            count('rmatvec')
+            return adjointBlock(y.reshape((M * Nr, 1)))
         
-            # initialize the output array x for the range of Matrix.T
-            x = np.zeros((2*Nm-1, Ns), dtype=kernel.dtype)
-            
-            for j in range(Ns):
-                # Compute the matrix-vector product for Matrix.T * y
-                circularConvolutionT = np.fft.irfft(U[:, :, j].conj().T * y, axis=0)
-                circularConvolutionT = circularConvolutionT[:(2*Nm-1), :]
-                x[:, j] = np.sum(circularConvolutionT, axis=1) # sum over receivers
-            
-            x = x.reshape(((2*Nm-1) * Ns, 1), order='F')
+        def forwardMatrix(X):
+            count('matvec', X.shape[1])
+            return forwardBlock(X)
         
-            return x
+        def adjointMatrix(Y):
+            count('rmatvec', Y.shape[1])
+            return adjointBlock(Y)
         
-        return LinearOperator(shape=((2*Nm-1) * Nr, (2*Nm-1) * Ns), matvec=forwardOperator,
-                              rmatvec=adjointOperator, dtype=kernel.dtype)
+        return LinearOperator(shape=(M * Nr, M * Ns), matvec=forwardOperator,
+                              rmatvec=adjointOperator, matmat=forwardMatrix,
+                              rmatmat=adjointMatrix, dtype=kernel.dtype)
         
     else:
         # input data are complex (frequency domain)
         
         def forwardOperator(x):        
             # definition of the forward convolutional operator
+            count('matvec')
 
             #reshape x into a matrix
             x = x.reshape((Nm, Ns), order='F')
@@ -125,6 +154,7 @@ def asConvolutionalOperator(kernel):
     
         def adjointOperator(y):               
             # definition of the adjoint convolutional operator
+            count('rmatvec')
 
             #reshape y into a matrix
             y = y.reshape((Nm, Nr), order='F')
@@ -141,3 +171,104 @@ def asConvolutionalOperator(kernel):
     
         return LinearOperator(shape=(Nm * Nr, Nm * Ns), matvec=forwardOperator,
                               rmatvec=adjointOperator, dtype=kernel.dtype)
+
+
+#==============================================================================
+def asStreamedOperator(store):
+    '''
+    Out-of-core variant of asConvolutionalOperator for kernels that do not fit
+    in memory. The kernel is streamed from a KernelStore (see outofcore_utils)
+    block by block of sources/search points during each matrix-vector product,
+    with the next block read from disk while the current one is used. Only
+    one or two blocks of the kernel are held in memory at a time.
+    
+    Input: a KernelStore holding a kernel of shape Nr x Nm x Ns
+    
+    The operator has the same shape, ordering and precision as the one
+    returned by asConvolutionalOperator for the same kernel.
+    '''
+    
+    Nr, Nm, Ns = store.shape
+    if store.domain == 'time':
+        # input data are real (time domain)
+        # the store holds the Fourier transform U of the kernel (Ns x Nf x Nr)
+        N = store.N
+        M = 2 * Nm - 1
+        cdtype = complex_dtype(store.dtype)
+        
+        def forwardOperator(x):
+            # definition of the forward convolutional operator
+            count('matvec')
+            
+            #reshape x into a matrix and FFT over time axis=0
+            x = x.reshape((M, Ns), order='F')
+            x = np.fft.rfft(x, n=N, axis=0).astype(cdtype, copy=False)
+            
+            # sum over sources in the frequency domain, block by block
+            y = np.zeros((store.Nf, Nr), dtype=cdtype)
+            for start, stop, U in store.blocks():
+                y += np.einsum('jfr,fj->fr', U, x[:, start:stop])
+            
+            y = np.fft.irfft(y, n=N, axis=0)[:M, :].astype(store.dtype, copy=False)
+            y = y.reshape((M * Nr, 1), order='F')
+            
+            return y
+        
+        def adjointOperator(y):
+            # definition of the adjoint convolutional operator
+            count('rmatvec')
+            
+            #reshape y into a matrix and FFT over time axis=0
+            y = y.reshape((M, Nr), order='F')
+            y = np.fft.rfft(y, n=N, axis=0).astype(cdtype, copy=False)
+            
+            # sum over receivers in the frequency domain, block by block
+            # (conj(U)^T y is computed as conj(U^T conj(y)) to avoid copying U)
+            x = np.zeros((store.Nf, Ns), dtype=cdtype)
+            for start, stop, U in store.blocks():
+                x[:, start:stop] = np.einsum('jfr,fr->fj', U, y.conj()).conj()
+            
+            x = np.fft.irfft(x, n=N, axis=0)[:M, :].astype(store.dtype, copy=False)
+            x = x.reshape((M * Ns, 1), order='F')
+            
+            return x
+        
+        return LinearOperator(shape=(M * Nr, M * Ns), matvec=forwardOperator,
+                              rmatvec=adjointOperator, dtype=store.dtype)
+    
+    else:
+        # input data are complex (frequency domain)
+        # the store holds the kernel (Ns x Nm x Nr)
+        
+        def forwardOperator(x):
+            # definition of the forward convolutional operator
+            count('matvec')
+            
+            #reshape x into a matrix
+            x = x.reshape((Nm, Ns), order='F')
+            
+            y = np.zeros((Nm, Nr), dtype=store.dtype)
+            for start, stop, K in store.blocks():
+                y += np.einsum('jmr,mj->mr', K, x[:, start:stop]) # sum over sources
+            
+            y = y.reshape((Nm * Nr, 1), order='F')
+            
+            return y
+        
+        def adjointOperator(y):
+            # definition of the adjoint convolutional operator
+            count('rmatvec')
+            
+            #reshape y into a matrix
+            y = y.reshape((Nm, Nr), order='F')
+            
+            x = np.zeros((Nm, Ns), dtype=store.dtype)
+            for start, stop, K in store.blocks():
+                x[:, start:stop] = np.einsum('jmr,mr->mj', K, y.conj()).conj() # sum over receivers
+            
+            x = x.reshape((Nm * Ns, 1), order='F')
+            
+            return x
+        
+        return LinearOperator(shape=(Nm * Nr, Nm * Ns), matvec=forwardOperator,
+                              rmatvec=adjointOperator, dtype=store.dtype)
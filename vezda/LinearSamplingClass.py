@@ -1,23 +1,42 @@
+import sys
 import time
+import textwrap
 import numpy as np
 from tqdm import trange
 import scipy.sparse as sp
 from scipy.linalg import norm
 from joblib import Parallel, delayed
 from vezda.math_utils import humanReadable
-from vezda.svd_utils import load_svd, svd_needs_recomputing, compute_svd
-from vezda.LinearOperators import asConvolutionalOperator
+from vezda.svd_utils import (load_svd, svd_matches, svd_needs_recomputing, svd_is_reusable, compute_svd,
+                             update_svd, compute_block_svd, block_tikhonov_inverse)
+from vezda.LinearOperators import asConvolutionalOperator, asStreamedOperator
+from vezda.outofcore_utils import KernelStore
+from vezda.profile_utils import stage, profiled, record
 
 
 def scipy_lsmr(A, b, damp, atol, btol):
-    return sp.linalg.lsmr(A, b, damp, atol, btol)[0]
+    # returns the solution and the number of iterations
+    x, istop, itn = sp.linalg.lsmr(A, b, damp, atol, btol)[:3]
+    return x, itn
 
 def scipy_lsqr(A, b, damp, atol, btol):
-    return sp.linalg.lsqr(A, b, damp, atol, btol)[0]
+    # returns the solution and the number of iterations
+    x, istop, itn = sp.linalg.lsqr(A, b, damp, atol, btol)[:3]
+    return x, itn
 
 def inverse_svd(V, Sp, Uh, b):
     return V.dot(Sp.dot(Uh.dot(b)))
 
+def normalize_indicator(indicator):
+    '''
+    Normalize an indicator (or each column of an array of indicators) to
+    take on values between 0 and 1.
+    '''
+    eps = np.finfo(float).eps
+    Imin = np.min(indicator, axis=0)
+    Imax = np.max(indicator, axis=0)
+    return (indicator - Imin) / (Imax - Imin + eps)
+
 #==============================================================================
 # Super class (Parent class)
 # A class for solving linear systems Ax = b
@@ -44,12 +63,13 @@ class LinearSystem(object):
         
         if nproc != 1:
             startTime = time.time()
-            X = Parallel(n_jobs=nproc, verbose=11)(
+            results = Parallel(n_jobs=nproc, verbose=11)(
                     delayed(scipy_lsmr)(self.A, self.B[:, :, i].reshape(M),
                             damp=damp, atol=atol, btol=btol)
                     for i in range(K))
             endTime = time.time()
-            X = np.asarray(X, dtype=self.A.dtype).T
+            X = np.asarray([x for x, itn in results], dtype=self.A.dtype).T
+            record('iterations', [itn for x, itn in results])
         
         else:
             # initialize solution matrix X
@@ -57,8 +77,9 @@ class LinearSystem(object):
             
             startTime = time.time()
             for i in trange(K):
-                X[:, i] = scipy_lsmr(self.A, self.B[:, :, i].reshape(M),
+                X[:, i], itn = scipy_lsmr(self.A, self.B[:, :, i].reshape(M),
                  damp=damp, atol=atol, btol=btol)
+                record('iterations', itn)
             endTime = time.time()
             
         print('Elapsed time:', humanReadable(endTime - startTime))
@@ -71,12 +92,13 @@ class LinearSystem(object):
         
         if nproc != 1:
             startTime = time.time()
-            X = Parallel(n_jobs=nproc, verbose=11)(
+            results = Parallel(n_jobs=nproc, verbose=11)(
                     delayed(scipy_lsqr)(self.A, self.B[:, :, i].reshape(M),
                             damp=damp, atol=atol, btol=btol)
                     for i in range(K))
             endTime = time.time()
-            X = np.asarray(X, dtype=self.A.dtype).T
+            X = np.asarray([x for x, itn in results], dtype=self.A.dtype).T
+            record('iterations', [itn for x, itn in results])
         
         else:
             # initialize solution matrix X
@@ -84,8 +106,9 @@ class LinearSystem(object):
             
             startTime = time.time()
             for i in trange(K):
-                X[:, i] = scipy_lsqr(self.A, self.B[:, :, i].reshape(M),
+                X[:, i], itn = scipy_lsqr(self.A, self.B[:, :, i].reshape(M),
                  damp=damp, atol=atol, btol=btol)
+                record('iterations', itn)
             endTime = time.time()
             
         print('Elapsed time:', humanReadable(endTime - startTime))
@@ -139,29 +162,89 @@ class LinearSystem(object):
 # A class for solving linear sampling problems of the form Ax = b
 #
 # Class data objects: 
-#   kernel: data or test functions
+#   kernel: data or test functions (an array, or a KernelStore streamed
+#           from disk for kernels that do not fit in memory)
 #   right-hand side vectors: B = [b1 b2 ... bn]
 #
 # Class methods:
 #   solve system of equations using specified method: solve(method)
+#   solve by per-frequency Tikhonov factorization: solve_direct
+#   load (or compute) the SVD used by the svd method: get_svd()
+#   solve and reduce chunks of solutions into an image: solve_chunks()
 #   construst image from solutions: construct_image()
 #==============================================================================
 class LinearSamplingProblem(LinearSystem):
     
     def __init__(self, operatorName, kernel, rhs_vectors):
-        super().__init__(asConvolutionalOperator(kernel), rhs_vectors)
+        with stage('operator build'):
+            if isinstance(kernel, KernelStore):
+                super().__init__(asStreamedOperator(kernel), rhs_vectors)
+            else:
+                super().__init__(asConvolutionalOperator(kernel), rhs_vectors)
         self.operatorName = operatorName
         self.kernel = kernel
         
+        # cached per-frequency factorizations used by the direct solver
+        self.blockSVD = None
+        self.blockInverses = {}
+        
+        # SVD (U, s, Vh) used by the svd method instead of the one saved to
+        # 'NFO_SVD.npz'/'LSO_SVD.npz' (see vezda.SurveyClass)
+        self.SVD = None
+        
+    
+    def solve_direct(self, alpha=0.0):
+        '''
+        Solve the Tikhonov-regularized normal equations (A^H A + alpha I) x = A^H b
+        exactly for all right-hand sides. In the frequency domain the operator A
+        is block diagonal, so the system splits into Nm small dense systems of
+        size Nr x Ns. Each block is factored once (the factorization is cached)
+        and the regularized inverse for a given alpha is cached as well, so that
+        all search points are solved by a single batched matrix product.
+        '''
+        if np.issubdtype(self.kernel.dtype, np.floating):
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The direct solver is only available in the frequency domain.
+                    Use \'--domain=freq\' or choose an iterative method (lsmr/lsqr).
+                    '''))
+        
+        if self.blockSVD is None:
+            self.blockSVD = compute_block_svd(self.kernel)
+        
+        if alpha not in self.blockInverses:
+            self.blockInverses[alpha] = block_tikhonov_inverse(*self.blockSVD, alpha)
+        Ainv = self.blockInverses[alpha]
+        
+        Nm, Ns, Nr = Ainv.shape
+        K = self.B.shape[2]
+        
+        startTime = time.time()
+        # right-hand sides arranged as Nm blocks of shape Nr x K
+        X = np.matmul(Ainv, np.transpose(self.B, (1, 0, 2)))
+        # rearrange solutions to match the column ordering of the operator
+        X = np.transpose(X, (1, 0, 2)).reshape((Ns * Nm, K))
+        endTime = time.time()
+        print('Elapsed time:', humanReadable(endTime - startTime))
+        
+        return X
         
+        
+    @profiled('solve')
     def solve(self, method, fly=True, nproc=1, alpha=0.0, atol=1.0e-8, btol=1.0e-8, k=None):
         '''
         method : specified direct or iterative method for solving Ax = b
+                 (lsmr, lsqr, svd, or direct)
         alpha : regularization parameter
         atol : error tolerance for the linear operator
         btol : error tolerance for the right-hand side vectors
         k : number of singular values/vectors
+        
+        The solutions have the precision of the operator. Tolerances below
+        that precision cannot be met and are raised to it.
         '''
+        eps = 10 * np.finfo(self.A.dtype).eps
+        atol, btol = max(atol, eps), max(btol, eps)
         #======================================================================
         if method == 'lsmr':
             print('Localizing targets...')
@@ -169,58 +252,187 @@ class LinearSamplingProblem(LinearSystem):
         
         elif method == 'lsqr':
             print('Localizing targets...')
-            return super().solve_lsqr(alpha, atol, btol, nproc, fly)
+            return super().solve_lsqr(alpha, atol, btol, nproc)
         
         elif method == 'svd':
             # Load or recompute the SVD of A as needed
-        
-            if self.operatorName == 'nfo':
-                filename = 'NFO_SVD.npz'
-            elif self.operatorName == 'lso':
-                filename = 'LSO_SVD.npz'
-        
-            try:
-                U, s, Vh = load_svd(filename)
-                if svd_needs_recomputing(self.kernel, k, U, s, Vh):
-                    U, s, Vh = compute_svd(self.kernel, k, self.operatorName)
-            except IOError as err:
-                print(err.strerror)
-                if k is None:
-                    k = input('Specify the number of singular values and vectors to compute: ')
-                U, s, Vh = compute_svd(self.kernel, k, self.operatorName)
+            if self.SVD is not None:
+                U, s, Vh = self.SVD
+            else:
+                U, s, Vh = self.get_svd(k)
             
             print('Localizing targets...')
-            return super().solve_svd(U, s, Vh, alpha, nproc, fly)
+            return super().solve_svd(U, s, Vh, alpha, nproc)
+        
+        elif method == 'direct':
+            print('Localizing targets...')
+            return self.solve_direct(alpha)
             
     
-    def construct_image(self, solutions):
+    def get_svd(self, k=None):
+        '''
+        Loads the SVD (U, s, Vh) of A saved to 'NFO_SVD.npz'/'LSO_SVD.npz',
+        truncating, extending or recomputing it as needed for k singular
+        values and vectors.
+        '''
+        if self.operatorName == 'nfo':
+            filename = 'NFO_SVD.npz'
+        elif self.operatorName == 'lso':
+            filename = 'LSO_SVD.npz'
+        
+        try:
+            U, s, Vh = load_svd(filename)
+            if not svd_matches(filename, self.kernel, self.operatorName):
+                print('SVD was computed for a different operator: SVD needs recomputing...')
+                U, s, Vh = compute_svd(self.kernel, k or len(s), self.operatorName)
+            elif svd_needs_recomputing(self.kernel, k, U, s, Vh):
+                if k is not None and svd_is_reusable(self.kernel, U, s, Vh):
+                    # truncate or extend the saved SVD
+                    U, s, Vh = update_svd(self.kernel, k, U, s, Vh, self.operatorName)
+                else:
+                    U, s, Vh = compute_svd(self.kernel, k or len(s), self.operatorName)
+        except IOError as err:
+            print(err.strerror)
+            if k is None:
+                k = input('Specify the number of singular values and vectors to compute: ')
+            U, s, Vh = compute_svd(self.kernel, k, self.operatorName)
+        
+        return U, s, Vh
+    
+    
+    def solve_chunks(self, method, fly=True, nproc=1, alpha=0.0, atol=1.0e-8, btol=1.0e-8,
+                     k=None, chunk=None, out=None, keep_norms=False, checkpoint=None, stage_index=0):
+        '''
+        Solves Ax = b for chunks of right-hand sides and reduces each finished
+        chunk of solutions straight into the image, so that the solutions never
+        need to be held in memory all at once.
+        
+        chunk : number of right-hand sides solved at a time (all if None)
+        out : optional array (e.g., a memory-mapped .npy file) of shape (N, K)
+              into which the solutions are written
+        keep_norms : if True, also return the norms of the solutions from which
+                     the image is formed (see 'solution_norms')
+        checkpoint : optional Checkpoint (see checkpoint_utils) to which each
+                     finished chunk is recorded, and from which a previously
+                     interrupted solve of the given 'stage_index' is resumed
+        
+        Output:
+            Image: the image (see 'construct_image')
+            norms: the solution norms if keep_norms is True, otherwise None
+        '''
+        B = self.B
+        K = B.shape[2]
+        if chunk is None or chunk > K:
+            chunk = K
+        
+        if self.operatorName == 'nfo':
+            image = np.zeros(K)
+        elif self.operatorName == 'lso':
+            image = np.zeros(self.kernel.shape[2])
+        norms = []
+        
+        completed = 0
+        if checkpoint is not None:
+            saved = checkpoint.restore(stage_index, out)
+            if saved is not None:
+                completed, savedImage, chunkNorms = saved
+                if self.operatorName == 'nfo':
+                    # the image is assembled from the solution norms
+                    if completed > 0:
+                        image[:completed] = np.concatenate(chunkNorms)
+                else:
+                    image = savedImage
+                if keep_norms:
+                    norms = chunkNorms
+                print('Restored %d of %d solved right-hand sides from checkpoint...' %(completed, K))
+        
+        # the SVD is loaded once for all chunks
+        SVD = self.SVD
+        if method == 'svd' and SVD is None and completed < K:
+            self.SVD = self.get_svd(k)
+        
+        try:
+            for start in range(completed, K, chunk):
+                stop = min(start + chunk, K)
+                if chunk < K:
+                    print('Solving for right-hand sides %d to %d of %d...' %(start + 1, stop, K))
+                self.B = B[:, :, start:stop]
+                X = self.solve(method, fly, nproc, alpha, atol, btol, k)
+                if out is not None:
+                    out[:, start:stop] = X
+                
+                with stage('image construction'):
+                    chunkNorms = self.solution_norms(X)
+                    if self.operatorName == 'nfo':
+                        image[start:stop] = chunkNorms
+                    elif self.operatorName == 'lso':
+                        image += np.sum(normalize_indicator(chunkNorms)**2, axis=1)
+                if keep_norms:
+                    norms.append(chunkNorms)
+                
+                if checkpoint is not None:
+                    if hasattr(out, 'flush'):
+                        out.flush()
+                    # only the accumulated image of the Lippmann-Schwinger
+                    # operator needs to be recorded besides the norms
+                    checkpoint.update(stage_index, start, stop, chunkNorms,
+                                      image if self.operatorName == 'lso' else None, X)
+        finally:
+            self.B = B
+            self.SVD = SVD
+        
         print('Constructing the image...')
+        image = self.finalize_image(image, K)
+        
+        if keep_norms:
+            return image, np.concatenate(norms, axis=-1)
+        else:
+            return image, None
+    
+    
+    def solution_norms(self, solutions):
+        '''
+        Returns the norms of the solutions from which the image is formed:
+        an array of length K for the near-field operator and an array of shape
+        (Nsp, K) with the norm over frequency/time at each search point for the
+        Lippmann-Schwinger operator.
+        '''
+        if self.operatorName == 'nfo':
+            return norm(solutions, axis=0)
+        
+        elif self.operatorName == 'lso':
+            Nm, Nsp = self.kernel.shape[1], self.kernel.shape[2]
+            K = solutions.shape[1]
+            return norm(solutions.reshape((Nsp, Nm, K)), axis=1)
+    
+    
+    @profiled('image construction')
+    def finalize_image(self, image, K):
+        '''
+        Completes the image from the reduced solution norms: the reciprocal
+        norms (nfo) or the sum of squared normalized indicators over the K
+        right-hand sides (lso).
+        '''
         # Get machine precision
         eps = np.finfo(float).eps     # about 2e-16 (used in division
                                       # so we never divide by zero)
         if self.operatorName == 'nfo':
-            Image = 1.0 / (norm(solutions, axis=0) + eps)
-            
             # Normalize Image to take on values between 0 and 1
-            Imin = np.min(Image)
-            Imax = np.max(Image)
-            Image = (Image - Imin) / (Imax - Imin + eps)
+            Image = normalize_indicator(1.0 / (image + eps))
             
         elif self.operatorName == 'lso':
-            Nm, Nsp = self.kernel.shape[1], self.kernel.shape[2]
-            K = solutions.shape[1]
-            solutions = solutions.reshape((Nsp, Nm, K))
-            
-            # Initialize the Image
-            Image = np.zeros(Nsp)
-            for i in range(K):
-                indicator = norm(solutions[:, :, i], axis=1)
-                Imin = np.min(indicator)
-                Imax = np.max(indicator)
-                indicator = (indicator - Imin) / (Imax - Imin + eps)
-                Image += indicator**2
-        
             # Image is defined as the root-mean-square indicator
-            Image = np.sqrt(Image / K)
+            Image = np.sqrt(image / K)
             
-        return Image
\ No newline at end of file
+        return Image
+        
+    
+    def construct_image(self, solutions):
+        print('Constructing the image...')
+        norms = self.solution_norms(solutions)
+        if self.operatorName == 'nfo':
+            return self.finalize_image(norms, solutions.shape[1])
+        
+        elif self.operatorName == 'lso':
+            return self.finalize_image(np.sum(normalize_indicator(norms)**2, axis=1),
+                                       solutions.shape[1])
@@ -18,6 +18,7 @@ import textwrap
 import pickle
 import numpy as np
 from vezda.plot_utils import (remove_keymap_conflicts, default_params, setFigure)
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 #import matplotlib
 #matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
@@ -55,7 +56,9 @@ def cli():
                         help='''Specify whether to view plots in light mode for daytime viewing
                         or dark mode for nighttime viewing.
                         Mode must be either \'light\' or \'dark\'.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzpicard')
     #==============================================================================
                 
     def process_key_picard(event, tstart, tstop, rinterval,
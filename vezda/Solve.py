@@ -17,10 +17,25 @@ import sys
 import argparse
 import textwrap
 import numpy as np
+from pathlib import Path
+from numpy.lib.format import open_memmap
 from scipy.linalg import norm
 from vezda.plot_utils import FontColor
-from vezda.data_utils import load_data, load_impulse_responses
+from vezda.signal_utils import encode_sources, ENCODINGS
+from vezda.data_utils import (load_data, load_impulse_responses, compute_impulse_responses_at,
+                              load_search_grid, shift_impulse_responses, impulse_response_store)
+from vezda.sampling_utils import get_search_points, scatter_to_grid
+from vezda.adaptive_utils import adaptive_image
+from vezda.checkpoint_utils import Checkpoint, fingerprint
 from vezda.LinearSamplingClass import LinearSamplingProblem
+from vezda.profile_utils import add_profile_arguments, enable_profiling
+from vezda.session_utils import delegate
+from vezda.plan_utils import plan_solve
+from vezda.outofcore_utils import check_out_of_core
+from vezda.baseline_utils import (check_baseline, adopt_baseline, baseline_keys, solve_with_baseline,
+                                  reuse_report, save_difference)
+from vezda.precision_utils import compare_precision, print_precision_report
+from vezda.SurveyClass import Survey
 
 def info():
     commandName = FontColor.BOLD + 'vzsolve:' + FontColor.END
@@ -29,6 +44,9 @@ def info():
     return commandName + description
 
 def cli():
+    # run in the resident session server if one is running (see 'vezda serve')
+    delegate('vzsolve')
+    
     parser = argparse.ArgumentParser()
     parser.add_argument('--nfe', action='store_true',
                         help='Solve the near-field equation (NFE).')
@@ -41,9 +59,12 @@ def cli():
                         help='''Specify whether to solve the linear system in the time domain
                         or frequency domain. Default is set to frequency domain for faster
                         performance.''')
-    parser.add_argument('--method', '-m', type=str, default='lsmr', choices=['lsmr', 'lsqr', 'svd'],
+    parser.add_argument('--method', '-m', type=str, choices=['lsmr', 'lsqr', 'svd', 'direct'],
                         help='''Specify the method for solving the linear system of equations:
-                        iterative least-squares (lsmr/lsqr) or singular-value decomposition (svd).''')
+                        iterative least-squares (lsmr/lsqr), singular-value decomposition (svd),
+                        or direct per-frequency factorization (direct). The direct method is exact
+                        and only available in the frequency domain. Default is \'lsmr\' (or chosen
+                        to fit \'--max-memory\').''')
     parser.add_argument('--fly', '-f', action='store_true',
                         help='''Solve on the fly. Default behavior is to load full array 'B' of right-hand side
                         vectors for bulk processing before solution of a linear systems Ax=b, where each vector
@@ -69,7 +90,80 @@ def cli():
                         help='''Specify whether the background medium is constant or variable
                         (inhomogeneous). If argument is set to 'constant', the velocity defined in
                         the required 'pulsesFun.py' file is used. Default is set to 'constant'.''')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='''Solve the near-field equation on a coarse-to-fine hierarchy of search
+                        points. The image is first obtained on a coarse subset of the search grid, and
+                        only cells where the indicator is large or changes sharply are refined.''')
+    parser.add_argument('--levels', type=int, default=2,
+                        help='''Specify the number of refinement levels for adaptive imaging. The
+                        coarsest level uses every 2**levels-th search point. Default is 2.''')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='''Specify the (normalized) indicator value above which cells are refined
+                        in adaptive imaging. Must be between 0 and 1. Default is 0.5.''')
+    parser.add_argument('--jump', type=float, default=0.25,
+                        help='''Specify the variation of the (normalized) indicator across a cell above
+                        which the cell is refined in adaptive imaging. Must be between 0 and 1.
+                        Default is 0.25.''')
+    parser.add_argument('--chunk', type=int,
+                        help='''Specify the number of right-hand side vectors to solve for at a time.
+                        Each finished chunk of solutions is reduced into the image right away. Default
+                        is to solve for all right-hand side vectors at once.''')
+    parser.add_argument('--store', type=str, choices=['npz', 'mmap', 'norms'],
+                        help='''Specify how the solutions are saved: in memory and then to a compressed
+                        file (npz), appended chunk by chunk to a memory-mapped .npy file (mmap), or
+                        only their (single-precision) norms (norms). With \'mmap\' or \'norms\' and
+                        \'--chunk\', memory use does not grow with the number of search points.
+                        Default is \'npz\' (or chosen to fit \'--max-memory\').''')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='''Specify a directory to which progress is written after each chunk of
+                        right-hand side vectors (see \'--chunk\'). The directory is removed once the
+                        solve is complete.''')
+    parser.add_argument('--resume', action='store_true',
+                        help='''Resume an interrupted solve from its checkpoint directory (Default is
+                        \'vzcheckpoint\'). The checkpoint must have been written for the same inputs and
+                        solver settings.''')
+    parser.add_argument('--precision', type=str, default=None, choices=['single', 'double'],
+                        help='''Specify the floating-point precision of the data, impulse responses,
+                        operator and solutions: single (float32/complex64) or double (float64/complex128).
+                        Single precision halves the memory use. Default is \'double\' (or single
+                        precision if needed to fit \'--max-memory\').''')
+    parser.add_argument('--compare-precision', action='store_true',
+                        help='''After solving, solve the problem again in single and double precision
+                        and report the accuracy of single precision relative to double precision
+                        (saved to \'precisionReportNFE.npz\' or \'precisionReportLSE.npz\').''')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='''Keep the impulse responses (the kernel of the Lippmann-Schwinger operator)
+                        on disk and stream them block by block during each operator product, for problems
+                        whose impulse responses do not fit in memory. Only available with \'--lse\' and
+                        an iterative method (lsmr/lsqr).''')
+    parser.add_argument('--plan', action='store_true',
+                        help='''Print the predicted memory use and run time of the solve (and the
+                        settings chosen for \'--max-memory\') without solving.''')
+    parser.add_argument('--max-memory', type=str, default=None,
+                        help='''Specify a memory budget (e.g., \'8G\'). The method, the storage of the
+                        solutions and the chunk size (each if not specified) are chosen so that the
+                        predicted peak memory fits the budget. If they cannot fit it, single precision
+                        (unless \'--precision\' is specified) and then, for the Lippmann-Schwinger
+                        equation, an out-of-core solve are tried.''')
+    parser.add_argument('--encode', type=int, default=None, metavar='NE',
+                        help='''Encode the sources of the near-field operator into the specified number of
+                        simultaneous sources (random combinations of the source gathers), which
+                        reduces the cost of the operator in proportion.''')
+    parser.add_argument('--encoding', type=str, default='rademacher', choices=ENCODINGS,
+                        help='''Specify the random weights of the encoding: random signs (rademacher) or
+                        Gaussian weights. Default is rademacher.''')
+    parser.add_argument('--encode-per-frequency', action='store_true',
+                        help='''Draw a different encoding for each frequency (frequency domain only).''')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='''Specify the seed of the random encoding, so that it can be reproduced.''')
+    parser.add_argument('--baseline', type=str, default=None, metavar='DIR',
+                        help='''Specify the working directory of a baseline survey over the same acquisition
+                        geometry (time-lapse imaging). Its frequency window, impulse responses and
+                        factorizations of the operator are reused, as are its solutions for the sources
+                        whose data are unchanged. A difference image (monitor - baseline) is saved as well.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzsolve')
     
     #==========================================================================
     # Check the value of the regularization parameter
@@ -132,23 +226,148 @@ def cli():
         # if args.nproc is None
         nproc = 1
         
+    if args.chunk is not None and args.chunk < 1:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Optional argument \'--chunk\' must be a positive integer.
+                '''))
+        
+    if args.resume and args.checkpoint is None:
+        args.checkpoint = 'vzcheckpoint'
+    
+    if args.checkpoint is not None and args.adaptive:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Checkpointing is not available for adaptive imaging.
+                '''))
+        
+    if args.compare_precision and (args.adaptive or args.medium == 'variable'):
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Comparing precisions is not available for adaptive imaging or a
+                variable medium.
+                '''))
+        
+    if args.out_of_core:
+        check_out_of_core(args)
+        
+    if args.baseline is not None:
+        check_baseline(args)
+        
+    if args.encode is not None:
+        if args.lse or args.encode < 1:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Source encoding applies to the near-field equation (\'--nfe\') and
+                    \'--encode\' must be a positive integer.
+                    '''))
+        if args.encode_per_frequency and args.domain == 'time':
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: A different encoding for each frequency is only available in the
+                    frequency domain.
+                    '''))
+        
+    if args.method == 'direct' and args.domain == 'time':
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The direct method is only available in the frequency domain.
+                Use \'--domain=freq\' or choose an iterative method (lsmr/lsqr).
+                '''))
+        
+    #==========================================================================
+    # Check the parameters for adaptive imaging
+    #==========================================================================
+    if args.adaptive:
+        if not args.nfe or args.lse:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Adaptive imaging is only available for the near-field equation.
+                    Use \'--nfe --adaptive\'.
+                    '''))
+        if args.levels < 0:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Optional argument \'--levels\' must be a nonnegative integer.
+                    '''))
+        if not (0.0 <= args.threshold <= 1.0 and 0.0 <= args.jump <= 1.0):
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Optional arguments \'--threshold\' and \'--jump\' must be between 0 and 1.
+                    '''))
+        if np.size(load_search_grid()['tau']) > 1:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Adaptive imaging supports a single focusing time. Set one with
+                    \'vzgrid --tau=value\'.
+                    '''))
+    
+    #==========================================================================
+    # Plan the run: predict memory and time, and choose settings that fit
+    # the memory budget
+    #==========================================================================
+    if args.plan or args.max_memory is not None:
+        if args.nfe == args.lse:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Specify the equation to plan for with \'--nfe\' or \'--lse\'.
+                    '''))
+        if args.adaptive:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Planning is not available for adaptive imaging.
+                    '''))
+        plan_solve(args, nproc)
+        if args.plan:
+            return
+    else:
+        if args.method is None:
+            args.method = 'lsmr'
+        if args.store is None:
+            args.store = 'npz'
+        if args.precision is None:
+            args.precision = 'double'
+    
+    if args.baseline is not None:
+        copied = adopt_baseline(args.baseline, args.lse, args.method)
+        
     #==========================================================================
     # determine whether to solve near-field equation or Lippmann-Schwinger equation
     # load data, impulseResponses
     #==========================================================================      
+    # time-domain impulse responses of the first of several focusing times
+    baseResponses = None
     if args.nfe:
         # Solve using the linear sampling method
         
         # data form the kernel of the linear operator A
-        data = load_data(args.domain, taper=True, verbose=True, skip_fft=False)
+        data = load_data(args.domain, taper=True, verbose=True, skip_fft=False,
+                         precision=args.precision)
+        if args.encode is not None:
+            data = encode_data(data, args)
         
-        # impulse responses are the right-hand side vectors b
-        impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=args.fly)
+        searchGrid = load_search_grid()
+        if args.adaptive:
+            # impulse responses are computed level by level during refinement
+            impulseResponses = None
+        elif searchGrid is not None and np.size(searchGrid['tau']) > 1:
+            # The time-domain impulse responses of the first focusing time are
+            # shifted to the remaining focusing times (see below), so they are
+            # loaded once and those of the first focusing time derived from them
+            baseResponses = load_impulse_responses('time', args.medium, precision=args.precision)
+            if args.fly or args.domain == 'time':
+                impulseResponses = baseResponses.copy()
+            else:
+                impulseResponses = shift_impulse_responses(baseResponses, 0.0, args.domain)
+        else:
+            # impulse responses are the right-hand side vectors b
+            impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=args.fly,
+                                                      precision=args.precision)
         
-        if args.ngs:
+        if args.ngs and impulseResponses is not None:
             print('Normalizing impulse responses by their energy...')
-            for k in range(impulseResponses.shape[2]):
-                impulseResponses[:, :, k] /= norm(impulseResponses[:, :, k])
+            # (not in place: the loaded impulse responses may be shared by a session)
+            impulseResponses = impulseResponses / norm(impulseResponses, axis=(0, 1))[None, None, :]
         
         p = LinearSamplingProblem(operatorName='nfo', kernel=data, rhs_vectors=impulseResponses)
     
@@ -156,10 +375,17 @@ def cli():
         # Solve using Lippmann-Schwinger inversion
         
         # data are the right-hand side vectors b
-        data = load_data(args.domain, taper=True, verbose=True, skip_fft=args.fly)
+        data = load_data(args.domain, taper=True, verbose=True, skip_fft=args.fly,
+                         precision=args.precision)
         
         # impulse responses form the kernel of the linear operator A
-        impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=False)
+        if args.out_of_core:
+            impulseResponses = impulse_response_store(args.domain, args.medium, precision=args.precision)
+        else:
+            # kept as segments of their support in the time domain
+            impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=False,
+                                                      precision=args.precision,
+                                                      compact=args.domain == 'time')
         
         if args.domain == 'time':
             # This is particular to solving the Lippmann-Schwinger equation in the time domain
@@ -186,13 +412,16 @@ def cli():
                 args.nfe = True
                 print('Solving the near-field equation...')
                 # data form the kernel of the linear operator A
-                data = load_data(args.domain, taper=True, verbose=True, skip_fft=False)
+                data = load_data(args.domain, taper=True, verbose=True, skip_fft=False,
+                                 precision=args.precision)
+                if args.encode is not None:
+                    data = encode_data(data, args)
                 # impulse responses are the right-hand side vectors b
-                impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=args.fly)
+                impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=args.fly,
+                                                          precision=args.precision)
                 if args.ngs:
                     print('Normalizing impulse responses by their energy...')
-                    for k in range(impulseResponses.shape[2]):
-                        impulseResponses[:, :, k] /= norm(impulseResponses[:, :, k])
+                    impulseResponses = impulseResponses / norm(impulseResponses, axis=(0, 1))[None, None, :]
                 p = LinearSamplingProblem(operatorName='nfo', kernel=data, rhs_vectors=impulseResponses)
                 userResponded = True
                 break
@@ -201,9 +430,12 @@ def cli():
                 args.lse = True
                 print('Solving the Lippmann-Schwinger equation...')
                 # data are the right-hand side vectors b
-                data = load_data(args.domain, taper=True, verbose=True, skip_fft=args.fly)
+                data = load_data(args.domain, taper=True, verbose=True, skip_fft=args.fly,
+                                 precision=args.precision)
                 # impulse responses form the kernel of the linear operator A
-                impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=False)
+                impulseResponses = load_impulse_responses(args.domain, args.medium, skip_fft=False,
+                                                          precision=args.precision,
+                                                          compact=args.domain == 'time')
                 if args.domain == 'time':
                     # This is particular to solving the Lippmann-Schwinger equation in the time domain
                     # Pad data in the time domain to length 2*Nt-1 (length of circular convolution)
@@ -233,9 +465,234 @@ def cli():
     elif args.lse:
         extension = 'LSE.npz'
         
-    X = p.solve(args.method, args.fly, nproc, alpha, atol, btol, args.numVals)
-    Image = p.construct_image(X)
+    if args.adaptive:
+        searchGrid = load_search_grid()
+        if 'mask' in searchGrid or 'points' in searchGrid:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Adaptive imaging requires a full tensor-product search grid. Remove
+                    the region of interest with \'vzgrid --mask=none\' or set up a grid with
+                    \'vzgrid --xaxis --yaxis\'.
+                    '''))
+        if 'z' in searchGrid:
+            axes = [searchGrid['x'], searchGrid['y'], searchGrid['z']]
+        else:
+            axes = [searchGrid['x'], searchGrid['y']]
+        if min(len(ax) for ax in axes) < 2:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Adaptive imaging requires at least two search points along each axis.
+                    '''))
+        searchPoints = np.vstack(np.meshgrid(*axes, indexing='ij')).reshape(len(axes), -1).T
+        
+        solutions = []
+        def evaluate(indices):
+            # solve the near-field equation only at the requested search points
+            impulseResponses = compute_impulse_responses_at(searchPoints[indices, :],
+                                                            args.domain, args.medium, args.precision)
+            if args.ngs:
+                impulseResponses /= norm(impulseResponses, axis=(0, 1))[None, None, :]
+            p.B = impulseResponses
+            X = p.solve(args.method, args.fly, nproc, alpha, atol, btol, args.numVals)
+            solutions.append(X)
+            return 1.0 / (norm(X, axis=0) + np.finfo(float).eps)
+        
+        Image, samples, sampleLevels = adaptive_image(axes, args.levels, args.threshold,
+                                                      args.jump, evaluate)
+        # solutions were computed level by level; reorder them to match 'samples'
+        computed = np.concatenate([samples[sampleLevels == l] for l in range(args.levels + 1)])
+        X = np.concatenate(solutions, axis=1)[:, np.argsort(computed)]
+        
+        np.savez('solution'+extension, X=X, samples=samples, alpha=alpha, domain=args.domain)
+        np.savez('image'+extension, Image=Image, method=args.method,
+                 alpha=alpha, atol=atol, btol=btol, domain=args.domain,
+                 samples=samples, sampleLevels=sampleLevels)
+        print('Evaluated %d of %d search points.' %(len(samples), len(Image)))
         
-    np.savez('solution'+extension, X=X, alpha=alpha, domain=args.domain)
-    np.savez('image'+extension, Image=Image, method=args.method,
-             alpha=alpha, atol=atol, btol=btol, domain=args.domain)
\ No newline at end of file
+    else:
+        taus = np.atleast_1d(load_search_grid()['tau'])
+        
+        # solutions are written chunk by chunk into 'Xout' (if they are kept)
+        N, K = p.A.shape[1], p.B.shape[2]
+        if len(taus) == 1:
+            shape = (N, K)
+        else:
+            shape = (len(taus), N, K)
+        
+        if args.checkpoint is not None:
+            settings = {'equation': extension, 'domain': args.domain, 'method': args.method,
+                        'alpha': alpha, 'atol': atol, 'btol': btol, 'k': args.numVals,
+                        'ngs': args.ngs, 'fly': args.fly, 'medium': args.medium, 'store': args.store,
+                        'precision': args.precision}
+            checkpoint = Checkpoint(args.checkpoint, fingerprint(settings, p.kernel, p.B, taus),
+                                    args.resume, save_solutions=(args.store == 'npz'))
+            if args.chunk is None:
+                # progress is only saved between chunks
+                args.chunk = max(1, K // 100)
+        else:
+            checkpoint = None
+        
+        # A single chunk of one focusing time is solved at once, and its
+        # solutions are saved as returned rather than copied into 'Xout'
+        single = (len(taus) == 1 and checkpoint is None and args.baseline is None and
+                  (args.chunk is None or args.chunk >= K))
+        
+        if args.store == 'npz' and single:
+            Xout = None
+        elif args.store == 'npz':
+            Xout = np.zeros(shape, dtype=p.A.dtype)
+        elif args.store == 'mmap':
+            Xfile = 'solution' + extension.replace('.npz', '.npy')
+            if args.resume:
+                if not Path(Xfile).exists():
+                    sys.exit(textwrap.dedent(
+                            '''
+                            Error: Cannot resume because the memory-mapped solution file \'%s\'
+                            is missing.
+                            ''' %(Xfile)))
+                Xout = open_memmap(Xfile, mode='r+')
+                if Xout.shape != shape:
+                    sys.exit(textwrap.dedent(
+                            '''
+                            Error: Cannot resume because the memory-mapped solution file \'%s\'
+                            does not match the current problem.
+                            ''' %(Xfile)))
+            else:
+                print('Writing solutions to memory-mapped file \'%s\'...' %(Xfile))
+                Xout = open_memmap(Xfile, mode='w+', dtype=p.A.dtype, shape=shape)
+        else:
+            Xout = None
+        
+        # solutions of one focusing time are saved with the keys that allow
+        # reusing them as the baseline of a later solve
+        if len(taus) == 1:
+            reuseArgs = baseline_keys(p, args, alpha, atol, btol)
+        else:
+            reuseArgs = {}
+        
+        result = None
+        if args.baseline is not None and len(taus) == 1:
+            result = solve_with_baseline(p, args, extension, reuseArgs, copied, alpha, atol, btol,
+                                         nproc, Xout)
+        
+        if result is not None:
+            Image, norms, solved, changed = result
+        
+        elif args.store == 'npz' and single:
+            Xout = p.solve(args.method, args.fly, nproc, alpha, atol, btol, args.numVals)
+            Image, norms = p.construct_image(Xout), None
+        
+        elif len(taus) == 1:
+            Image, norms = p.solve_chunks(args.method, args.fly, nproc, alpha, atol, btol, args.numVals,
+                                          args.chunk, Xout, args.store == 'norms', checkpoint)
+        
+        else:
+            # The impulse responses for the first focusing time are shifted in
+            # time to obtain those of the remaining focusing times, so the
+            # Green functions are evaluated only once. For the near-field
+            # equation the operator (and any factorization of it) is reused.
+            if baseResponses is None and not (args.lse and args.out_of_core):
+                baseResponses = load_impulse_responses('time', args.medium, tau=taus[0],
+                                                       precision=args.precision)
+            
+            Image = []
+            norms = []
+            for i, tau in enumerate(taus):
+                print('Focusing time %d of %d (tau = %0.4g)...' %(i + 1, len(taus), tau))
+                if args.nfe and i == 0 and p.B is not None:
+                    # the right-hand sides of the first focusing time are set
+                    pass
+                elif args.nfe:
+                    if args.fly:
+                        impulseResponses = shift_impulse_responses(baseResponses, tau - taus[0], 'time')
+                    else:
+                        impulseResponses = shift_impulse_responses(baseResponses, tau - taus[0], args.domain)
+                    if args.ngs:
+                        impulseResponses = impulseResponses / norm(impulseResponses, axis=(0, 1))[None, None, :]
+                    p.B = impulseResponses
+                
+                elif args.out_of_core:
+                    # the stored impulse responses are rewritten for each focusing time
+                    impulseResponses = impulse_response_store(args.domain, args.medium, tau=tau,
+                                                              precision=args.precision)
+                    p = LinearSamplingProblem(operatorName='lso', kernel=impulseResponses, rhs_vectors=data)
+                
+                else:
+                    impulseResponses = shift_impulse_responses(baseResponses, tau - taus[0], args.domain)
+                    p = LinearSamplingProblem(operatorName='lso', kernel=impulseResponses, rhs_vectors=data)
+                
+                if Xout is not None:
+                    out = Xout[i]
+                else:
+                    out = None
+                image, tauNorms = p.solve_chunks(args.method, args.fly, nproc, alpha, atol, btol,
+                                                 args.numVals, args.chunk, out, args.store == 'norms',
+                                                 checkpoint, stage_index=i)
+                Image.append(image)
+                norms.append(tauNorms)
+            Image = np.stack(Image)
+            if args.store == 'norms':
+                norms = np.stack(norms)
+        
+        saveArgs = {}
+        if len(taus) > 1:
+            # solutions and images are stacked along the first axis (one per tau)
+            saveArgs['tau'] = taus
+        
+        if args.store == 'npz':
+            np.savez('solution'+extension, X=Xout, alpha=alpha, domain=args.domain, **saveArgs,
+                     **reuseArgs)
+        elif args.store == 'mmap':
+            Xout.flush()
+            del Xout
+            np.savez('solution'+extension, Xfile=Xfile, alpha=alpha, domain=args.domain, **saveArgs,
+                     **reuseArgs)
+        else:
+            np.savez('solution'+extension, norms=norms.astype(np.float32), alpha=alpha,
+                     domain=args.domain, **saveArgs, **reuseArgs)
+        
+        mask = get_search_points(load_search_grid())[1]
+        if mask is not None:
+            # scatter the image at the active search points back into the full grid
+            saveArgs['mask'] = mask
+            Image = scatter_to_grid(Image, mask)
+        
+        np.savez('image'+extension, Image=Image, method=args.method,
+                 alpha=alpha, atol=atol, btol=btol, domain=args.domain, **saveArgs)
+        
+        if args.baseline is not None:
+            if result is None:
+                solved, changed = None, np.array([], dtype=int)
+            report = reuse_report(copied, solved, K)
+            save_difference(args.baseline, extension, Image, report, changed, **saveArgs)
+        
+        if checkpoint is not None:
+            checkpoint.finish()
+        
+        if args.compare_precision:
+            # compared at the first focusing time on the same (noise-free) inputs
+            print('Comparing single and double precision at focusing time %0.4g...' %(taus[0]))
+            try:
+                report = compare_precision(Survey.load(), extension[:3].lower(), args.method, alpha,
+                                           args.domain, taus[0], args.ngs, atol, btol, args.numVals, nproc)
+            except (ValueError, RuntimeError) as err:
+                sys.exit('Error: %s' %(err))
+            print_precision_report(report)
+            np.savez('precisionReport'+extension, **report)
+
+
+def encode_data(data, args):
+    # simultaneous-source encoding of the kernel of the near-field operator
+    Ns = data.shape[2]
+    if args.encode >= Ns:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The number of encoded sources \'--encode\' must be smaller than the
+                number of sources (%d).
+                ''' %(Ns)))
+    if args.encode_per_frequency:
+        print('Encoding %d sources into %d simultaneous sources (%s, per frequency)...'
+              %(Ns, args.encode, args.encoding))
+    else:
+        print('Encoding %d sources into %d simultaneous sources (%s)...' %(Ns, args.encode, args.encoding))
+    return encode_sources(data, args.encode, args.encoding, args.encode_per_frequency, args.seed)
@@ -0,0 +1,420 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import pickle
+import importlib.util
+import numpy as np
+from pathlib import Path
+from scipy.linalg import norm
+from vezda.math_utils import timeShift, as_precision
+from vezda.signal_utils import tukey_taper, fft_window, encode_sources
+from vezda.sampling_utils import (compute_impulse_responses, get_search_points, scatter_to_grid,
+                                  get_unique_indices, add_reciprocal_data, convolution_times)
+from vezda.svd_utils import compute_svd, update_svd
+from vezda.LinearSamplingClass import LinearSamplingProblem
+
+#==============================================================================
+# A class holding an imaging experiment in memory
+#
+# The Survey class offers the pipeline of the command-line tools (vzdata,
+# vzwindow, vzgrid, vzsolve) as a Python API. All arrays are passed in memory:
+# nothing is read from or written to the working directory unless requested
+# with Survey.load() and save(). Invalid arguments raise a ValueError and
+# missing inputs (e.g., no search grid) a RuntimeError, rather than exiting
+# like the command-line tools.
+#
+# Class data objects:
+#   receiverPoints: Nr x dim array of receiver coordinates
+#   recordingTimes: array of Nt recording times
+#   recordedData: Nr x Nt x Ns array of recorded waves
+#   sourcePoints: Ns x dim array of source coordinates (optional)
+#   scattererPoints: array of scatterer coordinates (optional)
+#   pulse, velocity, peakFreq, peakTime: pulse function and background
+#                                        velocity (as in pulseFun.py)
+#   impulseResponses: impulse responses supplied for a variable medium
+#                     (computed for a constant medium if None)
+#   windows: receiver, time, source and frequency windows (see window())
+#   searchGrid: search grid dictionary as saved by vzgrid (see grid())
+#   precision: 'double' (float64/complex128) or 'single' (float32/complex64)
+#              precision of the data, impulse responses and solutions
+#   encoding: settings of the simultaneous-source encoding of the near-field
+#             operator (see encode()), None if the sources are not encoded
+#
+# Class methods:
+#   set the windows: window()
+#   set the search grid: grid()
+#   set the simultaneous-source encoding: encode()
+#   windowed data in the time or frequency domain: data()
+#   impulse responses of the search points: impulse_responses()
+#   linear sampling problem of the NFE or LSE: operator()
+#   solutions and image: solve(), image()
+#   read from/write to a directory used by the command-line tools: load(), save()
+#==============================================================================
+class Survey(object):
+
+    def __init__(self, receiverPoints, recordingTimes, recordedData, sourcePoints=None,
+                 scattererPoints=None, pulse=None, velocity=None, peakFreq=None, peakTime=None,
+                 impulseResponses=None, precision='double'):
+        self.receiverPoints = np.asarray(receiverPoints)
+        self.recordingTimes = np.asarray(recordingTimes)
+        self.recordedData = np.asarray(recordedData)
+        self.sourcePoints = sourcePoints
+        self.scattererPoints = scattererPoints
+        self.pulse = pulse
+        self.velocity = velocity
+        self.peakFreq = peakFreq
+        self.peakTime = peakTime
+        self.impulseResponses = impulseResponses
+        self.precision = precision
+
+        Nr, Nt, Ns = self.recordedData.shape
+        if self.receiverPoints.shape[0] != Nr or len(self.recordingTimes) != Nt:
+            raise ValueError('The recorded data (%d x %d x %d) do not match the %d receivers '
+                             'and %d recording times.'
+                             %(Nr, Nt, Ns, self.receiverPoints.shape[0], len(self.recordingTimes)))
+
+        self.dt = self.recordingTimes[1] - self.recordingTimes[0]
+        self.searchGrid = None
+        self.encoding = None
+        self.window()
+
+
+    def window(self, tstart=None, tstop=None, tstep=1, rstart=0, rstop=None, rstep=1,
+               sstart=0, sstop=None, sstep=1, fmin=0.0, fmax=None, frequencies=None):
+        '''
+        Sets the windows applied to the data (as with vzwindow): times in
+        [tstart, tstop) with units of time, receivers and sources with
+        (zero-based) indices in [start, stop), each decimated by its step, and
+        the frequency window [fmin, fmax), optionally restricted to a selection
+        of 'frequencies' (see 'vezda frequencies'). Returns the survey.
+        '''
+        Nr, Nt, Ns = self.recordedData.shape
+        # time window parameters are converted to array indices as in data_utils
+        if tstart is None:
+            tstart = 0.0
+        if tstop is None:
+            tstop = Nt * self.dt
+        if fmax is None:
+            # the Nyquist frequency of the windowed time samples
+            fmax = 1.0 / (2 * tstep * self.dt)
+
+        self.windows = {'tstart': tstart, 'tstop': tstop, 'tstep': tstep,
+                        'rstart': rstart, 'rstop': Nr if rstop is None else rstop, 'rstep': rstep,
+                        'sstart': sstart, 'sstop': Ns if sstop is None else sstop, 'sstep': sstep,
+                        'fmin': fmin, 'fmax': fmax, 'frequencies': frequencies}
+        self.rinterval = np.arange(rstart, self.windows['rstop'], rstep)
+        self.sinterval = np.arange(sstart, self.windows['sstop'], sstep)
+        self.tinterval = np.arange(int(round(tstart / self.dt)), int(round(tstop / self.dt)), tstep)
+
+        # arrays computed for the previous windows
+        self.cache = {}
+        return self
+
+
+    def grid(self, x=None, y=None, z=None, tau=0.0, points=None, mask=None):
+        '''
+        Sets the search grid (as with vzgrid): either the axes x, y (and z) of
+        a tensor-product grid, optionally restricted to the flattened boolean
+        'mask', or an unstructured array of search 'points'. Returns the survey.
+        '''
+        if points is not None:
+            self.searchGrid = {'points': np.atleast_2d(points), 'tau': tau}
+        elif x is not None and y is not None:
+            self.searchGrid = {'x': np.asarray(x), 'y': np.asarray(y), 'tau': tau}
+            if z is not None:
+                self.searchGrid['z'] = np.asarray(z)
+            if mask is not None:
+                self.searchGrid['mask'] = np.asarray(mask, dtype=bool).ravel()
+        else:
+            raise ValueError('A search grid requires either the axes \'x\' and \'y\' (and \'z\') '
+                             'or an array of search \'points\'.')
+
+        self.searchPoints, self.mask, self.gridShape = get_search_points(self.searchGrid)
+        self.cache = {key: value for key, value in self.cache.items() if key[0] == 'data'}
+        return self
+
+
+    def encode(self, sources=None, encoding='rademacher', per_frequency=False, seed=None):
+        '''
+        Sets the simultaneous-source encoding of the near-field operator (see
+        encode_sources in signal_utils): the windowed sources are replaced by
+        'sources' random combinations of them. Use sources=None to image without
+        encoding. Returns the survey.
+        '''
+        if sources is None:
+            self.encoding = None
+        else:
+            self.encoding = (sources, encoding, per_frequency, seed)
+        return self
+
+
+    def data(self, domain='freq', taper=True):
+        '''
+        Returns the windowed data with any reciprocal data added (see
+        prepare_data in data_utils), tapered and transformed to the frequency
+        domain if domain='freq'.
+        '''
+        key = ('data', domain, taper, self.precision)
+        if key not in self.cache:
+            data = self.recordedData[self.rinterval, :, :][:, self.tinterval, :][:, :, self.sinterval]
+            data = as_precision(data, self.precision)
+            indices = self.reciprocal_indices()
+            if len(indices) > 0:
+                data = add_reciprocal_data(data, indices)
+            if taper:
+                if self.peakFreq is None:
+                    raise RuntimeError('Tapering the data requires the peak frequency \'peakFreq\' '
+                                       'of the pulse function.')
+                data = tukey_taper(np.array(data), self.windows['tstep'] * self.dt,
+                                   self.peakFreq)
+            if domain == 'freq':
+                data = self.transform(data, double_length=True)
+            self.cache[key] = data
+
+        return self.cache[key]
+
+
+    def reciprocal_indices(self):
+        # windowed sources that may be added as receivers (see add_reciprocal_data)
+        if self.sourcePoints is None:
+            return []
+        return get_unique_indices(np.asarray(self.sourcePoints)[self.sinterval, :],
+                                  self.receiverPoints[self.rinterval, :])
+
+
+    def transform(self, X, double_length):
+        return fft_window(X, self.windows['tstep'] * self.dt, self.windows['fmin'],
+                          self.windows['fmax'], double_length, self.windows['frequencies'])
+
+
+    def impulse_responses(self, domain='freq', tau=None):
+        '''
+        Returns the impulse responses of the active search points for the
+        focusing time tau (default is the focusing time of the search grid),
+        in the time or frequency domain. Impulse responses for a constant
+        medium are computed once and shifted in time for other focusing times.
+        '''
+        if self.searchGrid is None:
+            raise RuntimeError('A search grid needs to be set up (see Survey.grid()) before '
+                               'impulse responses can be computed.')
+        if tau is None:
+            tau = float(np.atleast_1d(self.searchGrid['tau'])[0])
+
+        key = ('impulseResponses', domain, tau, self.precision)
+        if key in self.cache:
+            return self.cache[key]
+
+        baseKey = ('impulseResponses', 'time', None, self.precision)
+        if self.impulseResponses is not None:
+            # supplied impulse responses are used as they are
+            impulseResponses = as_precision(self.impulseResponses, self.precision)
+
+        elif baseKey in self.cache:
+            base, baseTau = self.cache[baseKey]
+            impulseResponses = timeShift(base, tau - baseTau, self.windows['tstep'] * self.dt)
+
+        else:
+            if self.pulse is None or self.velocity is None:
+                raise RuntimeError('Computing impulse responses requires the \'pulse\' function and '
+                                   'the \'velocity\' of the background medium.')
+            receiverPoints = self.receiverPoints[self.rinterval, :]
+            indices = self.reciprocal_indices()
+            if len(indices) > 0:
+                sourcePoints = np.asarray(self.sourcePoints)[self.sinterval, :]
+                receiverPoints = np.vstack((receiverPoints, sourcePoints[indices, :]))
+            times = convolution_times(self.recordingTimes[self.tinterval])
+            impulseResponses = compute_impulse_responses('constant', receiverPoints, times - tau,
+                                                         self.searchPoints, self.velocity, self.pulse,
+                                                         self.precision)
+            self.cache[baseKey] = (impulseResponses, tau)
+
+        if domain == 'freq':
+            impulseResponses = self.transform(impulseResponses, double_length=False)
+        self.cache[key] = impulseResponses
+
+        return impulseResponses
+
+
+    def operator(self, equation='nfe', domain='freq', tau=None, ngs=False):
+        '''
+        Returns the linear sampling problem (see LinearSamplingClass) of the
+        near-field equation (nfe) or the Lippmann-Schwinger equation (lse). The
+        problem is kept, so any factorization of the operator is reused by
+        later solves.
+        '''
+        key = ('operator', equation, domain, tau, ngs, self.precision,
+               self.encoding if equation == 'nfe' else None)
+        if key in self.cache:
+            return self.cache[key]
+
+        if equation == 'nfe':
+            impulseResponses = self.impulse_responses(domain, tau)
+            if ngs:
+                impulseResponses = impulseResponses / norm(impulseResponses, axis=(0, 1))[None, None, :]
+            data = self.data(domain)
+            if self.encoding is not None:
+                data = encode_sources(data, *self.encoding)
+            p = LinearSamplingProblem('nfo', data, impulseResponses)
+
+        elif equation == 'lse':
+            data = self.data(domain)
+            if domain == 'time':
+                # pad data to the length of the circular convolution (see Solve.py)
+                data = np.pad(data, ((0, 0), (data.shape[1] - 1, 0), (0, 0)), mode='constant')
+            p = LinearSamplingProblem('lso', self.impulse_responses(domain, tau), data)
+
+        else:
+            raise ValueError('Unknown equation \'%s\'. Use \'nfe\' or \'lse\'.' %(equation))
+
+        self.cache[key] = p
+        return p
+
+
+    def prepare(self, p, method, k):
+        if method == 'svd' and p.SVD is not None and k is not None and k != len(p.SVD[1]):
+            # truncate or extend the SVD kept in memory
+            p.SVD = update_svd(p.kernel, k, *p.SVD, p.operatorName, save=False)
+        
+        elif method == 'svd' and p.SVD is None:
+            # the SVD is kept in memory rather than saved to the working directory
+            if k is None:
+                raise ValueError('The svd method requires the number of singular values and '
+                                 'vectors \'k\'.')
+            p.SVD = compute_svd(p.kernel, k, p.operatorName, save=False)
+
+
+    def solve(self, equation='nfe', method='direct', alpha=0.0, domain='freq', tau=None,
+              ngs=False, atol=1.0e-8, btol=1.0e-8, k=None, nproc=1):
+        '''
+        Solves the near-field equation or Lippmann-Schwinger equation and
+        returns the solutions (one column per right-hand side).
+        '''
+        p = self.operator(equation, domain, tau, ngs)
+        self.prepare(p, method, k)
+        return p.solve(method, False, nproc, alpha, atol, btol, k)
+
+
+    def image(self, equation='nfe', method='direct', alpha=0.0, domain='freq', tau=None,
+              ngs=False, atol=1.0e-8, btol=1.0e-8, k=None, nproc=1, chunk=None):
+        '''
+        Returns the image over the search grid (of the grid's shape for a
+        tensor-product grid, NaN outside of any region of interest). The
+        solutions are reduced into the image chunk by chunk (see solve_chunks).
+        '''
+        p = self.operator(equation, domain, tau, ngs)
+        self.prepare(p, method, k)
+        Image, norms = p.solve_chunks(method, False, nproc, alpha, atol, btol, k, chunk)
+
+        Image = scatter_to_grid(Image, self.mask)
+        if self.gridShape is not None:
+            Image = Image.reshape(self.gridShape)
+
+        return Image
+
+
+    #==========================================================================
+    # Disk persistence (opt-in)
+    @classmethod
+    def load(cls, directory='.'):
+        '''
+        Creates a survey from a working directory set up with the command-line
+        tools: the data directory (datadir.npz), pulse function (pulseFun.py),
+        windows (window.npz and the frequency window of plotParams.pkl) and
+        search grid (searchGrid.npz).
+        '''
+        directory = Path(directory)
+        datadir = np.load(str(directory / 'datadir.npz'))
+        def load_file(key):
+            if key in datadir:
+                return np.load(str(datadir[key]))
+            return None
+
+        pulseFun = None
+        if (directory / 'pulseFun.py').exists():
+            spec = importlib.util.spec_from_file_location('pulseFun', str(directory / 'pulseFun.py'))
+            pulseFun = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(pulseFun)
+
+        survey = cls(load_file('receivers'), load_file('recordingTimes'), load_file('recordedData'),
+                     sourcePoints=load_file('sources'), scattererPoints=load_file('scatterer'),
+                     pulse=getattr(pulseFun, 'pulse', None), velocity=getattr(pulseFun, 'velocity', None),
+                     peakFreq=getattr(pulseFun, 'peakFreq', None), peakTime=getattr(pulseFun, 'peakTime', None),
+                     impulseResponses=load_file('impulseResponses'))
+
+        windows = {}
+        if (directory / 'window.npz').exists():
+            windowDict = np.load(str(directory / 'window.npz'))
+            for key in ['tstart', 'tstop', 'tstep', 'rstart', 'rstop', 'rstep', 'sstart', 'sstop', 'sstep']:
+                windows[key] = windowDict[key].item()
+        if (directory / 'plotParams.pkl').exists():
+            plotParams = pickle.load(open(str(directory / 'plotParams.pkl'), 'rb'))
+            windows['fmin'] = plotParams.get('fmin', 0.0)
+            windows['fmax'] = plotParams.get('fmax', None)
+            windows['frequencies'] = plotParams.get('frequencies', None)
+        survey.window(**windows)
+
+        if 'searchGrid' in datadir:
+            searchGrid = np.load(str(datadir['searchGrid']))
+        elif (directory / 'searchGrid.npz').exists():
+            searchGrid = np.load(str(directory / 'searchGrid.npz'))
+        else:
+            searchGrid = None
+        if searchGrid is not None:
+            survey.grid(**{key: searchGrid[key] for key in searchGrid.files
+                           if key in ['x', 'y', 'z', 'tau', 'points', 'mask']})
+
+        return survey
+
+
+    def save(self, directory='.'):
+        '''
+        Saves the survey to a directory in the format of the command-line
+        tools, so that they can be used on it (e.g., vzsolve, vzimage). The
+        pulse function is code and must be supplied as pulseFun.py.
+        '''
+        directory = Path(directory).resolve()
+        directory.mkdir(parents=True, exist_ok=True)
+        arrays = {'receivers': ('receiverPoints.npy', self.receiverPoints),
+                  'recordingTimes': ('recordingTimes.npy', self.recordingTimes),
+                  'recordedData': ('recordedData.npy', self.recordedData),
+                  'sources': ('sourcePoints.npy', self.sourcePoints),
+                  'scatterer': ('scattererPoints.npy', self.scattererPoints),
+                  'impulseResponses': ('impulseResponses.npy', self.impulseResponses)}
+        files = {}
+        for key, (filename, array) in arrays.items():
+            if array is not None:
+                np.save(str(directory / filename), array)
+                files[key] = str(directory / filename)
+        if self.impulseResponses is not None and self.searchGrid is not None:
+            np.savez(str(directory / 'suppliedSearchGrid.npz'), **self.searchGrid)
+            files['searchGrid'] = str(directory / 'suppliedSearchGrid.npz')
+        np.savez(str(directory / 'datadir.npz'), path=str(directory), files=list(files.values()), **files)
+
+        w = self.windows
+        np.savez(str(directory / 'window.npz'), tstart=w['tstart'], tstop=w['tstop'], tstep=w['tstep'],
+                 rstart=w['rstart'], rstop=w['rstop'], rstep=w['rstep'], slabel='sources',
+                 sstart=w['sstart'], sstop=w['sstop'], sstep=w['sstep'])
+        if self.searchGrid is not None:
+            np.savez(str(directory / 'searchGrid.npz'), **self.searchGrid)
+        
+        # the frequency window is kept with the plot parameters
+        if (directory / 'plotParams.pkl').exists():
+            plotParams = pickle.load(open(str(directory / 'plotParams.pkl'), 'rb'))
+        else:
+            from vezda.plot_utils import default_params
+            plotParams = default_params()
+        plotParams['fmin'] = w['fmin']
+        plotParams['fmax'] = w['fmax']
+        plotParams['frequencies'] = w['frequencies']
+        pickle.dump(plotParams, open(str(directory / 'plotParams.pkl'), 'wb'), pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,183 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import itertools
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+def level_indices(n, stride):
+    '''
+    Returns the indices of a search axis of length 'n' that belong to the
+    lattice with the given stride. The last index is always included so that
+    every lattice covers the full extent of the axis.
+    '''
+    return np.unique(np.r_[np.arange(0, n, stride), n - 1])
+
+
+def cell_indices(lattice, n):
+    '''
+    For each index 0, ..., n-1 along a search axis, return the lowest and
+    highest index of the lattice cells containing it. Indices lying strictly
+    inside a cell belong to one cell; lattice nodes belong to both neighboring
+    cells.
+    '''
+    i = np.arange(n)
+    ncells = len(lattice) - 1
+    lo = np.clip(np.searchsorted(lattice, i, side='left') - 1, 0, ncells - 1)
+    hi = np.clip(np.searchsorted(lattice, i, side='right') - 1, 0, ncells - 1)
+
+    return lo, hi
+
+
+def mark_cells(values, threshold, jump):
+    '''
+    Marks the cells of a lattice for refinement. A cell is marked if the
+    indicator at any of its corners exceeds 'threshold' or if the indicator
+    varies by more than 'jump' across its corners.
+
+    values: normalized indicator values (between 0 and 1) on the lattice nodes
+    '''
+    dim = values.ndim
+    corners = []
+    for shift in itertools.product([0, 1], repeat=dim):
+        corners.append(values[tuple(slice(s, m - 1 + s) for s, m in zip(shift, values.shape))])
+    corners = np.stack(corners)
+    cmax = np.max(corners, axis=0)
+    cmin = np.min(corners, axis=0)
+
+    return np.logical_or(cmax > threshold, cmax - cmin > jump)
+
+
+def refinement_mask(marked, lattices, gridShape):
+    '''
+    Expands the marked cells of a lattice to a boolean mask over the full
+    search grid that is True at every grid point contained in a marked cell.
+    '''
+    bounds = [cell_indices(lattice, n) for lattice, n in zip(lattices, gridShape)]
+
+    mask = np.zeros(gridShape, dtype=bool)
+    for choice in itertools.product([0, 1], repeat=len(gridShape)):
+        index = [bounds[a][c] for a, c in enumerate(choice)]
+        mask |= marked[np.ix_(*index)]
+
+    return mask
+
+
+def lattice_mask(lattices, gridShape):
+    '''
+    Returns a boolean mask over the full search grid that is True at the
+    nodes of the lattice.
+    '''
+    mask = np.zeros(gridShape, dtype=bool)
+    mask[np.ix_(*lattices)] = True
+
+    return mask
+
+
+def interpolate_lattice(values, evaluated, coarse, fine, axes):
+    '''
+    Fills the nodes of the fine lattice that have not been evaluated by
+    multilinear interpolation from the (completely filled) coarse lattice.
+
+    values: full-grid array of indicator values (modified in place)
+    evaluated: full-grid boolean array marking evaluated search points
+    coarse, fine: lists of lattice indices along each axis
+    axes: list of search axis coordinates (x, y[, z])
+    '''
+    interpolator = RegularGridInterpolator([ax[idx] for ax, idx in zip(axes, coarse)],
+                                           values[np.ix_(*coarse)], method='linear')
+
+    fineMask = lattice_mask(fine, values.shape)
+    fill = np.logical_and(fineMask, ~evaluated)
+    if np.any(fill):
+        idx = np.nonzero(fill)
+        points = np.stack([ax[i] for ax, i in zip(axes, idx)], axis=-1)
+        values[idx] = interpolator(points)
+
+    return values
+
+
+def adaptive_image(axes, levels, threshold, jump, evaluate):
+    '''
+    Constructs an image on a coarse-to-fine hierarchy of search lattices.
+
+    The image is first evaluated on a coarse lattice obtained by taking every
+    2**levels-th point of the search grid. At each subsequent level, the lattice
+    spacing is halved and only the cells flagged by 'mark_cells' are refined.
+    Grid points that are never evaluated are filled by multilinear
+    interpolation from the enclosing coarser lattice.
+
+    axes: list of search axis coordinates (x, y[, z])
+    levels: number of refinement levels
+    threshold: refine cells whose normalized indicator exceeds this value
+    jump: refine cells whose normalized indicator varies by more than this value
+    evaluate: a function that takes an array of flat grid indices and returns
+              the (unnormalized) indicator values at those search points
+
+    Output:
+        Image: the normalized image over the full search grid (flattened)
+        samples: flat indices of the evaluated search points
+        sampleLevels: refinement level at which each sample was evaluated
+    '''
+    gridShape = tuple(len(ax) for ax in axes)
+    values = np.zeros(gridShape)
+    evaluated = np.zeros(gridShape, dtype=bool)
+    sampleLevel = np.full(gridShape, -1, dtype=np.int8)
+
+    stride = 2**levels
+    lattices = [level_indices(n, stride) for n in gridShape]
+    newPoints = lattice_mask(lattices, gridShape)
+
+    for level in range(levels + 1):
+        indices = np.flatnonzero(newPoints)
+        print('Refinement level %d: evaluating %d of %d search points...'
+              %(level, len(indices), np.prod(gridShape)))
+        if len(indices) > 0:
+            values.flat[indices] = evaluate(indices)
+            evaluated.flat[indices] = True
+            sampleLevel.flat[indices] = level
+
+        if level < levels:
+            stride //= 2
+            fineLattices = [level_indices(n, stride) for n in gridShape]
+
+            # normalize the indicator over all evaluated points to
+            # determine which cells to refine
+            vmin = np.min(values[evaluated])
+            vmax = np.max(values[evaluated])
+            lvalues = values[np.ix_(*lattices)]
+            lvalues = (lvalues - vmin) / (vmax - vmin + np.finfo(float).eps)
+            marked = mark_cells(lvalues, threshold, jump)
+
+            # fill the unevaluated nodes of the next lattice before refinement
+            values = interpolate_lattice(values, evaluated, lattices, fineLattices, axes)
+
+            newPoints = refinement_mask(marked, lattices, gridShape)
+            newPoints &= lattice_mask(fineLattices, gridShape)
+            newPoints &= ~evaluated
+            lattices = fineLattices
+
+    # fill any points of the full grid that were never evaluated
+    values = interpolate_lattice(values, evaluated, lattices,
+                                 [np.arange(n) for n in gridShape], axes)
+
+    # Normalize Image to take on values between 0 and 1
+    Image = values.reshape(-1)
+    Imin = np.min(Image)
+    Imax = np.max(Image)
+    Image = (Image - Imin) / (Imax - Imin + np.finfo(float).eps)
+
+    samples = np.flatnonzero(evaluated)
+
+    return Image, samples, sampleLevel.reshape(-1)[samples]
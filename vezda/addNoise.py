@@ -19,9 +19,11 @@ import textwrap
 import numpy as np
 import pickle
 from pathlib import Path
+from numpy.lib.format import open_memmap
 from vezda.signal_utils import add_noise
 from vezda.plot_utils import default_params
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vznoise:' + FontColor.END
@@ -38,7 +40,15 @@ def cli():
     parser.add_argument('--snr', type=float,
                         help='''Specify the desired signal-to-noise ratio. Must be a positive
                                 real number.''')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='''Specify the seed of the random number generator. Default is a random
+                        seed, which is saved to 'noisyData.npz' so that the noise can be reproduced.''')
+    parser.add_argument('--memmap', action='store_true',
+                        help='''Write the noisy data to the memory-mapped file 'noisyData.npy' (for
+                        data that do not fit in memory twice).''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vznoise')
     
     #==============================================================================
     try:
@@ -46,8 +56,9 @@ def cli():
         fmin = Dict['fmin']
         fmax = Dict['fmax']
         snr = Dict['snr']
+        seed = Dict['seed'] if 'seed' in Dict.files else None
     except FileNotFoundError:
-        fmin, fmax, snr = None, None, None
+        fmin, fmax, snr, seed = None, None, None, None
         
     # Used for getting frequency units
     if Path('plotParams.pkl').exists():
@@ -75,7 +86,8 @@ def cli():
                         Minimum frequency: {:0.2f} {}
                         Maximum frequency: {:0.2f} {}
                         Signal-to-noise ratio: {:0.2f}
-                        '''.format(fmin, fu, fmax, fu, snr)))
+                        Seed: {}
+                        '''.format(fmin, fu, fmax, fu, snr, seed)))
             else:
                 sys.exit(textwrap.dedent(
                         '''
@@ -84,7 +96,8 @@ def cli():
                         Minimum frequency: {:0.2f}
                         Maximum frequency: {:0.2f}
                         Signal-to-noise ratio: {:0.2f}
-                        '''.format(fmin, fmax, snr)))
+                        Seed: {}
+                        '''.format(fmin, fmax, snr, seed)))
                     
     elif all(v is not None for v in [args.fmin, args.fmax, args.snr]):
         # if all arguments were passed
@@ -109,6 +122,11 @@ def cli():
         fmin = args.fmin
         fmax = args.fmax
         snr = args.snr
+        if args.seed is not None:
+            seed = args.seed
+        else:
+            # a fresh seed, saved so the noise can be reproduced
+            seed = np.random.default_rng().integers(2**63 - 1)
         fu = plotParams['fu']
         if fu != '':
             print(textwrap.dedent(
@@ -118,7 +136,8 @@ def cli():
                   Minimum frequency: {:0.2f} {}
                   Maximum frequency: {:0.2f} {}
                   Signal-to-noise ratio: {:0.2f}
-                  '''.format(fmin, fu, fmax, fu, snr)))
+                  Seed: {}
+                  '''.format(fmin, fu, fmax, fu, snr, seed)))
         else:
             print(textwrap.dedent(
                   '''
@@ -127,16 +146,25 @@ def cli():
                   Minimum frequency: {:0.2f}
                   Maximum frequency: {:0.2f}
                   Signal-to-noise ratio: {:0.2f}
-                  '''.format(fmin, fmax, snr)))
+                  Seed: {}
+                  '''.format(fmin, fmax, snr, seed)))
         
         # Load the 3D data array and recording times from data directory
         datadir = np.load('datadir.npz')
-        recordedData = np.load(str(datadir['recordedData']))
+        # (read block by block of sources as the noise is added)
+        recordedData = np.load(str(datadir['recordedData']), mmap_mode='r')
         recordingTimes = np.load(str(datadir['recordingTimes']))
         dt = recordingTimes[1] - recordingTimes[0]
     
-        noisyData = add_noise(recordedData, dt, fmin, fmax, snr)
-        np.savez('noisyData.npz', noisyData=noisyData, fmin=fmin, fmax=fmax, snr=snr)
+        if args.memmap:
+            print('Writing noisy data to memory-mapped file \'noisyData.npy\'...')
+            out = open_memmap('noisyData.npy', mode='w+', dtype=recordedData.dtype, shape=recordedData.shape)
+            add_noise(recordedData, dt, fmin, fmax, snr, seed, out)
+            out.flush()
+            np.savez('noisyData.npz', noisyFile='noisyData.npy', fmin=fmin, fmax=fmax, snr=snr, seed=seed)
+        else:
+            noisyData = add_noise(recordedData, dt, fmin, fmax, snr, seed)
+            np.savez('noisyData.npz', noisyData=noisyData, fmin=fmin, fmax=fmax, snr=snr, seed=seed)
         
     else:
         sys.exit(textwrap.dedent(
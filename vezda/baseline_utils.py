@@ -0,0 +1,345 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import sys
+import pickle
+import shutil
+import textwrap
+import numpy as np
+from pathlib import Path
+from vezda.session_utils import file_signature
+from vezda.checkpoint_utils import fingerprint
+from vezda.LinearSamplingClass import normalize_indicator
+
+# files of a baseline survey that do not depend on the recorded data
+# (the SVD of the Lippmann-Schwinger operator is that of the impulse responses)
+REUSABLE_FILES = {'impulse responses': 'VZImpulseResponses.npz',
+                  'SVD of the operator': 'LSO_SVD.npz'}
+
+def check_baseline(args):
+    '''
+    Checks that the baseline directory of vzsolve is a working directory
+    with a completed solve and that the other settings allow reusing it.
+    '''
+    directory = Path(args.baseline)
+    if not (directory / 'datadir.npz').exists():
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The baseline \'%s\' is not a Vezda working directory (it has no
+                \'datadir.npz\').
+                ''' %(args.baseline)))
+    if directory.resolve() == Path.cwd().resolve():
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The baseline must be the working directory of a different survey.
+                '''))
+    if args.nfe == args.lse:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Specify the equation solved for the baseline with \'--nfe\' or \'--lse\'.
+                '''))
+    if args.adaptive or args.out_of_core or args.compare_precision or args.checkpoint is not None:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: A baseline cannot be combined with adaptive imaging, out-of-core solves,
+                comparing precisions or checkpointing.
+                '''))
+
+
+def adopt_baseline(directory, lse, method):
+    '''
+    Takes over the parts of a baseline survey that do not depend on the
+    recorded data: the frequency window, the impulse responses and (for the
+    Lippmann-Schwinger equation) the SVD of the operator. The files are copied
+    into the working directory, where they are checked for consistency as
+    usual when they are loaded. Returns the signatures of the copied files,
+    from which it is determined afterwards whether they were reused (see
+    reuse_report).
+    '''
+    from vezda import data_utils
+
+    directory = Path(directory)
+    print('Reusing the baseline survey \'%s\'...' %(directory))
+    if (directory / 'plotParams.pkl').exists():
+        baselineParams = pickle.load(open(str(directory / 'plotParams.pkl'), 'rb'))
+        if baselineParams.get('fmax') is not None:
+            print('Applying the frequency window of the baseline...')
+            data_utils.plotParams['fmin'] = baselineParams['fmin']
+            data_utils.plotParams['fmax'] = baselineParams['fmax']
+            pickle.dump(data_utils.plotParams, open('plotParams.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+
+    copied = {}
+    for name, filename in REUSABLE_FILES.items():
+        if name == 'SVD of the operator' and not (lse and method == 'svd'):
+            continue
+        if (directory / filename).exists():
+            if file_signature(filename) != file_signature(str(directory / filename)):
+                shutil.copy2(str(directory / filename), filename)
+            copied[name] = file_signature(filename)
+
+    return copied
+
+
+def solved_data(p, domain):
+    '''
+    Returns the recorded data of a problem as prepared by prepare_data: the
+    kernel of the near-field operator or the right-hand sides of the
+    Lippmann-Schwinger equation (without the padding of the time domain).
+    '''
+    if p.operatorName == 'nfo':
+        return p.kernel
+    elif domain == 'time':
+        return p.B[:, (p.B.shape[1] - 1) // 2:, :]
+    return p.B
+
+
+def baseline_keys(p, args, alpha, atol, btol):
+    '''
+    Returns the keys with which the solutions of vzsolve are saved, so that a
+    later solve can reuse them as a baseline (see baseline_solution):
+
+        reuseKey: identifies everything the solutions depend on apart from
+                  the recorded data (solver settings, windows and impulse
+                  responses, which carry the search grid, focusing time,
+                  medium, normalization and precision)
+        dataKey: identifies the prepared recorded (or noisy) data solved for
+    '''
+    from vezda import data_utils
+    from vezda.data_utils import get_user_windows
+
+    rinterval, tinterval, tstep, dt, sinterval = get_user_windows()
+    settings = {'equation': p.operatorName, 'domain': args.domain, 'method': args.method,
+                'alpha': alpha, 'k': args.numVals, 'fly': args.fly, 'ngs': args.ngs,
+                'medium': args.medium, 'precision': args.precision, 'encode': args.encode,
+                'tstep': tstep, 'dt': dt, 'fmin': data_utils.plotParams['fmin'],
+                'fmax': data_utils.plotParams['fmax']}
+    if args.method in ['lsmr', 'lsqr']:
+        settings.update(atol=atol, btol=btol)
+    arrays = [p.B if p.operatorName == 'nfo' else p.kernel,
+              np.asarray(rinterval), np.asarray(tinterval), np.asarray(sinterval)]
+    if data_utils.plotParams.get('frequencies') is not None:
+        arrays.append(np.asarray(data_utils.plotParams['frequencies']))
+
+    return {'reuseKey': fingerprint(settings, *arrays),
+            'dataKey': fingerprint({}, solved_data(p, args.domain))}
+
+
+def baseline_solution(directory, extension, reuseKey, keep_solutions):
+    '''
+    Loads the solution norms (and, if keep_solutions is True, the solutions)
+    of a baseline solve. Returns (norms, X, dataKey) or None if the baseline
+    was solved with different settings, windows or impulse responses (see
+    baseline_keys) or did not keep what the current solve stores.
+    '''
+    directory = Path(directory)
+    if not ((directory / ('solution' + extension)).exists() and (directory / ('image' + extension)).exists()):
+        print('Baseline has no solutions to reuse...')
+        return None
+
+    solution = np.load(str(directory / ('solution' + extension)))
+    if 'tau' in solution.files:
+        print('Baseline was solved for several focusing times: solutions are not reused...')
+        return None
+    if 'reuseKey' not in solution.files or str(solution['reuseKey']) != reuseKey:
+        print('Baseline was solved with different settings: solutions are not reused...')
+        return None
+
+    X = None
+    if 'X' in solution.files:
+        X = solution['X']
+    elif 'Xfile' in solution.files:
+        X = np.load(str(directory / Path(str(solution['Xfile'])).name), mmap_mode='r')
+    elif keep_solutions:
+        print('Baseline kept only the solution norms: solutions are not reused...')
+        return None
+
+    if 'norms' in solution.files:
+        norms = solution['norms']
+    else:
+        norms = None
+    return norms, X, str(solution['dataKey'])
+
+
+def baseline_data(directory, domain, skip_fft, precision, dataKey):
+    '''
+    Returns the data the baseline survey was solved for (its recorded data or
+    the noisy data of 'vznoise'), prepared with the windows, taper and
+    transform of the current survey (see prepare_data), or None if neither
+    matches dataKey (see baseline_keys).
+    '''
+    from vezda.data_utils import prepare_data
+
+    directory = Path(directory)
+    datadir = np.load(str(directory / 'datadir.npz'))
+    candidates = [('recorded', str(datadir['recordedData']))]
+    if (directory / 'noisyData.npz').exists():
+        candidates.append(('noisy', str(directory / 'noisyData.npz')))
+
+    for name, filename in candidates:
+        print('Loading the %s waveforms of the baseline...' %(name))
+        data = prepare_data(domain, taper=True, skip_fft=skip_fft, precision=precision,
+                            filename=filename)
+        if fingerprint({}, data) == dataKey:
+            return data
+    print('Baseline data differ from those it was solved for: solutions are not reused...')
+    return None
+
+
+def changed_sources(data, baselineData):
+    '''
+    Returns the indices of the sources (right-hand sides or operator columns
+    along the last axis) whose prepared data differ from the baseline.
+    '''
+    if baselineData.shape != data.shape:
+        return np.arange(data.shape[2])
+    return np.flatnonzero(np.any(data != baselineData, axis=(0, 1)))
+
+
+def solve_against_baseline(p, changed, baseline, method, fly, nproc, alpha, atol, btol, k,
+                           chunk, out, keep_norms):
+    '''
+    Solves a monitor survey, reusing the baseline solutions of the right-hand
+    sides that are unchanged. For the near-field equation the data form the
+    operator, so any change requires all right-hand sides to be solved again.
+    For the Lippmann-Schwinger equation the data are the right-hand sides, so
+    only the sources whose data changed are solved.
+
+    changed: indices of the sources whose data differ from the baseline
+    baseline: (norms, X) of the baseline solve (see baseline_solution)
+
+    Returns the image, the solution norms (if keep_norms is True) and the
+    indices of the right-hand sides that were solved, or None if the baseline
+    solutions do not match the current problem.
+    '''
+    B = p.B
+    K = B.shape[2]
+    if p.operatorName == 'nfo':
+        solved = np.arange(K) if len(changed) > 0 else np.array([], dtype=int)
+    else:
+        solved = np.asarray(changed)
+
+    baselineNorms, X0 = baseline
+    if ((X0 is not None and X0.shape != (p.A.shape[1], K)) or
+        (baselineNorms is not None and baselineNorms.shape[-1] != K)):
+        print('Baseline solutions do not match the current problem: solutions are not reused...')
+        return None
+    if baselineNorms is None:
+        baselineNorms = p.solution_norms(X0)
+    norms = np.array(baselineNorms, dtype=float)
+    if out is not None:
+        out[:] = X0
+
+    if len(solved) > 0:
+        print('Solving for %d of %d right-hand sides...' %(len(solved), K))
+        Xsolved = np.zeros((out.shape[0], len(solved)), dtype=out.dtype) if out is not None else None
+        p.B = B[:, :, solved]
+        try:
+            image, solvedNorms = p.solve_chunks(method, fly, nproc, alpha, atol, btol, k, chunk,
+                                                Xsolved, True)
+        finally:
+            p.B = B
+        norms[..., solved] = solvedNorms
+        if out is not None:
+            out[:, solved] = Xsolved
+
+    else:
+        print('Constructing the image...')
+    if p.operatorName == 'nfo':
+        Image = p.finalize_image(norms, K)
+    elif p.operatorName == 'lso':
+        Image = p.finalize_image(np.sum(normalize_indicator(norms)**2, axis=1), K)
+
+    return Image, norms if keep_norms else None, solved
+
+
+def solve_with_baseline(p, args, extension, keys, copied, alpha, atol, btol, nproc, out):
+    '''
+    Solves the problem of vzsolve reusing the solutions of the baseline
+    (see solve_against_baseline). Returns (Image, norms, solved, changed), or
+    None if the baseline solutions cannot be reused.
+
+    keys: the keys of the current solve (see baseline_keys)
+    copied: the files taken over from the baseline (see adopt_baseline)
+    '''
+    if 'impulse responses' in recomputed(copied):
+        print('Impulse responses of the baseline were recomputed: solutions are not reused...')
+        return None
+    baseline = baseline_solution(args.baseline, extension, keys['reuseKey'], out is not None)
+    if baseline is None:
+        return None
+    norms, X, dataKey = baseline
+
+    baselineData = baseline_data(args.baseline, args.domain, args.lse and args.fly, args.precision,
+                                 dataKey)
+    if baselineData is None:
+        return None
+    # the data form the operator (nfe) or the right-hand sides (lse)
+    data = solved_data(p, args.domain)
+    changed = changed_sources(data, baselineData)
+    print('Data of %d of %d sources differ from the baseline...' %(len(changed), data.shape[2]))
+    result = solve_against_baseline(p, changed, (norms, X), args.method, args.fly, nproc, alpha,
+                                    atol, btol, args.numVals, args.chunk, out, args.store == 'norms')
+    if result is None:
+        return None
+    return result + (changed,)
+
+
+def recomputed(copied):
+    '''
+    Returns the names of the files taken over from the baseline (see
+    adopt_baseline) that were found inconsistent and recomputed since.
+    '''
+    # a file rewritten since it was copied was recomputed
+    return [name for name, signature in copied.items()
+            if file_signature(REUSABLE_FILES[name]) != signature]
+
+
+def reuse_report(copied, solved, K):
+    '''
+    Prints and returns which parts of the monitor solve were taken over from
+    the baseline and which required new computation.
+    '''
+    report = {}
+    for name in copied:
+        report[name] = 'recomputed' if name in recomputed(copied) else 'reused'
+    if solved is None:
+        report['solutions'] = 'recomputed'
+    elif len(solved) == 0:
+        report['solutions'] = 'reused'
+    else:
+        report['solutions'] = 'recomputed for %d of %d right-hand sides' %(len(solved), K)
+
+    print('\nParts of the monitor solve taken over from the baseline:\n')
+    for name, value in report.items():
+        print('    %-20s %s' %(name + ':', value))
+    print('')
+    return report
+
+
+def save_difference(directory, extension, Image, report, changed, **saveArgs):
+    '''
+    Saves the difference between the monitor image and the baseline image
+    to 'imageDifference<extension>' in the format of the image files.
+    '''
+    baselineImage = Path(directory) / ('image' + extension)
+    if not baselineImage.exists():
+        print('Baseline has no image: no difference image is saved...')
+        return
+    baselineImage = np.load(str(baselineImage))['Image']
+    if baselineImage.shape != Image.shape:
+        print('Baseline image is of a different shape: no difference image is saved...')
+        return
+    np.savez('imageDifference' + extension, Image=Image - baselineImage, changedSources=changed,
+             recomputed=[name for name, value in report.items() if value != 'reused'], **saveArgs)
+    print('Difference image saved to \'imageDifference%s\'.' %(extension))
@@ -0,0 +1,197 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import io
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from contextlib import redirect_stdout, redirect_stderr
+from vezda.benchmarks.synthetic import SyntheticSurvey, search_grid, velocity, pulse
+from vezda.LinearOperators import asConvolutionalOperator
+from vezda.LinearSamplingClass import LinearSamplingProblem
+from vezda.sampling_utils import compute_impulse_responses
+from vezda.svd_utils import compute_svd
+
+# survey sizes: number of receivers, sources, time samples and
+# search points along each axis of the grid
+SIZES = {'small': {'Nr': 16, 'Ns': 16, 'Nt': 64, 'grid': 11},
+         'medium': {'Nr': 32, 'Ns': 32, 'Nt': 128, 'grid': 21},
+         'large': {'Nr': 64, 'Ns': 64, 'Nt': 256, 'grid': 41}}
+
+# cases prefixed with 'lso_' time the Lippmann-Schwinger operator (the
+# others time the near-field operator)
+CASES = ['impulse_responses',
+         'matvec_time', 'rmatvec_time', 'matvec_freq', 'rmatvec_freq',
+         'svd', 'lsmr', 'lsqr', 'svd_solve', 'direct', 'construct_image',
+         'lso_matvec_freq', 'lso_rmatvec_freq', 'lso_lsmr', 'lso_direct', 'lso_construct_image']
+
+
+def measure(function, repeat):
+    '''
+    Times 'function' (called without arguments) 'repeat' times with its
+    console output suppressed. Returns the wall times in seconds.
+    '''
+    times = []
+    for i in range(repeat):
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            startTime = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - startTime)
+
+    return times
+
+
+def benchmark_cases(size, cases, repeat=3, nrhs=8, k=20, alpha=1e-3, dim=2):
+    '''
+    Runs the benchmark cases on a synthetic survey of the given size and
+    yields one result dictionary per case.
+
+    size: dictionary with keys 'Nr', 'Ns', 'Nt' and 'grid'
+    cases: list of case names (see CASES)
+    nrhs: number of search points (sources for the Lippmann-Schwinger
+          operator) solved for by the solvers
+    k: number of singular values/vectors for the truncated SVD
+    alpha: regularization parameter
+    '''
+    survey = SyntheticSurvey(size['Nr'], size['Ns'], size['Nt'], dim)
+    axes, points = search_grid(dim, size['grid'])
+    # the solvers are timed on a subset of search points
+    subset = points[np.linspace(0, len(points) - 1, min(nrhs, len(points))).astype(int)]
+
+    timeKernel = survey.time_kernel()
+    freqKernel = survey.freq_kernel()
+    timeOperator = asConvolutionalOperator(timeKernel)
+    freqOperator = asConvolutionalOperator(freqKernel)
+    freqRhs = survey.freq_rhs(subset)
+    problem = LinearSamplingProblem('nfo', freqKernel, freqRhs)
+    
+    # the Lippmann-Schwinger operator is formed by the impulse responses of
+    # all search points, and the recorded data are its right-hand sides
+    lsoKernel = survey.freq_rhs(points)
+    lsoOperator = asConvolutionalOperator(lsoKernel)
+    lsoRhs = freqKernel[:, :, :min(nrhs, freqKernel.shape[2])]
+    lsoProblem = LinearSamplingProblem('lso', lsoKernel, lsoRhs)
+
+    rng = np.random.default_rng(0)
+    def random_vector(n, dtype):
+        x = rng.standard_normal(n)
+        if np.issubdtype(dtype, np.complexfloating):
+            x = x + 1j * rng.standard_normal(n)
+        return x
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # compute_svd saves its output to the working directory
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                U, s, Vh = compute_svd(freqKernel, k, 'nfo')
+                X = problem.solve_direct(alpha)
+                lsoX = lsoProblem.solve_direct(alpha)
+
+            functions = {
+                'impulse_responses': lambda : compute_impulse_responses('constant', survey.receiverPoints,
+                                                                        survey.convolution_times(), points,
+                                                                        velocity, pulse),
+                'matvec_time': lambda x=random_vector(timeOperator.shape[1], float) : timeOperator.matvec(x),
+                'rmatvec_time': lambda y=random_vector(timeOperator.shape[0], float) : timeOperator.rmatvec(y),
+                'matvec_freq': lambda x=random_vector(freqOperator.shape[1], complex) : freqOperator.matvec(x),
+                'rmatvec_freq': lambda y=random_vector(freqOperator.shape[0], complex) : freqOperator.rmatvec(y),
+                'svd': lambda : compute_svd(freqKernel, k, 'nfo'),
+                'lsmr': lambda : problem.solve_lsmr(np.sqrt(alpha), 1e-6, 1e-6),
+                'lsqr': lambda : problem.solve_lsqr(np.sqrt(alpha), 1e-6, 1e-6),
+                'svd_solve': lambda : problem.solve_svd(U, s, Vh, alpha),
+                'direct': lambda : LinearSamplingProblem('nfo', freqKernel, freqRhs).solve_direct(alpha),
+                'construct_image': lambda : problem.construct_image(X),
+                'lso_matvec_freq': lambda x=random_vector(lsoOperator.shape[1], complex) : lsoOperator.matvec(x),
+                'lso_rmatvec_freq': lambda y=random_vector(lsoOperator.shape[0], complex) : lsoOperator.rmatvec(y),
+                'lso_lsmr': lambda : lsoProblem.solve_lsmr(np.sqrt(alpha), 1e-6, 1e-6),
+                'lso_direct': lambda : LinearSamplingProblem('lso', lsoKernel, lsoRhs).solve_direct(alpha),
+                'lso_construct_image': lambda : lsoProblem.construct_image(lsoX)}
+
+            for case in cases:
+                times = measure(functions[case], repeat)
+                yield {'case': case,
+                       'size': dict(size, dim=dim, Nf=freqKernel.shape[1], nrhs=len(subset), k=k),
+                       'min': min(times), 'median': float(np.median(times)),
+                       'times': times}
+        finally:
+            os.chdir(cwd)
+
+
+#==============================================================================
+def environment():
+    '''
+    Returns a description of the environment in which the benchmarks run.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    try:
+        import pkg_resources  # part of setuptools
+        version = pkg_resources.require('vezda')[0].version
+    except Exception:
+        version = None
+
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'version': version,
+            'commit': commit or None,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor()}
+
+
+def append_history(filename, run):
+    '''
+    Appends a benchmark run as one JSON line to the history file.
+    '''
+    with open(filename, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baseline(filename, run):
+    with open(filename, 'w') as f:
+        json.dump(run, f, indent=2)
+
+
+def compare(run, baseline, tolerance):
+    '''
+    Compares the median times of a run against a baseline run. Returns a list
+    of (case, size name, dimension, baseline median, median, ratio, regressed)
+    tuples for the cases present in both runs (for the same size and number of
+    space dimensions). A case has regressed if its median time exceeds the
+    baseline by more than the relative 'tolerance'.
+    '''
+    key = lambda r : (r['case'], r['name'], r['size'].get('dim', 2))
+    reference = {key(r): r['median'] for r in baseline['results']}
+    comparison = []
+    for r in run['results']:
+        if key(r) in reference:
+            ratio = r['median'] / reference[key(r)]
+            comparison.append(key(r) + (reference[key(r)], r['median'], ratio, ratio > 1 + tolerance))
+
+    return comparison
@@ -0,0 +1,145 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import numpy as np
+from vezda.math_utils import nextPow2
+from vezda.sampling_utils import free_space_ir
+
+# pulse function and background velocity used by the synthetic surveys
+# (the same as in the starfish tutorial)
+velocity = 1.0
+peakFreq = 4.0
+peakTime = 3.0
+
+def pulse(t):
+    return np.sin(peakFreq * t) * np.exp(-1.6 * (t - peakTime)**2)
+
+
+def sphere_points(N, dim, radius):
+    '''
+    Returns N points spread evenly over a circle (dim=2) or a sphere (dim=3)
+    of the given radius centered at the origin.
+    '''
+    i = np.arange(N)
+    if dim == 2:
+        theta = 2 * np.pi * i / N
+        return radius * np.column_stack((np.cos(theta), np.sin(theta)))
+
+    elif dim == 3:
+        # Fibonacci lattice on the sphere
+        z = 1 - (2 * i + 1) / N
+        r = np.sqrt(1 - z**2)
+        phi = np.pi * (3 - np.sqrt(5)) * i
+        return radius * np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+def search_grid(dim, n, extent=2.0):
+    '''
+    Returns the axes and the (flattened) points of a search grid with 'n'
+    points along each axis covering [-extent, extent]^dim.
+    '''
+    axes = [np.linspace(-extent, extent, n)] * dim
+    points = np.vstack(np.meshgrid(*axes, indexing='ij')).reshape(dim, -1).T
+
+    return axes, points
+
+
+#==============================================================================
+# A class holding a synthetic survey of point scatterers
+#
+# Class data objects:
+#   receiverPoints: Nr x dim array of receiver coordinates
+#   sourcePoints: Ns x dim array of source coordinates
+#   recordingTimes: array of Nt recording times
+#   scatterers: array of point scatterer coordinates
+#   data: Nr x Nt x Ns array of recorded (Born-approximated) waves
+#
+# Class methods:
+#   time-domain kernel and right-hand sides: time_kernel(), time_rhs(points)
+#   frequency-domain kernel and right-hand sides: freq_kernel(), freq_rhs(points)
+#==============================================================================
+class SyntheticSurvey(object):
+
+    def __init__(self, Nr, Ns, Nt, dim=2, scatterers=None, radius=5.0, T=None):
+        self.dim = dim
+        self.receiverPoints = sphere_points(Nr, dim, radius)
+        self.sourcePoints = sphere_points(Ns, dim, 1.05 * radius)
+        if T is None:
+            # long enough to record waves scattered at the center of the array
+            T = peakTime + 2.5 * radius / velocity
+        self.recordingTimes = np.linspace(0, T, Nt)
+        self.dt = self.recordingTimes[1] - self.recordingTimes[0]
+
+        if scatterers is None:
+            scatterers = np.zeros((1, dim))
+            scatterers[0, 0] = 0.5
+        self.scatterers = np.atleast_2d(scatterers)
+
+        self.data = self.forward_model()
+
+
+    def forward_model(self):
+        '''
+        Models the waves scattered by the point scatterers in the Born
+        approximation: for each scatterer z, the incident impulse response
+        from the source to z is convolved in time with the free-space Green
+        function from z to the receivers.
+        '''
+        Nt = len(self.recordingTimes)
+        N = nextPow2(2 * Nt)
+        impulse = lambda t : np.where(np.abs(t) < self.dt / 2, 1.0 / self.dt, 0.0)
+
+        data = np.zeros((len(self.receiverPoints), Nt, len(self.sourcePoints)))
+        for z in self.scatterers:
+            incident = free_space_ir(self.sourcePoints, self.recordingTimes, z, velocity, pulse)
+            green = free_space_ir(self.receiverPoints, self.recordingTimes, z, velocity, impulse)
+            incident = np.fft.rfft(incident, n=N, axis=1)
+            green = np.fft.rfft(green, n=N, axis=1)
+            scattered = np.fft.irfft(green[:, :, None] * incident.T[None, :, :], n=N, axis=1)
+            data += self.dt * scattered[:, :Nt, :]
+
+        return data
+
+
+    def convolution_times(self):
+        T = self.recordingTimes[-1] - self.recordingTimes[0]
+        return np.linspace(-T, T, 2 * len(self.recordingTimes) - 1)
+
+
+    def frequency_window(self, N):
+        # keep the frequencies where the pulse carries energy
+        freqs = np.fft.rfftfreq(N, self.dt)
+        return np.flatnonzero(freqs <= 3 * peakFreq / (2 * np.pi))
+
+
+    def time_kernel(self):
+        return self.data
+
+
+    def time_rhs(self, points):
+        # impulse responses of shape Nr x (2*Nt-1) x K
+        times = self.convolution_times()
+        return np.stack([free_space_ir(self.receiverPoints, times, z, velocity, pulse)
+                         for z in points], axis=2)
+
+
+    def freq_kernel(self):
+        N = nextPow2(2 * len(self.recordingTimes))
+        return np.fft.rfft(self.data, n=N, axis=1)[:, self.frequency_window(N), :]
+
+
+    def freq_rhs(self, points):
+        rhs = self.time_rhs(points)
+        N = nextPow2(2 * len(self.recordingTimes))
+        return np.fft.rfft(rhs, n=N, axis=1)[:, self.frequency_window(N), :]
@@ -0,0 +1,178 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import shutil
+import pickle
+import hashlib
+import textwrap
+import numpy as np
+from pathlib import Path
+
+def fingerprint(settings, *arrays):
+    '''
+    Returns a hash identifying a solve: the solver settings (a dictionary)
+    together with the contents of the input arrays (operator kernel,
+    right-hand sides, focusing times, ...).
+    '''
+    h = hashlib.sha1()
+    h.update(repr(sorted(settings.items())).encode())
+    for array in arrays:
+        if hasattr(array, 'signature'):
+            # arrays kept on disk (see outofcore_utils.KernelStore)
+            h.update(array.signature.encode())
+            continue
+        array = np.ascontiguousarray(array)
+        h.update(str(array.dtype).encode())
+        h.update(str(array.shape).encode())
+        h.update(array.data)
+
+    return h.hexdigest()
+
+
+def atomic_write(filename, write):
+    '''
+    Writes a file by first writing to a temporary file in the same
+    directory and then renaming it, so that an interrupted write never
+    leaves a corrupt file behind.
+
+    write: a function that takes an open binary file object
+    '''
+    tmp = str(filename) + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+#==============================================================================
+# A class for checkpointing chunked solves
+#
+# Each finished chunk of right-hand sides is written to a file of its own
+# (its solution norms and, if checkpointed, its solutions), so the state file
+# rewritten after each chunk stays the same size however far the solve gets.
+#
+# Class data objects:
+#   directory: the checkpoint directory
+#   fingerprint: hash of the solver settings and inputs
+#   save_solutions: whether the solutions themselves are checkpointed
+#   state: for each stage (e.g., focusing time), the number of completed
+#          right-hand sides and the partial image (if it is accumulated
+#          rather than assembled from the solution norms)
+#
+# Class methods:
+#   restore the state of a stage and any saved solutions: restore()
+#   record a completed chunk: update()
+#   remove the checkpoint once the solve is complete: finish()
+#==============================================================================
+class Checkpoint(object):
+
+    def __init__(self, directory, fingerprint, resume=False, save_solutions=False):
+        self.directory = Path(directory)
+        self.fingerprint = fingerprint
+        self.save_solutions = save_solutions
+        self.state = {}
+
+        stateFile = self.directory / 'state.pkl'
+        if resume:
+            if not stateFile.exists():
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: No checkpoint found in \'%s\'. Run without \'--resume\' to
+                        start a new solve.
+                        ''' %(self.directory)))
+
+            saved = pickle.load(open(stateFile, 'rb'))
+            if saved['fingerprint'] != fingerprint:
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: The checkpoint in \'%s\' was written for different inputs or
+                        solver settings. Run without \'--resume\' to start a new solve.
+                        ''' %(self.directory)))
+
+            self.state = saved['state']
+            print('Resuming from checkpoint \'%s\'...' %(self.directory))
+
+        else:
+            if self.directory.exists():
+                shutil.rmtree(self.directory)
+            self.directory.mkdir(parents=True)
+            self.write()
+
+
+    def write(self):
+        atomic_write(self.directory / 'state.pkl',
+                     lambda f : pickle.dump({'fingerprint': self.fingerprint, 'state': self.state},
+                                            f, pickle.HIGHEST_PROTOCOL))
+
+
+    def solution_file(self, stage, start):
+        return self.directory / ('X_%d_%d.npy' %(stage, start))
+
+
+    def norms_file(self, stage, start):
+        return self.directory / ('norms_%d_%d.npy' %(stage, start))
+
+
+    def chunks(self, stage, completed):
+        # first right-hand sides of the chunks recorded before 'completed'
+        # (files of a chunk interrupted before its state was written are
+        # ignored)
+        starts = [int(f.stem.split('_')[-1]) for f in self.directory.glob('norms_%d_*.npy' %(stage))]
+        return sorted(start for start in starts if start < completed)
+
+
+    def restore(self, stage, out=None):
+        '''
+        Returns the number of completed right-hand sides, the partial image
+        (None if it is not accumulated) and the list of solution norms of the
+        completed chunks of a stage (None if the stage has not been started).
+        Saved solutions are copied into 'out'.
+        '''
+        if stage not in self.state:
+            return None
+
+        entry = self.state[stage]
+        completed = entry['completed']
+        norms = []
+        for start in self.chunks(stage, completed):
+            norms.append(np.load(self.norms_file(stage, start)))
+            if self.save_solutions and out is not None:
+                stop = start + norms[-1].shape[-1]
+                out[:, start:stop] = np.load(self.solution_file(stage, start))
+
+        if entry['image'] is None:
+            return completed, None, norms
+        return completed, entry['image'].copy(), norms
+
+
+    def update(self, stage, start, stop, norms, image=None, X=None):
+        '''
+        Records that right-hand sides start, ..., stop-1 of a stage have been
+        solved, along with their solution norms, the partial image (if it is
+        accumulated over chunks) and (if solutions are checkpointed) the
+        solutions themselves.
+        '''
+        atomic_write(self.norms_file(stage, start), lambda f : np.save(f, norms))
+        if self.save_solutions and X is not None:
+            atomic_write(self.solution_file(stage, start), lambda f : np.save(f, X))
+
+        self.state[stage] = {'completed': stop, 'image': None if image is None else image.copy()}
+        self.write()
+
+
+    def finish(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -12,16 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #==============================================================================
+import io
 import os
 import sys
 import numpy as np
 import pickle
 from pathlib import Path
 import textwrap
-from vezda.math_utils import nextPow2
-from vezda.signal_utils import tukey_taper
-from vezda.sampling_utils import samplingIsCurrent, compute_impulse_responses
+from tqdm import trange
+from contextlib import redirect_stderr
+from vezda.math_utils import nextPow2, timeShift, as_precision, complex_dtype
+from vezda.signal_utils import tukey_taper, frequency_window
+from vezda.sampling_utils import (samplingIsCurrent, compute_impulse_responses, get_search_points,
+                                  get_unique_indices, add_reciprocal_data, convolution_times)
 from vezda.plot_utils import default_params
+from vezda.profile_utils import stage, profiled
+from vezda.session_utils import cached
+from vezda.outofcore_utils import KernelStore, store_is_current
+from vezda.trace_utils import SegmentedTraces
 sys.path.append(os.getcwd())
 import pulseFun
 
@@ -33,9 +41,11 @@ if Path('plotParams.pkl').exists():
 else:
     plotParams = default_params()
 
-def load_data(domain, taper=False, verbose=False, skip_fft=False):
+@profiled('load data')
+def load_data(domain, taper=False, verbose=False, skip_fft=False, precision='double'):
     # load the recorded data    
     print('Loading recorded waveforms...')
+    noisy = False
     if Path('noisyData.npz').exists():
         userResponded = False
         print(textwrap.dedent(
@@ -49,29 +59,39 @@ def load_data(domain, taper=False, verbose=False, skip_fft=False):
             answer = input('Action: ')
             if answer == '' or answer == 'y' or answer == 'yes':
                 print('Proceeding with noisy data...')
-                # read in the noisy data array
-                data = np.load('noisyData.npz')['noisyData']
+                noisy = True
                 userResponded = True
             elif answer == 'n' or answer == 'no':
                 print('Proceeding with noise-free data...')
-                # read in the recorded data array
-                data = np.load(str(datadir['recordedData']))
                 userResponded = True
             elif answer == 'q' or answer == 'quit':
                 sys.exit('Exiting program.\n')
             else:
                 print('Invalid response. Please enter \'y/yes\', \'n\no\', or \'q/quit\'.')
-                
-    else:
-        # read in the recorded data array
-        data = np.load(str(datadir['recordedData']))
-        
+    
+    return prepare_data(domain, taper, verbose, skip_fft, noisy, precision)
+
+def load_noisy_data(filename):
+    # read in the noisy data array (or the memory-mapped file holding it,
+    # which is found relative to the directory of 'noisyData.npz')
+    noisyDict = np.load(str(filename))
+    if 'noisyFile' in noisyDict.files:
+        return np.load(str(Path(filename).parent / str(noisyDict['noisyFile'])), mmap_mode='r')
+    return noisyDict['noisyData']
+
+def window_data(data, verbose=False, precision='double'):
+    '''
+    Applies the user-specified windows and source-receiver reciprocity to a
+    data array as recorded (e.g., memory-mapped), returning a new array.
+    '''
     # apply user-specified windows to data array
     rinterval, tinterval, tstep, dt, sinterval = get_user_windows(verbose)
     print('Applying windows to data volume...')
-    data = data[rinterval, :, :]
-    data = data[:, tinterval, :]
-    data = data[:, :, sinterval]
+    with stage('windowing'):
+        data = data[rinterval, :, :]
+        data = data[:, tinterval, :]
+        data = data[:, :, sinterval]
+    data = as_precision(data, precision)
     
     # check if source-receiver reciprocity can be used
     if 'sources' in datadir:
@@ -90,18 +110,41 @@ def load_data(domain, taper=False, verbose=False, skip_fft=False):
             print('Sources and receivers are co-located. Reciprocity adds no value...')
         else:
             print('Adding reciprocal data for %d unique source points...' %(N))
-            newData = data[:, :, indices]
-            newData = np.swapaxes(newData, 0, 2)
-            M = newData.shape[2]
-            npad = ((0, N), (0, 0), (0, M))
-            data = np.pad(data, pad_width=npad, mode='constant', constant_values=0)
-            data[-N:, :, -M:] = newData
+            data = add_reciprocal_data(data, indices)
+    
+    return data
+
+@cached
+def prepare_data(domain, taper=False, verbose=False, skip_fft=False, noisy=False, precision='double',
+                 filename=None):
+    '''
+    Reads the recorded (or noisy) data and applies the user-specified windows,
+    source-receiver reciprocity, the taper and the Fourier transform.
+    
+    precision: 'single' (float32/complex64) or 'double' (float64/complex128)
+    filename: read the recorded data from this file instead (e.g., the data of
+              a baseline survey over the same acquisition geometry), or the
+              noisy data if it is a 'noisyData.npz' file
+    '''
+    if filename is not None and str(filename).endswith('.npz'):
+        data = load_noisy_data(filename)
+    elif filename is not None:
+        data = np.load(str(filename))
+    elif noisy:
+        data = load_noisy_data('noisyData.npz')
+    else:
+        # read in the recorded data array
+        data = np.load(str(datadir['recordedData']))
+        
+    data = window_data(data, verbose, precision)
+    tstep, dt = get_user_windows()[2:4]
     
     if taper:
         # Apply tapered cosine (Tukey) window to time signals.
         # This ensures that any fast Fourier transforms (FFTs) used
         # will be acting on a function that is continuous at its edges.
-        data = tukey_taper(data, tstep * dt, pulseFun.peakFreq)
+        with stage('taper'):
+            data = tukey_taper(data, tstep * dt, pulseFun.peakFreq)
     
     if domain == 'freq' and not skip_fft:
         print('Transforming data to the frequency domain...')
@@ -109,7 +152,21 @@ def load_data(domain, taper=False, verbose=False, skip_fft=False):
         
     return data
 
-def load_impulse_responses(domain, medium, verbose=False, return_search_points=False, skip_fft=False):
+@profiled('load impulse responses')
+@cached
+def load_impulse_responses(domain, medium, verbose=False, return_search_points=False, skip_fft=False, tau=None,
+                           precision='double', compact=False):
+    '''
+    Loads or computes the impulse responses for the active search points.
+    
+    tau: the focusing time. If None, the focusing time of the search grid is
+         used (the first one if a list of focusing times was specified).
+    precision: 'single' (float32/complex64) or 'double' (float64/complex128).
+         Impulse responses saved in single precision are recomputed if double
+         precision is requested.
+    compact: if True, time-domain impulse responses are returned as
+         SegmentedTraces (see trace_utils) instead of a dense array.
+    '''
     # load user-specified windows
     rinterval, tinterval, tstep, dt = get_user_windows(verbose, skip_sources=True)
     
@@ -121,17 +178,13 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
     recordingTimes = recordingTimes[tinterval]
         
     # load/compute the impulse responses and search points
+    searchGrid = load_search_grid()
     if 'impulseResponses' in datadir:
         impulseResponses = np.load(str(datadir['impulseResponses']))
-        searchGrid = np.load(str(datadir['searchGrid']))
         loadVZImpulseResponses = False
     
     else:
-        try:
-            searchGrid = np.load('searchGrid.npz')
-            loadVZImpulseResponses = True
-        except FileNotFoundError:
-            searchGrid = None
+        loadVZImpulseResponses = True
         
         if searchGrid is None:
             sys.exit(textwrap.dedent(
@@ -146,28 +199,13 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
                     search grid.
                     '''))        
             
-    x = searchGrid['x']
-    y = searchGrid['y']
-    Nx, Ny = len(x), len(y)
-    tau = searchGrid['tau']
-    if 'z' in searchGrid:
-        z = searchGrid['z']
-        Nz = len(z)
-        searchPoints = np.vstack(np.meshgrid(x, y, z, indexing='ij')).reshape(3, Nx * Ny * Nz).T
-    else:
-        searchPoints = np.vstack(np.meshgrid(x, y, indexing='ij')).reshape(2, Nx * Ny).T
+    if tau is None:
+        tau = np.atleast_1d(searchGrid['tau'])[0]
+    # only the active search points (region of interest) are used
+    searchPoints = get_search_points(searchGrid)[0]
             
     if loadVZImpulseResponses:
-        # check if source-receiver reciprocity can be used
-        if 'sources' in datadir:
-            sinterval = get_user_windows()[-1]
-            
-            sourcePoints = np.load(str(datadir['sources']))
-            sourcePoints = sourcePoints[sinterval, :]
-            
-            indices = get_unique_indices(sourcePoints, receiverPoints)
-            if len(indices) > 0:
-                receiverPoints = np.vstack((receiverPoints, sourcePoints[indices, :]))
+        receiverPoints, convolutionTimes = get_impulse_response_geometry(receiverPoints, recordingTimes)
         
         pulse = lambda t : pulseFun.pulse(t)
         velocity = pulseFun.velocity
@@ -175,17 +213,20 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
         peakTime = pulseFun.peakTime
             
         tu = plotParams['tu']
-        # set up the convolution times based on length of recording time interval
-        T = recordingTimes[-1] - recordingTimes[0]
-        convolutionTimes = np.linspace(-T, T, 2 * len(recordingTimes) - 1)
         
         if Path('VZImpulseResponses.npz').exists():
             print('Detected that impulse responses have already been computed...')
             print('Checking consistency with current search grid, focusing time, and pulse function...')
             IRDict = np.load('VZImpulseResponses.npz')
                 
-            if samplingIsCurrent(IRDict, receiverPoints, convolutionTimes, searchPoints, tau, velocity, peakFreq, peakTime):
-                impulseResponses = IRDict['IRarray']
+            if precision == 'double' and saved_impulse_response_dtype(IRDict) == np.float32:
+                print('Impulse responses were saved in single precision...')
+                isCurrent = False
+            else:
+                isCurrent = samplingIsCurrent(IRDict, receiverPoints, convolutionTimes, searchPoints, tau,
+                                              velocity, peakFreq, peakTime)
+            if isCurrent:
+                impulseResponses = read_impulse_responses(IRDict)
                 print('Impulse responses are up to date...')
                     
             else:
@@ -195,15 +236,16 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
                     else:
                         print('Recomputing impulse responses for current search grid and focusing time %0.2f...' %(tau))
                     impulseResponses = compute_impulse_responses(medium, receiverPoints, convolutionTimes - tau,
-                                                                 searchPoints, velocity, pulse)
+                                                                 searchPoints, velocity, pulse, precision)
                 else:
                     print('Recomputing impulse responses for current search grid...')
                     impulseResponses = compute_impulse_responses(medium, receiverPoints, convolutionTimes,
-                                                                 searchPoints, velocity, pulse)
+                                                                 searchPoints, velocity, pulse, precision)
                     
-                np.savez('VZImpulseResponses.npz', IRarray=impulseResponses, time=convolutionTimes, receivers=receiverPoints,
-                         peakFreq=peakFreq, peakTime=peakTime, velocity=velocity,
-                         searchPoints=searchPoints, tau=tau)
+                impulseResponses = save_impulse_responses(impulseResponses, time=convolutionTimes,
+                                                          receivers=receiverPoints, peakFreq=peakFreq,
+                                                          peakTime=peakTime, velocity=velocity,
+                                                          searchPoints=searchPoints, tau=tau)
                     
         else:                
             if tau != 0.0:
@@ -212,19 +254,29 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
                 else:
                     print('Computing impulse responses for current search grid and focusing time %0.2f...' %(tau))
                 impulseResponses = compute_impulse_responses(medium, receiverPoints, convolutionTimes - tau,
-                                                             searchPoints, velocity, pulse)
+                                                             searchPoints, velocity, pulse, precision)
             else:
                 print('Computing impulse responses for current search grid...')
                 impulseResponses = compute_impulse_responses(medium, receiverPoints, convolutionTimes,
-                                                             searchPoints, velocity, pulse)
+                                                             searchPoints, velocity, pulse, precision)
                     
-            np.savez('VZImpulseResponses.npz', IRarray=impulseResponses, time=convolutionTimes, receivers=receiverPoints,
-                     peakFreq=peakFreq, peakTime=peakTime, velocity=velocity,
-                     searchPoints=searchPoints, tau=tau)
+            impulseResponses = save_impulse_responses(impulseResponses, time=convolutionTimes,
+                                                      receivers=receiverPoints, peakFreq=peakFreq,
+                                                      peakTime=peakTime, velocity=velocity,
+                                                      searchPoints=searchPoints, tau=tau)
         
-    if domain == 'freq' and not skip_fft:
-        print('Transforming impulse responses to the frequency domain...')
-        impulseResponses = fft_and_window(impulseResponses, tstep * dt, double_length=False)
+    if compact and domain == 'time':
+        if not isinstance(impulseResponses, SegmentedTraces):
+            impulseResponses = SegmentedTraces.from_dense(impulseResponses)
+        impulseResponses = impulseResponses.astype(np.float32 if precision == 'single' else np.float64,
+                                                   copy=False)
+    else:
+        if isinstance(impulseResponses, SegmentedTraces):
+            impulseResponses = impulseResponses.densify()
+        impulseResponses = as_precision(impulseResponses, precision)
+        if domain == 'freq' and not skip_fft:
+            print('Transforming impulse responses to the frequency domain...')
+            impulseResponses = fft_and_window(impulseResponses, tstep * dt, double_length=False)
     
     if return_search_points:
         return impulseResponses, searchPoints
@@ -233,6 +285,182 @@ def load_impulse_responses(domain, medium, verbose=False, return_search_points=F
         return impulseResponses
         
 
+def save_impulse_responses(impulseResponses, **meta):
+    '''
+    Saves computed impulse responses to 'VZImpulseResponses.npz' as segments
+    of their support (see trace_utils.SegmentedTraces), together with the
+    metadata checked by samplingIsCurrent. Returns the SegmentedTraces.
+    '''
+    traces = SegmentedTraces.from_dense(impulseResponses)
+    np.savez('VZImpulseResponses.npz', **traces.to_dict(), **meta)
+    return traces
+
+
+def read_impulse_responses(IRDict):
+    # impulse responses saved by earlier versions are dense ('IRarray')
+    if 'IRarray' in IRDict.files:
+        return IRDict['IRarray']
+    return SegmentedTraces.from_dict(IRDict)
+
+
+def saved_impulse_response_dtype(IRDict):
+    if 'IRarray' in IRDict.files:
+        return IRDict['IRarray'].dtype
+    return IRDict['IRsegments'].dtype
+
+
+@profiled('impulse response store')
+def impulse_response_store(domain, medium, tau=None, precision='double', name='VZImpulseResponseStore'):
+    '''
+    Returns a KernelStore (see outofcore_utils) holding the impulse responses
+    of the active search points in the given domain, for solving the
+    Lippmann-Schwinger equation out of core. The impulse responses are
+    computed (or read from the data directory) block by block of search
+    points and written straight to disk, so they are never held in memory
+    all at once. A stored kernel that is consistent with the current inputs
+    is reused.
+    
+    tau: the focusing time (default is the first one of the search grid)
+    '''
+    rinterval, tinterval, tstep, dt = get_user_windows(skip_sources=True)
+    receiverPoints = np.load(str(datadir['receivers']))[rinterval, :]
+    recordingTimes = np.load(str(datadir['recordingTimes']))[tinterval]
+    receiverPoints, convolutionTimes = get_impulse_response_geometry(receiverPoints, recordingTimes)
+    
+    searchGrid = load_search_grid()
+    if 'impulseResponses' in datadir:
+        supplied = np.load(str(datadir['impulseResponses']), mmap_mode='r')
+        searchPoints = None
+    else:
+        supplied = None
+        if searchGrid is None:
+            sys.exit(textwrap.dedent(
+                    '''
+                    A search grid needs to be set up before impulse responses can
+                    be computed or loaded.
+                    '''))
+        if medium != 'constant':
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Out-of-core impulse responses for a variable medium must be
+                    provided in the data directory (see \'vzdata\').
+                    '''))
+        searchPoints = get_search_points(searchGrid)[0]
+    if tau is None:
+        tau = np.atleast_1d(searchGrid['tau'])[0] if searchGrid is not None else 0.0
+    
+    dtype = np.float32 if precision == 'single' else np.float64
+    if domain == 'freq':
+        dtype = complex_dtype(dtype)
+        frequencies = get_frequency_window(nextPow2(len(convolutionTimes)), tstep * dt, verbose=False)
+    else:
+        frequencies = np.array([], dtype=int)
+    meta = {'receivers': receiverPoints, 'time': convolutionTimes, 'tau': tau,
+            'searchPoints': searchPoints if searchPoints is not None else np.array([]),
+            'velocity': pulseFun.velocity, 'peakFreq': pulseFun.peakFreq, 'peakTime': pulseFun.peakTime,
+            'frequencies': frequencies}
+    
+    opened = KernelStore.open(name)
+    if opened is not None and supplied is None:
+        print('Detected a stored kernel of impulse responses...')
+        store, stored = opened
+        if (store_is_current(stored, domain, dtype, frequencies) and
+            samplingIsCurrent(stored, receiverPoints, convolutionTimes, searchPoints, tau,
+                              pulseFun.velocity, pulseFun.peakFreq, pulseFun.peakTime)):
+            print('Stored impulse responses are up to date...')
+            return store
+    
+    K = supplied.shape[2] if supplied is not None else searchPoints.shape[0]
+    Nm = len(frequencies) if domain == 'freq' else len(convolutionTimes)
+    store = KernelStore.create(name, domain, (receiverPoints.shape[0], Nm, K), dtype)
+    print('Writing impulse responses to \'%s.npy\' in blocks of %d search points...' %(name, store.blockSize))
+    for start in trange(0, K, store.blockSize):
+        stop = min(start + store.blockSize, K)
+        if supplied is not None:
+            block = as_precision(supplied[:, :, start:stop], precision)
+        else:
+            with redirect_stderr(io.StringIO()):
+                block = compute_impulse_responses(medium, receiverPoints, convolutionTimes - tau,
+                                                  searchPoints[start:stop, :], pulseFun.velocity,
+                                                  lambda t : pulseFun.pulse(t), precision)
+        if domain == 'freq':
+            block = np.fft.rfft(block, n=nextPow2(block.shape[1]), axis=1)[:, frequencies, :]
+        store.write(start, block)
+    store.finish(**meta)
+    
+    return store
+
+
+def load_search_grid():
+    '''
+    Returns the search grid dictionary. A search grid provided in the data
+    directory takes precedence over one set up with \'vzgrid\'. Returns None
+    if no search grid exists.
+    '''
+    if 'searchGrid' in datadir:
+        return np.load(str(datadir['searchGrid']))
+    
+    try:
+        return np.load('searchGrid.npz')
+    except FileNotFoundError:
+        return None
+
+
+def get_impulse_response_geometry(receiverPoints, recordingTimes):
+    '''
+    Returns the receiver points (augmented with any reciprocal receivers) and
+    the convolution times at which the impulse responses are evaluated.
+    
+    receiverPoints: windowed receiver coordinates
+    recordingTimes: windowed recording times
+    '''
+    # check if source-receiver reciprocity can be used
+    if 'sources' in datadir:
+        sinterval = get_user_windows()[-1]
+        
+        sourcePoints = np.load(str(datadir['sources']))
+        sourcePoints = sourcePoints[sinterval, :]
+        
+        indices = get_unique_indices(sourcePoints, receiverPoints)
+        if len(indices) > 0:
+            receiverPoints = np.vstack((receiverPoints, sourcePoints[indices, :]))
+    
+    return receiverPoints, convolution_times(recordingTimes)
+
+
+def compute_impulse_responses_at(searchPoints, domain, medium, precision='double'):
+    '''
+    Computes the impulse responses for an arbitrary set of search points using
+    the current windows, focusing time and pulse function. Unlike
+    load_impulse_responses, the result is neither cached nor checked against
+    'VZImpulseResponses.npz'. This is used when only a subset of the search
+    grid needs to be evaluated (e.g., adaptive grid refinement).
+    
+    searchPoints: an array of search points in 2D or 3D space
+    '''
+    if 'impulseResponses' in datadir:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Impulse responses were provided in the data directory and cannot
+                be evaluated at new search points.
+                '''))
+    
+    rinterval, tinterval, tstep, dt = get_user_windows(skip_sources=True)
+    receiverPoints = np.load(str(datadir['receivers']))[rinterval, :]
+    recordingTimes = np.load(str(datadir['recordingTimes']))[tinterval]
+    receiverPoints, convolutionTimes = get_impulse_response_geometry(receiverPoints, recordingTimes)
+    
+    tau = np.atleast_1d(load_search_grid()['tau'])[0]
+    impulseResponses = compute_impulse_responses(medium, receiverPoints, convolutionTimes - tau,
+                                                 searchPoints, pulseFun.velocity,
+                                                 lambda t : pulseFun.pulse(t), precision)
+    
+    if domain == 'freq':
+        impulseResponses = fft_and_window(impulseResponses, tstep * dt, double_length=False)
+    
+    return impulseResponses
+        
+
 def get_user_windows(verbose=False, skip_sources=False):
     recordingTimes = np.load(str(datadir['recordingTimes']))
     dt = recordingTimes[1] - recordingTimes[0]
@@ -329,44 +557,65 @@ def get_user_windows(verbose=False, skip_sources=False):
 #==============================================================================
 def fft_and_window(X, dt, double_length):
     # Transform X into the frequency domain and apply window around nonzero
-    # frequency components
-    
+    # frequency components. The transform has the precision of X.
+    dtype = complex_dtype(X.dtype)
     if double_length:
         N = nextPow2(2 * X.shape[1])
     else:
         N = nextPow2(X.shape[1])
-    X = np.fft.rfft(X, n=N, axis=1)
+    with stage('fft'):
+        X = np.fft.rfft(X, n=N, axis=1)
+    
+    # Apply the frequency window
+    finterval = get_frequency_window(N, dt)
+    with stage('windowing'):
+        X = X[:, finterval, :].astype(dtype, copy=False)
     
+    return X
+
+
+def get_frequency_window(N, dt, verbose=True):
+    '''
+    Returns the indices of the rfft frequency bins (for a transform of length N
+    and sampling interval dt) that lie inside the user-specified frequency window,
+    restricted to the selected frequencies if a selection was made (see
+    'vezda frequencies').
+    '''
     if plotParams['fmax'] is None:
         freqs = np.fft.rfftfreq(N, dt)
         plotParams['fmax'] = np.max(freqs)
         pickle.dump(plotParams, open('plotParams.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
     
-    # Apply the frequency window
     fmin = plotParams['fmin']
     fmax = plotParams['fmax']
     fu = plotParams['fu']   # frequency units (e.g., Hz)
+    frequencies = plotParams.get('frequencies')
     
-    if fu != '':
-        print('Applying frequency window: [%0.2f %s, %0.2f %s]' %(fmin, fu, fmax, fu))
-    else:
-        print('Applying frequency window: [%0.2f, %0.2f]' %(fmin, fmax))
-        
-    df = 1.0 / (N * dt)
-    startIndex = int(round(fmin / df))
-    stopIndex = int(round(fmax / df))
+    if verbose:
+        if fu != '':
+            print('Applying frequency window: [%0.2f %s, %0.2f %s]' %(fmin, fu, fmax, fu))
+        else:
+            print('Applying frequency window: [%0.2f, %0.2f]' %(fmin, fmax))
+        if frequencies is not None:
+            print('Keeping %d selected frequencies...' %(len(frequencies)))
         
-    finterval = np.arange(startIndex, stopIndex, 1)
-    X = X[:, finterval, :]
-    
-    return X
+    return frequency_window(N, dt, fmin, fmax, frequencies)
+
 
 #==============================================================================
-def get_unique_indices(coordinates1, coordinates2):    
-    N = coordinates1.shape[0]
-    unique_indices = []
-    for n in range(N):
-        if (coordinates1[n, :] != coordinates2).any(axis=1).all():
-            unique_indices.append(n)
+def shift_impulse_responses(impulseResponses, tau, domain):
+    '''
+    Shifts time-domain impulse responses (as returned by load_impulse_responses
+    with domain='time') by the focusing time tau without recomputing them. The
+    shift is applied in the frequency domain by the phase e^(-i * omega * tau).
+    If domain='freq', the shifted impulse responses are returned in the
+    frequency domain.
+    '''
+    rinterval, tinterval, tstep, dt = get_user_windows(skip_sources=True)
+    if tau != 0.0:
+        impulseResponses = timeShift(impulseResponses, tau, tstep * dt)
+    
+    if domain == 'freq':
+        impulseResponses = fft_and_window(impulseResponses, tstep * dt, double_length=False)
         
-    return unique_indices
\ No newline at end of file
+    return impulseResponses
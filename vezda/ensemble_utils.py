@@ -0,0 +1,239 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import io
+import os
+import sys
+import time
+import textwrap
+import numpy as np
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.linalg import norm
+from vezda.math_utils import humanReadable, nextPow2
+from vezda.signal_utils import add_noise, tukey_taper, fft_window
+from vezda.sweep_utils import share, attach, parse_values
+from vezda.LinearSamplingClass import LinearSamplingProblem
+
+def solve_realizations(tasks, inputs, settings):
+    '''
+    Solves the noise realizations of a list of tasks. Runs in a worker process
+    and returns (snr index, realization, image) for each task.
+
+    tasks: list of (snr index, realization, snr, seed). The noise-free
+           reference has snr None.
+    inputs: shared-memory descriptor of the impulse responses (transformed to
+            the domain of the solve)
+    settings: dictionary with the equation, domain, file of the recorded data
+              and its time step, time step dt of the windowed data, noise
+              band, frequency window, method, regularization parameter and
+              tolerances
+
+    For the Lippmann-Schwinger equation the impulse responses form the
+    operator and the (noisy) data are the right-hand sides, so one operator
+    (and any factorization of it) is used for all tasks of the worker. For the
+    near-field equation the noisy data form the operator, which is built for
+    each realization against the shared right-hand sides.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda.data_utils import window_data
+
+    memory, impulseResponses = attach(inputs['impulseResponses'])
+    try:
+        impulseResponses = np.array(impulseResponses)
+    finally:
+        memory.close()
+    # (the recorded data are memory-mapped by each worker)
+    recordedData = np.load(settings['recordedData'], mmap_mode='r')
+
+    dt = settings['dt']
+    def prepare(snr, seed):
+        # noise is added to the recordings as by vznoise (over the full record),
+        # then the windows, reciprocity, taper and transform of vzsolve are applied
+        if snr is not None:
+            X = add_noise(recordedData, settings['rawDt'], settings['bmin'], settings['bmax'], snr, seed)
+            X = window_data(X)
+        else:
+            X = window_data(recordedData)
+        # (the taper is applied in place)
+        X = tukey_taper(X, dt, settings['peakFreq'])
+        if settings['domain'] == 'freq':
+            X = fft_window(X, dt, settings['fmin'], settings['fmax'], double_length=True,
+                           frequencies=settings['frequencies'])
+        elif settings['equation'] == 'lse':
+            # pad data to the length of the circular convolution (see Solve.py)
+            X = np.pad(X, ((0, 0), (X.shape[1] - 1, 0), (0, 0)), mode='constant')
+        return X
+
+    results = []
+    p = None
+    # (progress output of the solvers is discarded)
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        for i, r, snr, seed in tasks:
+            if settings['equation'] == 'nfe':
+                p = LinearSamplingProblem('nfo', prepare(snr, seed), impulseResponses)
+            elif p is None:
+                p = LinearSamplingProblem('lso', impulseResponses, prepare(snr, seed))
+            else:
+                p.B = prepare(snr, seed)
+            X = p.solve(settings['method'], False, 1, settings['alpha'], settings['atol'], settings['btol'])
+            results.append((i, r, p.construct_image(X)))
+
+    return results
+
+
+def ensemble_statistics(images, percentiles):
+    '''
+    Returns the mean, variance and percentile images of an ensemble of images
+    (SNRs x realizations x search points). The percentile images are stacked
+    as SNRs x percentiles x search points.
+    '''
+    ddof = 1 if images.shape[1] > 1 else 0
+    Mean = np.mean(images, axis=1)
+    Variance = np.var(images, axis=1, ddof=ddof)
+    Percentiles = np.moveaxis(np.percentile(images, percentiles, axis=1), 0, 1)
+    return Mean, Variance, Percentiles
+
+
+def run_ensemble(args):
+    '''
+    Runs a Monte Carlo noise ensemble as specified by the command-line
+    arguments of 'vezda ensemble': the recorded data are imaged with
+    'args.realizations' seeded realizations of band-limited noise at each
+    signal-to-noise ratio, in parallel, and the mean, variance and percentile
+    images of each ensemble are saved to a single results file.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda import data_utils
+    from vezda.data_utils import (load_impulse_responses, load_search_grid, get_user_windows,
+                                  get_frequency_window)
+    from vezda.sampling_utils import get_search_points, scatter_to_grid
+
+    equation = 'lse' if args.lse else 'nfe'
+    snrs = parse_values(args.snr, float, 'snr')
+    percentiles = parse_values(args.percentiles, float, 'percentiles')
+    if min(snrs) <= 0 or args.realizations < 1 or args.alpha < 0:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The signal-to-noise ratios must be positive, the number of realizations
+                a positive integer and the regularization parameter nonnegative.
+                '''))
+    if min(percentiles) < 0 or max(percentiles) > 100:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Percentiles must lie between 0 and 100.
+                '''))
+    if args.method == 'direct' and args.domain == 'time':
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The direct method is only available in the frequency domain.
+                '''))
+
+    #==========================================================================
+    # the impulse responses are loaded (or computed) once
+    impulseResponses, searchPoints = load_impulse_responses(args.domain, args.medium, return_search_points=True)
+    if args.ngs and equation == 'nfe':
+        print('Normalizing impulse responses by their energy...')
+        impulseResponses = impulseResponses / norm(impulseResponses, axis=(0, 1))[None, None, :]
+    rinterval, tinterval, tstep, rawDt = get_user_windows(verbose=True, skip_sources=True)
+    dt = tstep * rawDt
+
+    # frequency window of the solve (see 'vzspectra') and band of the noise
+    get_frequency_window(nextPow2(2 * len(tinterval)), dt, verbose=False)
+    plotParams = data_utils.plotParams
+    if args.band is not None:
+        bmin, bmax = parse_values(args.band.replace(':', ','), float, 'band')
+    else:
+        bmin, bmax = plotParams['fmin'], plotParams['fmax']
+    if bmax < bmin:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The maximum frequency of the noise band must be greater than or
+                equal to the minimum frequency.
+                '''))
+    elif bmin <= 0:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The minimum frequency of the noise band must be strictly positive
+                (as for \'vznoise\'). Specify the band with \'--band=fmin:fmax\'.
+                '''))
+    settings = {'equation': equation, 'domain': args.domain, 'dt': dt, 'bmin': bmin, 'bmax': bmax,
+                'recordedData': str(data_utils.datadir['recordedData']), 'rawDt': rawDt,
+                'fmin': plotParams['fmin'], 'fmax': plotParams['fmax'],
+                'frequencies': plotParams.get('frequencies'), 'peakFreq': data_utils.pulseFun.peakFreq,
+                'method': args.method, 'alpha': args.alpha, 'atol': args.atol, 'btol': args.btol}
+
+    # one independent stream of random numbers per realization
+    seed = args.seed if args.seed is not None else int(np.random.default_rng().integers(2**63 - 1))
+    streams = iter(np.random.SeedSequence(seed).spawn(len(snrs) * args.realizations))
+    tasks = [(-1, 0, None, None)]
+    for i, snr in enumerate(snrs):
+        tasks += [(i, r, snr, next(streams)) for r in range(args.realizations)]
+
+    # contiguous chunks, so that a worker reuses the Lippmann-Schwinger operator
+    jobs = args.jobs or os.cpu_count() or 1
+    chunks = np.array_split(np.arange(len(tasks)), min(jobs, len(tasks)))
+    print('Solving %d noise realizations at %d signal-to-noise ratios (seed %d)...'
+          %(args.realizations, len(snrs), seed))
+
+    Images = np.zeros((len(snrs), args.realizations, searchPoints.shape[0]))
+    Reference = None
+    memories = []
+    startTime = time.time()
+    try:
+        inputs = {}
+        memory, inputs['impulseResponses'] = share(impulseResponses)
+        memories.append(memory)
+        del impulseResponses
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(solve_realizations, [tasks[t] for t in chunk], inputs, settings)
+                       for chunk in chunks]
+            for done, future in enumerate(as_completed(futures)):
+                for i, r, image in future.result():
+                    if i < 0:
+                        Reference = image
+                    else:
+                        Images[i, r] = image
+                print('Completed %d of %d chunks of realizations...' %(done + 1, len(chunks)))
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    print('Elapsed time:', humanReadable(time.time() - startTime))
+
+    #==========================================================================
+    Mean, Variance, Percentiles = ensemble_statistics(Images, percentiles)
+
+    # how often the image peaks where the noise-free image does
+    peakAgreement = np.mean(np.argmax(Images, axis=2) == np.argmax(Reference), axis=1)
+    eps = np.finfo(float).eps
+    meanError = norm(Mean - Reference[None, :], axis=1) / (norm(Reference) + eps)
+
+    mask = get_search_points(load_search_grid())[1]
+    saveArgs = {}
+    if mask is not None:
+        saveArgs['mask'] = mask
+        Reference, Mean, Variance, Percentiles = [scatter_to_grid(X, mask) for X in
+                                                  [Reference, Mean, Variance, Percentiles]]
+    np.savez(args.output, Reference=Reference, Mean=Mean, Variance=Variance, Percentiles=Percentiles,
+             snr=snrs, percentiles=percentiles, realizations=args.realizations, seed=seed,
+             band=[bmin, bmax], alpha=args.alpha, method=args.method, equation=equation,
+             domain=args.domain, peak_agreement=peakAgreement, mean_error=meanError, **saveArgs)
+
+    print('\n%10s %14s %14s %14s' %('snr', 'peak agreement', 'mean error', 'max variance'))
+    for i, snr in enumerate(snrs):
+        print('%10.4g %13.1f%% %14.4g %14.4g' %(snr, 100 * peakAgreement[i], meanError[i],
+                                                 np.nanmax(Variance[i])))
+    print('\nResults saved to \'%s\'.' %(args.output))
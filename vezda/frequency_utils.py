@@ -0,0 +1,128 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import sys
+import pickle
+import textwrap
+import numpy as np
+from scipy.linalg import norm
+from vezda.math_utils import nextPow2
+from vezda.signal_utils import select_frequencies
+
+def selection_fidelity(survey, frequencies, alpha=0.0):
+    '''
+    Images the near-field equation of a Survey (direct solver) with all the
+    frequencies of its window and with the selected frequencies only, and
+    returns a report (dictionary) of the accuracy of the image of the
+    selection relative to the full one:
+
+        image_error: relative error of the image (2-norm)
+        image_max_error: largest error of the image relative to its maximum
+        peak_distance: distance between the search points at which the two
+                       images peak (zero if they peak at the same point)
+    '''
+    windows = dict(survey.windows)
+    images = []
+    for selection in [None, frequencies]:
+        survey.window(**dict(windows, frequencies=selection))
+        X = survey.solve('nfe', 'direct', alpha)
+        images.append(survey.operator('nfe').construct_image(X))
+    Ifull, Isel = images
+
+    eps = np.finfo(float).eps
+    peaks = survey.searchPoints[[np.argmax(Isel), np.argmax(Ifull)], :]
+    return {'image_error': norm(Isel - Ifull) / (norm(Ifull) + eps),
+            'image_max_error': np.max(np.abs(Isel - Ifull)) / (np.max(np.abs(Ifull)) + eps),
+            'peak_distance': norm(peaks[0] - peaks[1])}
+
+
+def print_selection_report(report):
+    print('\nFrequency selection:\n')
+    print('    frequencies kept:                %d of %d' %(report['selected'], report['window']))
+    print('    energy kept:                     %0.2f%%' %(100 * report['energy_kept']))
+    if 'image_error' in report:
+        print('    relative error of the image:     %0.2e' %(report['image_error']))
+        print('    maximum error of the image:      %0.2e (relative to its peak)' %(report['image_max_error']))
+        if report['peak_distance'] == 0:
+            print('    image peak:                      same search point')
+        else:
+            print('    image peak:                      moved by %0.4g' %(report['peak_distance']))
+    print('')
+
+
+def run_frequency_selection(args):
+    '''
+    Selects a subset of the frequencies of the frequency window as specified
+    by the command-line arguments of 'vezda frequencies'. The selected
+    frequencies are kept with the plot parameters (like the frequency window),
+    so that the data, impulse responses and images of later solves use them
+    consistently, and saved with a report of the image fidelity to
+    'frequencySelection.npz'.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda import data_utils
+    from vezda.data_utils import load_data, get_user_windows, get_frequency_window, load_search_grid
+
+    if args.clear:
+        data_utils.plotParams['frequencies'] = None
+        pickle.dump(data_utils.plotParams, open('plotParams.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+        print('Cleared the selection of frequencies...')
+        return
+
+    if args.step < 1 or (args.count is not None and args.count < 1) or \
+       (args.energy is not None and not 0.0 < args.energy <= 1.0):
+        sys.exit(textwrap.dedent(
+                '''
+                Error: \'--step\' and \'--count\' must be positive integers and \'--energy\'
+                a fraction in (0, 1].
+                '''))
+    if args.step == 1 and args.count is None and args.energy is None:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Specify how to select frequencies with \'--step\', \'--energy\' and/or
+                \'--count\' (or use \'--clear\' to remove a selection).
+                '''))
+
+    # the selection is made from all frequencies of the window
+    data_utils.plotParams['frequencies'] = None
+    data = load_data('freq', taper=True, verbose=True)
+    tinterval, tstep, dt = get_user_windows()[1:4]
+    N = nextPow2(2 * len(tinterval))
+    finterval = get_frequency_window(N, tstep * dt, verbose=False)
+    freqs = np.fft.rfftfreq(N, tstep * dt)[finterval]
+
+    # energy of each frequency block (sum of its squared singular values)
+    energy = np.sum(np.abs(data)**2, axis=(0, 2))
+    del data
+    indices = select_frequencies(energy, args.step, args.energy, args.count)
+    frequencies = freqs[indices]
+
+    report = {'window': len(freqs), 'selected': len(indices),
+              'energy_kept': np.sum(energy[indices]) / np.sum(energy)}
+    if load_search_grid() is not None:
+        from vezda.SurveyClass import Survey
+        print('Comparing the image of the selected frequencies with that of the full window...')
+        try:
+            report.update(selection_fidelity(Survey.load(), frequencies, args.alpha))
+        except (ValueError, RuntimeError) as err:
+            sys.exit('Error: %s' %(err))
+    else:
+        print('No search grid is set up: the image fidelity is not reported...')
+    print_selection_report(report)
+
+    data_utils.plotParams['frequencies'] = frequencies
+    pickle.dump(data_utils.plotParams, open('plotParams.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+    np.savez('frequencySelection.npz', frequencies=frequencies, bins=finterval[indices],
+             energy=energy, **report)
+    print('Selected frequencies saved to \'plotParams.pkl\' and \'frequencySelection.npz\'.')
@@ -1,8 +1,17 @@
 import os
+import sys
+import argparse
 import pkg_resources  # part of setuptools
 import textwrap
 import vezda
 from datetime import datetime
+from vezda.profile_utils import add_profile_arguments, enable_profiling
+from vezda import session_utils
+from vezda.pipeline_utils import run_pipeline
+from vezda.sweep_utils import run_sweep
+from vezda.watch_utils import run_watch
+from vezda.frequency_utils import run_frequency_selection
+from vezda.ensemble_utils import run_ensemble
 #from vezda.plot_utils import FontColor
 #from vezda import (setDataPath, setWindow, plotWiggles, plotImage, setSamplingGrid,
 #                   plotSpectra, SVD, Solve, addNoise)
@@ -15,6 +24,175 @@ from datetime import datetime
     
 
 def cli():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    serveParser = subparsers.add_parser('serve',
+                                        help='''Start a resident session server. While it runs, 'vzsolve'
+                                        is run inside the server, which keeps the loaded data, impulse
+                                        responses and SVDs in memory between invocations. Only 'vzsolve' is
+                                        run in the server: the plotting commands (including 'vzsvd' and
+                                        'vzpicard', which display the SVD saved by 'vzsolve') are
+                                        interactive and run as usual.''')
+    group = serveParser.add_mutually_exclusive_group()
+    group.add_argument('--stop', action='store_true',
+                       help='Stop the running session server.')
+    group.add_argument('--status', action='store_true',
+                       help='Show the status of the running session server.')
+    runParser = subparsers.add_parser('run',
+                                      help='''Run the stages declared in a pipeline file without prompting,
+                                      skipping the stages whose inputs are unchanged since their last run.''')
+    runParser.add_argument('pipeline', type=str,
+                           help='Specify the pipeline file (TOML format).')
+    runParser.add_argument('--jobs', '-j', type=int, default=None,
+                           help='''Specify the maximum number of stages run concurrently. Default is the
+                           \'jobs\' setting of the pipeline file or the number of processors.''')
+    runParser.add_argument('--force', action='store_true',
+                           help='Run every stage, even if its inputs are unchanged.')
+    runParser.add_argument('--dry-run', action='store_true',
+                           help='List the stages that would run without running them.')
+    sweepParser = subparsers.add_parser('sweep',
+                                        help='''Solve for every combination of a grid of parameters on a
+                                        process pool. Configurations that share an operator are solved
+                                        together, reusing the operator and any factorization of it.''')
+    sweepParser.add_argument('--nfe', action='store_true',
+                             help='Solve the near-field equation (NFE). (Default)')
+    sweepParser.add_argument('--lse', action='store_true',
+                             help='Solve the Lippmann-Schwinger equation (LSE).')
+    sweepParser.add_argument('--alpha', '--regPar', type=str, default='0',
+                             help='Specify a comma-separated list of regularization parameters. Default is 0.')
+    sweepParser.add_argument('--tau', type=str, default=None,
+                             help='''Specify a comma-separated list of focusing times. Default is the (first)
+                             focusing time of the search grid.''')
+    sweepParser.add_argument('--band', type=str, default=None,
+                             help='''Specify a comma-separated list of frequency windows fmin:fmax (e.g.,
+                             \'0:1.5,0.5:1.5\'). Default is the frequency window set with \'vzspectra\'.''')
+    sweepParser.add_argument('--rstep', type=str, default='1',
+                             help='''Specify a comma-separated list of receiver decimation steps (applied to
+                             the windowed receivers). Default is 1.''')
+    sweepParser.add_argument('--sstep', type=str, default='1',
+                             help='''Specify a comma-separated list of source decimation steps (applied to
+                             the windowed sources). Default is 1.''')
+    sweepParser.add_argument('--method', '-m', type=str, default='lsmr',
+                             help='''Specify a comma-separated list of methods (lsmr, lsqr, svd, direct).
+                             Default is lsmr.''')
+    sweepParser.add_argument('--domain', '-d', type=str, default='freq', choices=['time', 'freq'],
+                             help='Specify the domain in which the systems are solved. Default is freq.')
+    sweepParser.add_argument('--numVals', '-k', type=int, default=None,
+                             help='Specify the number of singular values/vectors (svd method).')
+    sweepParser.add_argument('--atol', type=float, default=1.0e-8,
+                             help='Specify the error tolerance of the linear operator. Default is 1e-8.')
+    sweepParser.add_argument('--btol', type=float, default=1.0e-8,
+                             help='Specify the error tolerance of the right-hand sides. Default is 1e-8.')
+    sweepParser.add_argument('--ngs', '-n', action='store_true',
+                             help='Normalize the impulse responses by their energy (NFE only).')
+    sweepParser.add_argument('--medium', type=str, default='constant', choices=['constant', 'variable'],
+                             help='Specify whether the background medium is constant or variable.')
+    sweepParser.add_argument('--jobs', '-j', type=int, default=None,
+                             help='Specify the number of worker processes. Default is the number of processors.')
+    sweepParser.add_argument('--output', '-o', type=str, default='sweep.npz',
+                             help='Specify the results file. Default is \'sweep.npz\'.')
+    watchParser = subparsers.add_parser('watch',
+                                        help='''Watch a directory for the gathers of new sources and keep the
+                                        near-field image up to date as they arrive, updating the factorization
+                                        of the operator instead of solving from scratch. The image is saved to
+                                        \'imageWatchNFE.npz\' (view it with \'vzimage --watch\').''')
+    watchParser.add_argument('inbox', type=str, nargs='?', default='incoming',
+                             help='''Specify the directory into which new gathers are written as .npy files
+                             (Nr x Nt for one source or Nr x Nt x b for b sources, without windows applied).
+                             Default is \'incoming\'.''')
+    watchParser.add_argument('--store', type=str, default='watchStore',
+                             help='''Specify the directory to which absorbed gathers are moved. Gathers found
+                             there are absorbed again when watching is restarted. Default is \'watchStore\'.''')
+    watchParser.add_argument('--alpha', '--regPar', type=float, default=0.0,
+                             help='Specify the regularization parameter. Default is 0.')
+    watchParser.add_argument('--every', type=int, default=1,
+                             help='Specify the number of new sources between image refreshes. Default is 1.')
+    watchParser.add_argument('--interval', type=float, default=1.0,
+                             help='Specify the time (in seconds) between checks of the inbox. Default is 1.')
+    watchParser.add_argument('--once', action='store_true',
+                             help='Absorb the gathers waiting in the inbox, refresh the image and exit.')
+    watchParser.add_argument('--ngs', '-n', action='store_true',
+                             help='Normalize the impulse responses by their energy.')
+    watchParser.add_argument('--medium', type=str, default='constant', choices=['constant', 'variable'],
+                             help='Specify whether the background medium is constant or variable.')
+    watchParser.add_argument('--precision', type=str, default='double', choices=['single', 'double'],
+                             help='Specify the floating-point precision. Default is double.')
+    frequencyParser = subparsers.add_parser('frequencies',
+                                            help='''Select an informative subset of the frequencies of the
+                                            frequency window, which shrinks the frequency dimension of the
+                                            operators, and report the fidelity of the resulting image.''')
+    frequencyParser.add_argument('--step', type=int, default=1,
+                                 help='Keep every step-th frequency of the window only. Default is 1.')
+    frequencyParser.add_argument('--energy', type=float, default=None,
+                                 help='''Keep the fewest frequencies that hold the specified fraction of the
+                                 energy of the data (e.g., 0.99).''')
+    frequencyParser.add_argument('--count', type=int, default=None,
+                                 help='Keep at most the specified number of frequencies (those of largest energy).')
+    frequencyParser.add_argument('--alpha', '--regPar', type=float, default=0.0,
+                                 help='''Specify the regularization parameter of the images compared in the
+                                 fidelity report. Default is 0.''')
+    frequencyParser.add_argument('--clear', action='store_true',
+                                 help='Remove the selection and use all frequencies of the window.')
+    ensembleParser = subparsers.add_parser('ensemble',
+                                           help='''Image the recorded data with many seeded realizations of
+                                           band-limited noise at each signal-to-noise ratio, in parallel, and
+                                           save the mean, variance and percentile images.''')
+    ensembleParser.add_argument('--nfe', action='store_true',
+                                help='Solve the near-field equation (NFE). (Default)')
+    ensembleParser.add_argument('--lse', action='store_true',
+                                help='Solve the Lippmann-Schwinger equation (LSE).')
+    ensembleParser.add_argument('--snr', type=str, required=True,
+                                help='Specify a comma-separated list of signal-to-noise ratios.')
+    ensembleParser.add_argument('--realizations', '-N', type=int, default=20,
+                                help='Specify the number of noise realizations per signal-to-noise ratio. Default is 20.')
+    ensembleParser.add_argument('--band', type=str, default=None,
+                                help='''Specify the frequency band fmin:fmax of the noise (fmin > 0). Default
+                                is the frequency window set with \'vzspectra\'.''')
+    ensembleParser.add_argument('--seed', type=int, default=None,
+                                help='''Specify the seed of the random number generator. Default is a random
+                                seed, which is saved with the results.''')
+    ensembleParser.add_argument('--alpha', '--regPar', type=float, default=0.0,
+                                help='Specify the regularization parameter. Default is 0.')
+    ensembleParser.add_argument('--method', '-m', type=str, default='direct', choices=['lsmr', 'lsqr', 'direct'],
+                                help='Specify the method. Default is direct.')
+    ensembleParser.add_argument('--domain', '-d', type=str, default='freq', choices=['time', 'freq'],
+                                help='Specify the domain in which the systems are solved. Default is freq.')
+    ensembleParser.add_argument('--atol', type=float, default=1.0e-8,
+                                help='Specify the error tolerance of the linear operator. Default is 1e-8.')
+    ensembleParser.add_argument('--btol', type=float, default=1.0e-8,
+                                help='Specify the error tolerance of the right-hand sides. Default is 1e-8.')
+    ensembleParser.add_argument('--percentiles', type=str, default='5,50,95',
+                                help='Specify a comma-separated list of percentile images. Default is 5,50,95.')
+    ensembleParser.add_argument('--ngs', '-n', action='store_true',
+                                help='Normalize the impulse responses by their energy (NFE only).')
+    ensembleParser.add_argument('--medium', type=str, default='constant', choices=['constant', 'variable'],
+                                help='Specify whether the background medium is constant or variable.')
+    ensembleParser.add_argument('--jobs', '-j', type=int, default=None,
+                                help='Specify the number of worker processes. Default is the number of processors.')
+    ensembleParser.add_argument('--output', '-o', type=str, default='ensemble.npz',
+                                help='Specify the results file. Default is \'ensemble.npz\'.')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    enable_profiling(args, 'vezda')
+    
+    if args.command == 'serve':
+        serve(args)
+        return
+    elif args.command == 'sweep':
+        run_sweep(args)
+        return
+    elif args.command == 'watch':
+        run_watch(args)
+        return
+    elif args.command == 'frequencies':
+        run_frequency_selection(args)
+        return
+    elif args.command == 'ensemble':
+        run_ensemble(args)
+        return
+    elif args.command == 'run':
+        sys.exit(run_pipeline(args.pipeline, args.jobs, args.force, args.dry_run))
+    
     version = pkg_resources.require('vezda')[0].version
     vzpath = os.path.dirname(os.path.abspath(vezda.__file__))
     print(textwrap.dedent(
@@ -37,4 +215,16 @@ def cli():
                 #SVD.info(),
                 #Solve.info(),
                 #addNoise.info()
-                #)))
\ No newline at end of file
+                #)))
+
+def serve(args):
+    if args.stop or args.status:
+        reply = session_utils.request('stop' if args.stop else 'status')
+        if reply is None:
+            print('No Vezda session server is running.')
+        elif args.stop:
+            print('Stopped Vezda session server (pid %d).' %(reply['pid']))
+        else:
+            print('Vezda session server running (pid %d) with %d cached objects.' %(reply['pid'], reply['cached']))
+    else:
+        session_utils.serve()
@@ -13,6 +13,7 @@
 # limitations under the License.
 #==============================================================================
 import numpy as np
+from scipy.fft import next_fast_len
 
 def humanReadable(seconds):
     '''
@@ -39,6 +40,39 @@ def nextPow2(i):
     return n
 
 
+def as_precision(X, precision):
+    '''
+    Returns the real or complex array X in single (float32/complex64) or
+    double (float64/complex128) precision. X is returned as is if it already
+    has the requested precision.
+    '''
+    if precision == 'single':
+        dtype = np.complex64 if np.iscomplexobj(X) else np.float32
+    else:
+        dtype = np.complex128 if np.iscomplexobj(X) else np.float64
+    
+    return np.asarray(X).astype(dtype, copy=False)
+
+
+def complex_dtype(dtype):
+    '''
+    Returns the complex dtype with the same precision as the given (real or
+    complex) dtype, e.g. the dtype of the Fourier transform of real data.
+    '''
+    return np.result_type(dtype, np.complex64)
+
+
+def convolution_length(Nm):
+    '''
+    Returns the length of the Fourier transforms used by the time-domain
+    convolutional operator with a kernel of Nm time samples: the smallest
+    fast FFT length that holds the full linear convolution of the kernel with
+    a signal of 2*Nm-1 samples, so that the circular convolution computed by
+    the FFTs never wraps around.
+    '''
+    return next_fast_len(3 * Nm - 2, real=True)
+
+
 def timeShift(data, tau, dt):
     '''
     Apply a time shift 'tau' to the data in the frequency domain
@@ -48,7 +82,9 @@ def timeShift(data, tau, dt):
     dt: the length of the time step (used to generate the discretized frequency bins)
     '''
     Nt = data.shape[1]
-    N = nextPow2(Nt)
+    # pad by at least the length of the shift so that the
+    # circular shift does not wrap around the signal
+    N = nextPow2(Nt + int(np.ceil(np.abs(tau) / dt)))
     fftData = np.fft.rfft(data, n=N, axis=1)
     
     # Set up the phase vector e^(-i * omega * tau)
@@ -58,4 +94,4 @@ def timeShift(data, tau, dt):
     # Apply time shift in the frequency domain (element-wise array multiplication)
     shiftedData = np.fft.irfft(fftData * phase[None, :, None], axis=1)
     
-    return shiftedData[:, :Nt, :]
\ No newline at end of file
+    return shiftedData[:, :Nt, :].astype(data.dtype, copy=False)
\ No newline at end of file
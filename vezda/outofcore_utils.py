@@ -0,0 +1,200 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import hashlib
+import textwrap
+import numpy as np
+from pathlib import Path
+from numpy.lib.format import open_memmap
+from concurrent.futures import ThreadPoolExecutor
+from vezda.math_utils import convolution_length, complex_dtype
+
+# target size (in bytes) of a block of the kernel read from disk at a time
+BLOCK_BYTES = 64 * 2**20
+
+#==============================================================================
+# A kernel of a convolutional operator kept on disk
+#
+# The kernel (Nr x Nm x Ns) is stored in a memory-mapped .npy file in the
+# form used by the operator: Fourier transformed over time in the time domain
+# (see asConvolutionalOperator) and with the third axis (sources or search
+# points) first, so that a block of sources/search points is one contiguous
+# read. The metadata are saved to an .npz file of the same name once the
+# kernel is complete.
+#
+# Class data objects:
+#   name: file name of the store (without extension)
+#   domain: 'time' or 'freq'
+#   shape: shape of the kernel (Nr x Nm x Ns)
+#   dtype: dtype of the kernel (real in the time domain)
+#   N: length of the Fourier transform over time (time domain)
+#   blockSize: number of sources/search points read at a time
+#   array: the memory-mapped transformed kernel (Ns x Nf x Nr)
+#
+# Class methods:
+#   create a store to be written block by block: create()
+#   open a complete store: open()
+#   write a block of the kernel: write()
+#   save the metadata of a complete store: finish()
+#   read a block of the transformed kernel: read()
+#   iterate over the blocks, reading ahead in a separate thread: blocks()
+#==============================================================================
+class KernelStore(object):
+
+    def __init__(self, name, domain, shape, dtype, blockSize=None):
+        self.name = name
+        self.domain = domain
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+
+        Nr, Nm, Ns = self.shape
+        if domain == 'time':
+            self.N = convolution_length(Nm)
+            self.Nf = self.N // 2 + 1
+        else:
+            self.N = None
+            self.Nf = Nm
+
+        if blockSize is None:
+            itemsize = np.dtype(complex_dtype(self.dtype)).itemsize
+            blockSize = max(1, BLOCK_BYTES // (self.Nf * Nr * itemsize))
+        self.blockSize = min(blockSize, Ns)
+        self.array = None
+
+
+    @classmethod
+    def create(cls, name, domain, shape, dtype, blockSize=None):
+        store = cls(name, domain, shape, dtype, blockSize)
+        # an incomplete store has no metadata file
+        if Path(name + '.npz').exists():
+            os.remove(name + '.npz')
+        store.array = open_memmap(name + '.npy', mode='w+', dtype=complex_dtype(store.dtype),
+                                  shape=(store.shape[2], store.Nf, store.shape[0]))
+        return store
+
+
+    @classmethod
+    def open(cls, name, blockSize=None):
+        '''
+        Opens a complete store. Returns the store and its metadata, or None if
+        the store does not exist or is incomplete.
+        '''
+        if not (Path(name + '.npz').exists() and Path(name + '.npy').exists()):
+            return None
+        meta = dict(np.load(name + '.npz'))
+        store = cls(name, str(meta['domain']), meta['shape'], str(meta['dtype']), blockSize)
+        store.array = np.load(name + '.npy', mmap_mode='r')
+        if store.array.shape != (store.shape[2], store.Nf, store.shape[0]):
+            # written with a different layout
+            return None
+        return store, meta
+
+
+    def write(self, start, block):
+        '''
+        Writes the kernel of the sources/search points start, start+1, ...
+        (block is an Nr x Nm x b array, transformed over time here in the time
+        domain).
+        '''
+        if self.domain == 'time':
+            block = np.fft.rfft(block, n=self.N, axis=1)
+        self.array[start:start + block.shape[2]] = np.transpose(block, (2, 1, 0))
+
+
+    def finish(self, **meta):
+        self.array.flush()
+        np.savez(self.name + '.npz', domain=self.domain, shape=self.shape, dtype=str(self.dtype), **meta)
+        self.array = np.load(self.name + '.npy', mmap_mode='r')
+
+
+    def read(self, start, stop):
+        return np.array(self.array[start:stop])
+
+
+    def blocks(self):
+        '''
+        Yields (start, stop, block) for the blocks of the transformed kernel
+        ((stop - start) x Nf x Nr arrays). The next block is read in a
+        separate thread while the current one is being used, so that reading
+        from disk overlaps with computing.
+        '''
+        Ns = self.shape[2]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.read, 0, self.blockSize)
+            for start in range(0, Ns, self.blockSize):
+                stop = min(start + self.blockSize, Ns)
+                block = future.result()
+                if stop < Ns:
+                    future = executor.submit(self.read, stop, min(stop + self.blockSize, Ns))
+                yield start, stop, block
+
+
+    @property
+    def signature(self):
+        # identifies the contents of the store (see checkpoint_utils.fingerprint)
+        stat = os.stat(self.name + '.npy')
+        with open(self.name + '.npz', 'rb') as f:
+            meta = hashlib.sha1(f.read()).hexdigest()
+        return '%s:%d:%d' %(meta, stat.st_size, stat.st_mtime_ns)
+
+
+    def __getstate__(self):
+        # the memory map is reopened by each process (e.g., joblib workers)
+        state = self.__dict__.copy()
+        state['array'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.array = np.load(self.name + '.npy', mmap_mode='r')
+
+
+def store_is_current(meta, domain, dtype, frequencies):
+    '''
+    Checks the parts of the metadata of a store that are not covered by
+    samplingIsCurrent: the domain, precision and frequency window.
+    '''
+    if str(meta['domain']) != domain or str(meta['dtype']) != str(np.dtype(dtype)):
+        print('Stored kernel has a different domain or precision...')
+        return False
+    if not np.array_equal(meta['frequencies'], frequencies):
+        print('Current frequency window is inconsistent...')
+        return False
+    return True
+
+
+def check_out_of_core(args):
+    '''
+    Checks that the solver settings of vzsolve allow an out-of-core solve.
+    '''
+    if not args.lse or args.nfe:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Out-of-core solves are only available for the Lippmann-Schwinger
+                equation. Use \'--lse --out-of-core\'.
+                '''))
+    if args.method not in [None, 'lsmr', 'lsqr']:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Out-of-core solves require an iterative method (lsmr/lsqr).
+                '''))
+    if args.adaptive or args.compare_precision:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Out-of-core solves are not available for adaptive imaging or
+                comparing precisions.
+                '''))
@@ -0,0 +1,432 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import fnmatch
+import textwrap
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from vezda.checkpoint_utils import atomic_write
+from vezda.session_utils import file_signature, referenced_files
+
+# commands that may appear in a pipeline and the modules implementing them
+COMMANDS = {'vzdata': 'vezda.setDataPath',
+            'vzwindow': 'vezda.setWindow',
+            'vzgrid': 'vezda.setSearchGrid',
+            'vznoise': 'vezda.addNoise',
+            'vzsolve': 'vezda.Solve',
+            'vzsvd': 'vezda.plotSVD',
+            'vzpicard': 'vezda.Picard',
+            'vzimage': 'vezda.plotImage',
+            'vzwiggles': 'vezda.plotWiggles',
+            'vzspectra': 'vezda.plotSpectra'}
+
+STAGE_KEYS = ['command', 'args', 'answers', 'inputs', 'outputs', 'after']
+
+# runs a command module in a child process: python -c RUNNER command module args...
+RUNNER = 'import sys, importlib; sys.argv.pop(0); module = sys.argv.pop(1); importlib.import_module(module).cli()'
+
+# files read by every stage that works on the recorded data
+DATA_FILES = ['datadir.npz', 'window.npz', 'searchGrid.npz', 'noisyData.npz', 'pulseFun.py']
+
+# settings rewritten by many commands (e.g., the frequency window and view
+# mode kept in the plot parameters). Stages writing them run one after the
+# other, but a stage is not rerun because a later stage rewrote them.
+SHARED_FILES = ['plotParams.pkl']
+
+def default_files(command, args):
+    '''
+    Returns the files read and written by a command (lists of file names or
+    glob patterns) given its arguments.
+    '''
+    equation = 'LSE' if args.get('lse') else 'NFE'
+    operator = 'LSO' if args.get('lso') else 'NFO'
+    solveOperator = 'LSO' if args.get('lse') else 'NFO'
+    if command == 'vzdata':
+        return [os.path.join(str(args.get('path', '.')), '*')], ['datadir.npz']
+    elif command == 'vzwindow':
+        # (a changed time window clears the selection of frequencies)
+        return ['datadir.npz'], ['window.npz', 'plotParams.pkl']
+    elif command == 'vzgrid':
+        return ['datadir.npz'], ['searchGrid.npz']
+    elif command == 'vznoise':
+        return ['datadir.npz', 'window.npz'], ['noisyData.npz', 'noisyData.npy']
+    elif command == 'vzsolve':
+        # besides the solutions (memory-mapped with '--store=mmap') and the
+        # image, the impulse responses (stored on disk with '--out-of-core'),
+        # the SVD ('--method=svd') and the frequency window are saved
+        return DATA_FILES, ['image' + equation + '.npz', 'solution' + equation + '.npz',
+                            'solution' + equation + '.npy', 'VZImpulseResponses.npz',
+                            'VZImpulseResponseStore*', solveOperator + '_SVD.npz', 'plotParams.pkl']
+    elif command == 'vzsvd':
+        return DATA_FILES, [operator + '_SVD.npz', 'singularValues.' + args.get('format', 'pdf'),
+                            'plotParams.pkl']
+    elif command == 'vzpicard':
+        return DATA_FILES + [operator + '_SVD.npz'], ['Picard.' + args.get('format', 'pdf'), 'plotParams.pkl']
+    elif command == 'vzimage':
+        return (['datadir.npz', 'window.npz', 'searchGrid.npz', 'image' + equation + '.npz'],
+                ['image' + equation + '.' + args.get('format', 'pdf'), 'plotParams.pkl'])
+    elif command in ['vzwiggles', 'vzspectra']:
+        return DATA_FILES, ['plotParams.pkl']
+    return DATA_FILES, []
+
+
+def command_line(args):
+    '''
+    Converts the arguments of a stage to command-line options. Arguments are
+    given either as a list of strings or as a table, where true adds a flag,
+    false omits it and lists are joined with commas.
+    '''
+    if isinstance(args, list):
+        return [str(a) for a in args]
+
+    options = []
+    for name, value in args.items():
+        option = '--' + name
+        if value is True:
+            options.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            options.append(option + '=' + ','.join(str(v) for v in value))
+        else:
+            options.append(option + '=' + str(value))
+
+    return options
+
+
+def matches(a, b):
+    return fnmatch.fnmatch(a, b) or fnmatch.fnmatch(b, a)
+
+
+def expand(patterns, exclude=()):
+    '''
+    Returns the signatures of the files matching a list of file names or glob
+    patterns. Missing files have the signature None.
+    '''
+    signatures = {}
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            files = sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+        else:
+            files = [pattern]
+        for f in files:
+            if not any(matches(f, e) for e in exclude):
+                signatures[f] = file_signature(f)
+
+    return signatures
+
+
+#==============================================================================
+# A class describing one stage of a pipeline
+#
+# Class data objects:
+#   name: name of the stage (its table name in the pipeline file)
+#   command: Vezda command run by the stage (e.g., 'vzsolve')
+#   argv: command-line options passed to the command
+#   answers: lines fed to the command's prompts
+#   inputs: files read by the stage
+#   outputs: files written by the stage
+#   after: names of the stages this stage depends on
+#
+# Class methods:
+#   fingerprint of the command, its options and input files: fingerprint()
+#   signatures of the output files: output_state()
+#==============================================================================
+class Stage(object):
+
+    def __init__(self, name, table):
+        self.name = name
+        for key in table:
+            if key not in STAGE_KEYS:
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: Unknown key \'%s\' in stage \'%s\'. Valid keys are: %s.
+                        ''' %(key, name, ', '.join(STAGE_KEYS))))
+        if table.get('command') not in COMMANDS:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Stage \'%s\' must specify a command, one of: %s.
+                    ''' %(name, ', '.join(COMMANDS))))
+
+        self.command = table['command']
+        args = table.get('args', {})
+        self.argv = command_line(args)
+        self.answers = [str(a) for a in table.get('answers', [])]
+        inputs, outputs = default_files(self.command, args if isinstance(args, dict) else {})
+        self.inputs = list(table.get('inputs', inputs))
+        self.outputs = list(table.get('outputs', outputs))
+        self.after = set(table.get('after', []))
+
+
+    def fingerprint(self):
+        inputs = expand(self.inputs, exclude=self.outputs)
+        if 'datadir.npz' in inputs:
+            # the recorded data and geometry are kept outside of the
+            # working directory
+            inputs.update(expand(referenced_files(), exclude=self.outputs))
+        h = hashlib.sha1()
+        h.update(json.dumps([self.command, self.argv, self.answers,
+                             sorted(inputs.items())]).encode())
+        return h.hexdigest()
+
+
+    def output_state(self):
+        # as stored in the state file (signatures of large files become lists);
+        # shared files are rewritten by later stages as well
+        outputs = expand(self.outputs, exclude=SHARED_FILES)
+        return json.loads(json.dumps(sorted(outputs.items())))
+
+
+def load_pipeline(filename):
+    '''
+    Reads a pipeline file and returns its settings and stages.
+    '''
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Reading pipeline files requires Python 3.11 or the tomli package.
+                    Install it with \'pip install tomli\'.
+                    '''))
+    try:
+        with open(filename, 'rb') as f:
+            table = tomllib.load(f)
+    except OSError:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Pipeline file \'%s\' not found.
+                ''' %(filename)))
+    except tomllib.TOMLDecodeError as e:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Could not read pipeline file \'%s\': %s
+                ''' %(filename, e)))
+
+    settings = table.get('pipeline', {})
+    stages = {name: Stage(name, stage) for name, stage in table.get('stages', {}).items()}
+    if len(stages) == 0:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Pipeline file \'%s\' does not declare any [stages.<name>] tables.
+                ''' %(filename)))
+
+    return settings, stages
+
+
+def resolve_dependencies(stages):
+    '''
+    Adds to each stage the stages that write one of its input files (in the
+    order the stages are declared) and returns the stage names in an order in
+    which they may be run.
+    '''
+    names = list(stages)
+    for i, name in enumerate(names):
+        stage = stages[name]
+        for other in stage.after:
+            if other not in stages:
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: Stage \'%s\' runs after unknown stage \'%s\'.
+                        ''' %(name, other)))
+        # an input is written by the closest earlier stage that outputs it
+        for pattern in stage.inputs:
+            for other in reversed(names[:i]):
+                if any(matches(pattern, output) for output in stages[other].outputs):
+                    stage.after.add(other)
+                    break
+        # a shared file is written after the closest earlier stage that writes it
+        for shared in SHARED_FILES:
+            if not any(matches(output, shared) for output in stage.outputs):
+                continue
+            for other in reversed(names[:i]):
+                if any(matches(output, shared) for output in stages[other].outputs):
+                    stage.after.add(other)
+                    break
+
+    order = []
+    visiting = set()
+    def visit(name, path):
+        if name in order:
+            return
+        if name in visiting:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Stages %s depend on each other.
+                    ''' %(' -> '.join(path + [name]))))
+        visiting.add(name)
+        for other in sorted(stages[name].after, key=names.index):
+            visit(other, path + [name])
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names:
+        visit(name, [])
+
+    # stages writing the same file must not run concurrently
+    upstream = {}
+    for name in order:
+        upstream[name] = set(stages[name].after)
+        for other in stages[name].after:
+            upstream[name] |= upstream[other]
+    for i, a in enumerate(order):
+        for b in order[i+1:]:
+            if a in upstream[b] or b in upstream[a]:
+                continue
+            for output in stages[a].outputs:
+                if any(matches(output, o) for o in stages[b].outputs):
+                    sys.exit(textwrap.dedent(
+                            '''
+                            Error: Stages \'%s\' and \'%s\' both write \'%s\'. Order them
+                            with \'after = [\"%s\"]\' in stage \'%s\'.
+                            ''' %(a, b, output, a, b)))
+
+    return order
+
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(filename, state):
+    atomic_write(filename, lambda f : f.write(json.dumps(state, indent=2).encode()))
+
+
+def run_stage(stage, logfile, env):
+    '''
+    Runs the command of a stage in a child process, feeding it the answers to
+    its prompts and writing its output to the log file. Returns the exit
+    status of the command.
+    '''
+    argv = [sys.executable, '-c', RUNNER, stage.command, COMMANDS[stage.command]] + stage.argv
+    answers = ''.join(a + '\n' for a in stage.answers)
+    with open(logfile, 'w') as log:
+        log.write('$ %s %s\n' %(stage.command, ' '.join(stage.argv)))
+        log.flush()
+        process = subprocess.run(argv, input=answers, stdout=log, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, env=env)
+
+    return process.returncode
+
+
+def run_pipeline(filename, jobs=None, force=False, dry_run=False):
+    '''
+    Runs the stages of a pipeline file, skipping the stages whose command,
+    options and input files are unchanged since their last successful run and
+    whose output files are unchanged since then. Stages that do not depend on each other
+    run concurrently.
+    '''
+    settings, stages = load_pipeline(filename)
+    order = resolve_dependencies(stages)
+
+    directory = Path(filename).resolve().parent / settings.get('directory', '.')
+    if jobs is None:
+        jobs = settings.get('jobs', os.cpu_count() or 1)
+    env = dict(os.environ)
+    env['MPLBACKEND'] = settings.get('backend', 'Agg')
+
+    cwd = os.getcwd()
+    os.chdir(str(directory))
+    try:
+        stateDir = Path('.vzpipeline')
+        stateFile = stateDir / 'state.json'
+        state = read_state(stateFile)
+
+        def up_to_date(name):
+            stage = stages[name]
+            previous = state.get(name)
+            if force or previous is None:
+                return False
+            # outputs that a run does not write (e.g., the SVD unless
+            # '--method=svd') are recorded as missing, and must still be
+            return (previous['fingerprint'] == stage.fingerprint() and
+                    stage.output_state() == previous['outputs'])
+
+        if dry_run:
+            rerun = set()
+            for name in order:
+                if not up_to_date(name) or stages[name].after & rerun:
+                    rerun.add(name)
+                    print('%-16s would run: %s %s' %(name, stages[name].command, ' '.join(stages[name].argv)))
+                else:
+                    print('%-16s up to date' %(name))
+            return 0
+
+        stateDir.mkdir(exist_ok=True)
+        done, failed, running = set(), set(), {}
+        startTime = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            while True:
+                # start every stage whose dependencies have completed (the stages
+                # are in dependency order, so skipped stages count at once)
+                if not failed:
+                    active = [r[0] for r in running.values()]
+                    for name in order:
+                        if name in done or name in active or not stages[name].after <= done:
+                            continue
+                        if up_to_date(name):
+                            print('%-16s up to date' %(name))
+                            done.add(name)
+                            continue
+                        print('%-16s running %s %s...' %(name, stages[name].command, ' '.join(stages[name].argv)))
+                        fingerprint = stages[name].fingerprint()
+                        future = pool.submit(run_stage, stages[name], str(stateDir / (name + '.log')), env)
+                        running[future] = (name, fingerprint, time.time())
+
+                if not running:
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint, stageStart = running.pop(future)
+                    status = future.result()
+                    if status == 0:
+                        done.add(name)
+                        state[name] = {'fingerprint': fingerprint,
+                                       'outputs': stages[name].output_state()}
+                        write_state(stateFile, state)
+                        print('%-16s done (%0.1f s)' %(name, time.time() - stageStart))
+                    else:
+                        failed.add(name)
+                        state.pop(name, None)
+                        write_state(stateFile, state)
+                        logfile = stateDir / (name + '.log')
+                        print('%-16s FAILED with status %s. Last lines of %s:' %(name, status, logfile))
+                        with open(logfile) as f:
+                            print(textwrap.indent(''.join(f.readlines()[-15:]), '    '))
+
+        if failed:
+            skipped = [name for name in order if name not in done and name not in failed]
+            if skipped:
+                print('Not run: %s' %(', '.join(skipped)))
+            return 1
+
+        print('Pipeline complete (%0.1f s).' %(time.time() - startTime))
+        return 0
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,440 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import time
+import textwrap
+import numpy as np
+from pathlib import Path
+from vezda.math_utils import nextPow2, humanReadable, as_precision, convolution_length
+from vezda.LinearOperators import asConvolutionalOperator
+from vezda.outofcore_utils import BLOCK_BYTES
+from vezda.sampling_utils import get_search_points, get_unique_indices, free_space_ir
+
+# number of iterations assumed per right-hand side by the lsmr/lsqr estimates
+ITERATIONS = 50
+
+# memory reserved for the interpreter, libraries and small arrays
+OVERHEAD = 200 * 2**20
+
+UNITS = {'': 1, 'B': 1, 'K': 2**10, 'KB': 2**10, 'M': 2**20, 'MB': 2**20,
+         'G': 2**30, 'GB': 2**30, 'T': 2**40, 'TB': 2**40}
+
+def parse_memory(text):
+    '''
+    Parses a memory size such as '512M', '8G' or '1.5GB' (in bytes if no
+    unit is given).
+    '''
+    text = text.strip().upper()
+    number = text.rstrip('KMGTB')
+    try:
+        return int(float(number) * UNITS[text[len(number):]])
+    except (ValueError, KeyError):
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Could not parse the memory size \'%s\'. Use a number followed by
+                K, M, G or T (e.g., \'8G\').
+                ''' %(text)))
+
+
+def workers(nproc):
+    # number of processes used for nproc (negative values count back from
+    # the number of processors, as in joblib)
+    if nproc < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + nproc)
+    return nproc
+
+
+def humanBytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '%0.1f %s' %(n, unit)
+        n /= 1024
+    return '%0.1f TB' %(n)
+
+
+def survey_dimensions(precision='double'):
+    '''
+    Returns the dimensions of the problem as determined by the metadata of
+    the recorded data, the windows and the search grid, without loading the
+    recorded data or impulse responses.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda.data_utils import datadir, get_user_windows, get_frequency_window, load_search_grid
+
+    recorded = np.load(str(datadir['recordedData']), mmap_mode='r')
+    rinterval, tinterval, tstep, dt, sinterval = get_user_windows()
+
+    Nr, Ns = len(rinterval), len(sinterval)
+    if 'sources' in datadir:
+        # reciprocal receivers and sources (see add_reciprocal_data)
+        receiverPoints = np.load(str(datadir['receivers']))[rinterval, :]
+        sourcePoints = np.load(str(datadir['sources']))[sinterval, :]
+        N = len(get_unique_indices(sourcePoints, receiverPoints))
+        if N > 0:
+            Nr, Ns = Nr + N, Ns + len(rinterval)
+
+    Nt = len(tinterval)
+    Nfft = nextPow2(2 * Nt)
+    Nf = len(get_frequency_window(Nfft, tstep * dt, verbose=False))
+
+    if 'impulseResponses' in datadir:
+        K = np.load(str(datadir['impulseResponses']), mmap_mode='r').shape[2]
+        taus = 1
+    else:
+        searchGrid = load_search_grid()
+        if searchGrid is None:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: A search grid needs to be set up before a run can be planned.
+                    '''))
+        K = get_search_points(searchGrid)[0].shape[0]
+        taus = np.size(searchGrid['tau'])
+
+    return {'raw': recorded.shape, 'itemsize': recorded.dtype.itemsize,
+            'Nr': Nr, 'Nt': Nt, 'Ns': Ns, 'Nfft': Nfft, 'Nf': Nf, 'K': K, 'taus': taus,
+            'dt': tstep * dt, 'precision': precision, 'outofcore': False}
+
+
+def operator_dimensions(dims, equation, domain):
+    '''
+    Returns the shape of the operator kernel (Nr x Nm x Ns), the number of
+    unknowns, the number of right-hand sides and their length.
+    '''
+    Nr, Nt, Ns, Nf, K = dims['Nr'], dims['Nt'], dims['Ns'], dims['Nf'], dims['K']
+    if domain == 'freq':
+        Nm = Nf
+    elif equation == 'nfe':
+        Nm = Nt
+    else:
+        Nm = 2 * Nt - 1
+    if equation == 'nfe':
+        kernel = (Nr, Nm, Ns)
+        nrhs = K
+    else:
+        kernel = (Nr, Nm, K)
+        nrhs = Ns
+    # the time-domain operator acts on signals of length 2*Nm-1
+    M = Nm if domain == 'freq' else 2 * Nm - 1
+
+    return kernel, M * kernel[2], nrhs, M * Nr
+
+
+def intermediates(dims, equation, domain, method, store, chunk, k=None, fly=False, nproc=1):
+    '''
+    Returns the sizes (in bytes) of the arrays that are held in memory at the
+    same time during each phase of a solve, as a list of (phase, [(name,
+    bytes), ...]) pairs.
+    '''
+    Nr, Nt, Ns, Nf, K = dims['Nr'], dims['Nt'], dims['Ns'], dims['Nf'], dims['K']
+    Nfull = dims['Nfft'] // 2 + 1
+    kernel, N, nrhs, length = operator_dimensions(dims, equation, domain)
+    chunk = min(chunk or nrhs, nrhs)
+    # bytes per real and complex value ('--precision'); the Fourier
+    # transforms themselves are computed in double precision
+    real = 4 if dims['precision'] == 'single' else 8
+    cplx = 2 * real
+    # solutions are real in the time domain and complex in the frequency domain
+    xsize = real if domain == 'time' else cplx
+
+    raw = int(np.prod(dims['raw'])) * dims['itemsize']
+    dataTime = Nr * Nt * Ns * real
+    dataFFT = Nr * Nfull * Ns * 16
+    dataFreq = Nr * Nf * Ns * cplx
+    irTime = Nr * (2 * Nt - 1) * K * real
+    irFFT = Nr * Nfull * K * 16
+    irFreq = Nr * Nf * K * cplx
+
+    data = dataFreq if domain == 'freq' else dataTime
+    if domain == 'time' or (fly and equation == 'nfe'):
+        ir = irTime
+    else:
+        ir = irFreq
+    if dims['outofcore']:
+        # two blocks of the stored impulse responses are held at a time (see
+        # KernelStore.blocks), while the rest stays on disk
+        Nfk = kernel[1] if domain == 'freq' else convolution_length(kernel[1]) // 2 + 1
+        block = min(BLOCK_BYTES, Nfk * kernel[0] * cplx * K)
+        phases = [('load data', [('recorded data', raw), ('windowed data', 2 * dataTime)])]
+        if domain == 'freq':
+            phases.append(('transform data', [('windowed data', dataTime), ('data spectrum', dataFFT),
+                                              ('windowed spectrum', dataFreq)]))
+        phases.append(('impulse responses', [('data', data), ('impulse response block', 3 * block)]))
+        solve = [('data', data), ('impulse response blocks', 2 * block),
+                 ('solver work vectors', 10 * (N + length) * xsize * workers(nproc)),
+                 ('solutions (chunk)', N * chunk * xsize)]
+        if store == 'npz' and (chunk < nrhs or dims['taus'] > 1):
+            solve.append(('solutions (all)', N * nrhs * xsize * dims['taus']))
+        elif store == 'norms':
+            solve.append(('solution norms', 8 * nrhs * dims['taus'] * K))
+        solve.append(('image', 8 * K * dims['taus']))
+        phases.append(('solve', solve))
+        return phases
+
+    phases = [('load data', [('recorded data', raw), ('windowed data', 2 * dataTime)])]
+    if domain == 'freq':
+        phases.append(('transform data', [('windowed data', dataTime), ('data spectrum', dataFFT),
+                                          ('windowed spectrum', dataFreq)]))
+    irPhase = [('data', data), ('impulse responses (time)', irTime)]
+    if dims['taus'] > 1:
+        irPhase.append(('impulse responses (first tau)', irTime))
+    if ir == irFreq:
+        irPhase += [('impulse responses spectrum', irFFT), ('windowed impulse responses', irFreq)]
+    phases.append(('impulse responses', irPhase))
+
+    solve = [('data', data), ('impulse responses', ir)]
+    if dims['taus'] > 1:
+        solve.append(('impulse responses (first tau)', irTime))
+    if domain == 'time':
+        # Fourier transform of the kernel kept by the operator
+        solve.append(('operator', kernel[0] * (convolution_length(kernel[1]) // 2 + 1) * kernel[2] * cplx))
+    if method == 'direct':
+        r = min(kernel[0], kernel[2])
+        solve += [('block SVD', kernel[1] * (kernel[0] * r + r + r * kernel[2]) * cplx),
+                  ('block inverses', kernel[1] * kernel[2] * kernel[0] * cplx),
+                  ('block products', kernel[1] * (2 * kernel[2] + kernel[0]) * chunk * cplx)]
+    elif method == 'svd':
+        kk = k or min(N, length) // 10
+        solve.append(('SVD', (N + length) * kk * xsize))
+    else:
+        # work vectors of the iterative solvers
+        solve.append(('solver work vectors', 10 * (N + length) * xsize * workers(nproc)))
+    solve.append(('solutions (chunk)', N * chunk * xsize))
+    # a single chunk of one focusing time is saved without a copy (see Solve.py)
+    if store == 'npz' and (chunk < nrhs or dims['taus'] > 1):
+        solve.append(('solutions (all)', N * nrhs * xsize * dims['taus']))
+    elif store == 'norms':
+        solve.append(('solution norms', 8 * nrhs * dims['taus'] * (K if equation == 'lse' else 1)))
+    solve.append(('image', 8 * K * dims['taus']))
+    phases.append(('solve', solve))
+
+    return phases
+
+
+def peak_memory(phases):
+    return OVERHEAD + max(sum(size for name, size in arrays) for phase, arrays in phases)
+
+
+def calibrate(dims, equation, domain, method, k=None):
+    '''
+    Times the core operations on small random problems of the same block
+    shape and returns estimates (in seconds) of one matrix-vector product
+    with the operator and its adjoint, of the direct block factorization and
+    of the impulse response of one search point.
+    '''
+    kernel, N, nrhs, length = operator_dimensions(dims, equation, domain)
+    rng = np.random.default_rng(0)
+    estimates = {}
+
+    if domain == 'freq':
+        # the frequency blocks are independent: time a few and scale
+        Nm = min(kernel[1], 16)
+        sample = rng.standard_normal((kernel[0], Nm, kernel[2])) + 1j * rng.standard_normal((kernel[0], Nm, kernel[2]))
+        scale = kernel[1] / Nm
+    else:
+        # the cost is linear in the number of sources: time a few and scale
+        Ns = min(kernel[2], 4)
+        sample = rng.standard_normal((kernel[0], kernel[1], Ns))
+        scale = kernel[2] / Ns
+    sample = as_precision(sample, dims['precision'])
+    A = asConvolutionalOperator(sample)
+    x = rng.standard_normal(A.shape[1]).astype(A.dtype)
+    y = rng.standard_normal(A.shape[0]).astype(A.dtype)
+    startTime = time.perf_counter()
+    for i in range(3):
+        A.matvec(x)
+        A.rmatvec(y)
+    estimates['matvec'] = scale * (time.perf_counter() - startTime) / 3
+
+    if method == 'direct':
+        block = sample[:, 0, :]
+        rhs = (rng.standard_normal((kernel[0], 8)) + 0j).astype(block.dtype)
+        startTime = time.perf_counter()
+        np.linalg.svd(block, full_matrices=False)
+        estimates['factorization'] = kernel[1] * (time.perf_counter() - startTime)
+        startTime = time.perf_counter()
+        np.matmul(block.conj().T, rhs)
+        estimates['block product'] = kernel[1] * (time.perf_counter() - startTime) / 8
+
+    # the data utilities read the working directory at import time
+    from vezda.data_utils import datadir, pulseFun
+    if 'impulseResponses' not in datadir:
+        receiverPoints = np.zeros((dims['Nr'], np.load(str(datadir['receivers'])).shape[1]))
+        times = np.linspace(0, 1, 2 * dims['Nt'] - 1)
+        startTime = time.perf_counter()
+        free_space_ir(receiverPoints + 1, times, receiverPoints[0], pulseFun.velocity, pulseFun.pulse)
+        estimates['impulse response'] = time.perf_counter() - startTime
+
+    return estimates
+
+
+def runtime(dims, equation, domain, method, estimates, k=None, nproc=1):
+    '''
+    Returns the estimated run times (in seconds) of the impulse responses and
+    of the solve from the calibration estimates.
+    '''
+    kernel, N, nrhs, length = operator_dimensions(dims, equation, domain)
+    times = {}
+    if 'impulse response' in estimates:
+        times['impulse responses'] = dims['K'] * estimates['impulse response']
+    if method == 'direct':
+        times['solve'] = estimates['factorization'] + nrhs * estimates['block product']
+    elif method == 'svd':
+        kk = k or min(N, length) // 10
+        # ARPACK needs a few matrix-vector products per singular value
+        times['solve'] = 3 * kk * estimates['matvec'] + nrhs * 2 * kk * (N + length) * 1e-9
+    else:
+        times['solve'] = nrhs * ITERATIONS * estimates['matvec'] / workers(nproc)
+    times['solve'] *= dims['taus']
+
+    return times
+
+
+def choose_settings(dims, equation, domain, method, store, chunk, budget, k=None, fly=False, nproc=1):
+    '''
+    Chooses the method (if not specified), the storage of the solutions (if
+    not specified) and the largest chunk of right-hand sides such that the
+    predicted peak memory fits the budget. The direct method is preferred in
+    the frequency domain, and the solutions are kept in memory (npz), then
+    memory-mapped (mmap). Returns (method, store, chunk), or None if the run
+    cannot fit the budget.
+    '''
+    nrhs = operator_dimensions(dims, equation, domain)[2]
+    if method is not None:
+        methods = [method]
+    elif dims['outofcore']:
+        methods = ['lsmr']
+    elif domain == 'freq':
+        methods = ['direct', 'lsmr']
+    else:
+        methods = ['lsmr']
+    stores = [store] if store is not None else ['npz', 'mmap']
+
+    for m in methods:
+        for s in stores:
+            if chunk is not None:
+                candidates = [chunk]
+            else:
+                # largest chunk that fits (bisection on the monotone peak)
+                candidates = []
+                lo, hi = 1, nrhs
+                if peak_memory(intermediates(dims, equation, domain, m, s, hi, k, fly, nproc)) <= budget:
+                    candidates = [hi]
+                elif peak_memory(intermediates(dims, equation, domain, m, s, lo, k, fly, nproc)) <= budget:
+                    while hi - lo > 1:
+                        mid = (lo + hi) // 2
+                        if peak_memory(intermediates(dims, equation, domain, m, s, mid, k, fly, nproc)) <= budget:
+                            lo = mid
+                        else:
+                            hi = mid
+                    candidates = [lo]
+            for c in candidates:
+                if peak_memory(intermediates(dims, equation, domain, m, s, c, k, fly, nproc)) <= budget:
+                    return m, s, (None if c >= nrhs else c)
+
+    return None
+
+
+def plan_solve(args, nproc=1):
+    '''
+    Predicts the memory use and run time of a vzsolve run and, if a memory
+    budget is given ('--max-memory'), chooses the method, the storage of the
+    solutions and the chunk size so that the run fits it. If no such settings
+    fit, single precision (unless '--precision' is specified) and then, for
+    the Lippmann-Schwinger equation, an out-of-core solve are tried as well.
+    The chosen settings are written to 'args'. Prints the plan.
+    '''
+    equation = 'nfe' if args.nfe else 'lse'
+    precision = args.precision or 'double'
+    dims = survey_dimensions(precision)
+    dims['outofcore'] = args.out_of_core
+
+    method, store, chunk = args.method, args.store, args.chunk
+    budget = None
+    if args.max_memory is not None:
+        budget = parse_memory(args.max_memory)
+        # settings tried in turn: the requested precision and backend, then
+        # single precision, then out of core (if available for the solve)
+        options = [(precision, args.out_of_core)]
+        if args.precision is None:
+            options.append(('single', args.out_of_core))
+        if (equation == 'lse' and not args.out_of_core and method in [None, 'lsmr', 'lsqr'] and
+            not args.compare_precision and args.baseline is None):
+            options += [(p, True) for p, outofcore in options]
+        
+        for precision, outofcore in options:
+            dims.update(precision=precision, outofcore=outofcore)
+            chosen = choose_settings(dims, equation, args.domain, method, store, chunk, budget,
+                                     args.numVals, args.fly, nproc)
+            if chosen is not None:
+                break
+        
+        if chosen is None:
+            smallest = peak_memory(intermediates(dims, equation, args.domain, method or 'lsmr',
+                                                 store or 'mmap', 1, args.numVals, args.fly, nproc))
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The run needs at least %s, which exceeds the memory budget of %s.
+                    Reduce the number of search points or receivers/sources (see \'vzgrid\'
+                    and \'vzwindow\') or store only the solution norms (\'--store=norms\').
+                    ''' %(humanBytes(smallest), humanBytes(budget))))
+        method, store, chunk = chosen
+        if precision != (args.precision or 'double'):
+            print('Switching to single precision to fit the memory budget...')
+        if outofcore and not args.out_of_core:
+            print('Switching to an out-of-core solve to fit the memory budget...')
+    method = method or 'lsmr'
+    store = store or 'npz'
+    kernel, N, nrhs, length = operator_dimensions(dims, equation, args.domain)
+
+    phases = intermediates(dims, equation, args.domain, method, store, chunk, args.numVals, args.fly, nproc)
+    estimates = calibrate(dims, equation, args.domain, method, args.numVals)
+    times = runtime(dims, equation, args.domain, method, estimates, args.numVals, nproc)
+
+    print(textwrap.dedent(
+          '''
+          Plan for solving the %s in the %s domain (%s precision%s):
+
+              receivers x time samples x sources: %d x %d x %d (%d frequencies)
+              search points: %d    focusing times: %d
+              operator: %d x %d    right-hand sides: %d
+          ''' %(equation.upper(), args.domain, dims['precision'], ', out of core' if dims['outofcore'] else '',
+                dims['Nr'], dims['Nt'], dims['Ns'], dims['Nf'], dims['K'], dims['taus'], length, N, nrhs)))
+    for phase, arrays in phases:
+        total = sum(size for name, size in arrays)
+        print('    %-22s %12s' %(phase, humanBytes(total)))
+        for name, size in arrays:
+            print('        %-30s %12s' %(name, humanBytes(size)))
+    print('\n    predicted peak memory: %s' %(humanBytes(peak_memory(phases))), end='')
+    if budget is not None:
+        print(' (budget %s)' %(humanBytes(budget)))
+    else:
+        print()
+
+    if 'impulse responses' in times:
+        saved = 'VZImpulseResponseStore.npz' if dims['outofcore'] else 'VZImpulseResponses.npz'
+        note = ' (skipped if %s is current)' %(saved) if Path(saved).exists() else ''
+        print('    impulse responses:     ~%s%s' %(humanReadable(times['impulse responses']), note))
+    if method in ['lsmr', 'lsqr']:
+        print('    solve:                 ~%s (assuming %d iterations per right-hand side)'
+              %(humanReadable(times['solve']), ITERATIONS))
+    else:
+        print('    solve:                 ~%s' %(humanReadable(times['solve'])))
+    print('\n    settings: --method=%s --store=%s%s --precision=%s%s\n'
+          %(method, store, '' if chunk is None else ' --chunk=%d' %(chunk), dims['precision'],
+            ' --out-of-core' if dims['outofcore'] else ''))
+
+    args.method, args.store, args.chunk = method, store, chunk
+    args.precision, args.out_of_core = dims['precision'], dims['outofcore']
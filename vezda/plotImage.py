@@ -19,11 +19,16 @@ import textwrap
 import pickle
 import numpy as np
 from pathlib import Path
+import os
 import matplotlib
-matplotlib.use('Qt5Agg')
+# respect a backend chosen through the environment (e.g., MPLBACKEND=Agg
+# when running headless from 'vezda run')
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
 from vezda.plot_utils import (FontColor, default_params,
-                              setFigure, plotImage, plotMap)
+                              setFigure, plotImage, image_movie, plotMap)
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzimage:' + FontColor.END
@@ -37,8 +42,11 @@ def cli():
                         help='''Plot the image obtained by solving the near-field equation.''')
     parser.add_argument('--lse', action='store_true',
                         help='''Plot the image obtained by solving the Lippmann-Schwinger equation.''')
+    parser.add_argument('--watch', action='store_true',
+                        help='''Plot the near-field image kept up to date by \'vezda watch\'.''')
     parser.add_argument('--movie', action='store_true',
-                        help='Save a three-dimensional figure as a rotating frame.')
+                        help='''Save an animation of the images obtained for a list of focusing
+                        times (see \'vzgrid --tau\') as an animated gif.''')
     parser.add_argument('--isolevel', type=float, default=None,
                         help='''Specify the contour level of the isosurface for
                         three-dimensional visualizations. Level must be between 0 and 1.''')
@@ -89,7 +97,9 @@ def cli():
                         help='''Specify whether to view plots in light mode for daytime viewing
                         or dark mode for nighttime viewing.
                         Mode must be either \'light\' or \'dark\'.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzimage')
     
     #==============================================================================
     
@@ -409,18 +419,40 @@ def cli():
                 search grid.
                 '''))
     
-    x = searchGrid['x']
-    y = searchGrid['y']
-    tau = searchGrid['tau']
-    if 'z' not in searchGrid:
-        X, Y = np.meshgrid(x, y, indexing='ij')
-        Z = None
+    tau = np.atleast_1d(searchGrid['tau'])[0]
+    if 'points' in searchGrid:
+        # unstructured search points are plotted as a scatter
+        points = searchGrid['points']
+        X, Y = points[:, 0], points[:, 1]
+        if points.shape[1] == 3:
+            Z = points[:, 2]
+        else:
+            Z = None
     else:
-        z = searchGrid['z']
-        X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
+        x = searchGrid['x']
+        y = searchGrid['y']
+        if 'z' not in searchGrid:
+            X, Y = np.meshgrid(x, y, indexing='ij')
+            Z = None
+        else:
+            z = searchGrid['z']
+            X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
         
     #==============================================================================
-    if Path('imageNFE.npz').exists() and not Path('imageLSE.npz').exists():
+    if args.watch:
+        if not Path('imageWatchNFE.npz').exists():
+            sys.exit(textwrap.dedent(
+                    '''
+                    PlotError: User requested to plot the image kept up to date by
+                    \'vezda watch\', but no such image exists.
+                    '''))
+        
+        # plot the near-field image of 'vezda watch'
+        Dict = np.load('imageWatchNFE.npz')
+        flag = 'WatchNFE'
+        fig, ax = plotImage(Dict, X, Y, Z, tau, plotParams, flag, args.movie)
+        
+    elif Path('imageNFE.npz').exists() and not Path('imageLSE.npz').exists():
         if args.lse:
             sys.exit(textwrap.dedent(
                     '''
@@ -444,7 +476,7 @@ def cli():
         # plot the image obtained by solving the Lippmann-Schwinger equation (LSE)
         Dict = np.load('imageLSE.npz')
         flag = 'LSE'
-        fig, ax = plotImage(Dict, X, Y, Z, tau, plotParams, flag)
+        fig, ax = plotImage(Dict, X, Y, Z, tau, plotParams, flag, args.movie)
         
     
     elif Path('imageNFE.npz').exists() and Path('imageLSE.npz').exists():
@@ -458,7 +490,7 @@ def cli():
             # plot the image obtained by solving the Lippmann-Schwinger equation (LSE)
             Dict = np.load('imageLSE.npz')
             flag = 'LSE'
-            fig, ax = plotImage(Dict, X, Y, Z, tau, plotParams, flag)
+            fig, ax = plotImage(Dict, X, Y, Z, tau, plotParams, flag, args.movie)
             
         
         elif args.nfe and args.lse:
@@ -504,10 +536,18 @@ def cli():
         fig, ax = setFigure(num_axes=1, mode=plotParams['view_mode'], ax1_dim=receiverPoints.shape[1])
     
     plotMap(ax, None, receiverPoints, sourcePoints, scatterer, 'data', plotParams)
+    # redraw the map when stepping through a stack of images
+    ax.map_args = (receiverPoints, sourcePoints, scatterer)
         
     #==============================================================================
     
     pltformat = plotParams['pltformat']    
     fig.savefig('image' + flag + '.' + pltformat, format=pltformat, bbox_inches='tight',
                  facecolor=fig.get_facecolor(), transparent=True)    
+    
+    if args.movie and flag != '':
+        if 'tau' in Dict:
+            image_movie(fig, ax, Dict, X, Y, Z, plotParams, 'image' + flag + '.gif')
+        else:
+            print('Warning: Animations require images for a list of focusing times (see \'vzgrid --tau\').')
     plt.show()
@@ -17,8 +17,12 @@ import sys
 import argparse
 import textwrap
 from pathlib import Path
+import os
 import matplotlib
-matplotlib.use('Qt5Agg')
+# respect a backend chosen through the environment (e.g., MPLBACKEND=Agg
+# when running headless from 'vezda run')
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
 from vezda.data_utils import get_user_windows, get_unique_indices
@@ -29,6 +33,7 @@ from vezda.plot_utils import (vector_title, remove_keymap_conflicts, plotWiggles
 import numpy as np
 import pickle
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzsvd:' + FontColor.END
@@ -52,7 +57,9 @@ def cli():
                         help='''Specify whether to view plots in light mode for daytime viewing
                         or dark mode for nighttime viewing.
                         Mode must be either \'light\' or \'dark\'.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzsvd')
     
     # See if an SVD already exists. If so, attempt to load it...
     if args.nfo and not args.lso:
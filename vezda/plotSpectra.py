@@ -24,6 +24,7 @@ from matplotlib.lines import Line2D
 from pathlib import Path
 import pickle
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzspectra:' + FontColor.END
@@ -60,7 +61,9 @@ def cli():
                         help='''Specify whether to view plots in light mode for daytime viewing
                         or dark mode for nighttime viewing.
                         Mode must be either \'light\' or \'dark\'.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzspectra')
     
     #==============================================================================        
     # Get time window parameters
@@ -303,6 +306,11 @@ def cli():
     elif plotParams['fmax'] is None:
         plotParams['fmax'] = np.max(freqs)
                 
+    if (args.fmin is not None or args.fmax is not None) and plotParams.get('frequencies') is not None:
+        # a selection of frequencies belongs to the frequency window it was made for
+        print('Frequency window changed: clearing the selection of frequencies...')
+        plotParams['frequencies'] = None
+    
     #===================================================================================
     if args.mode is not None:
         plotParams['view_mode'] = args.mode
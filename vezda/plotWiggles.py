@@ -22,6 +22,7 @@ from pathlib import Path
 from vezda.data_utils import get_user_windows, load_data, load_impulse_responses, get_unique_indices
 from vezda.plot_utils import default_params, Experiment, Plotter
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzwiggles:' + FontColor.END
@@ -64,7 +65,9 @@ def cli():
                         or dark mode for nighttime viewing.
                         Mode must be either \'light\' or \'dark\'.''')
     
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzwiggles')
     #==============================================================================
     # if a plotParams.pkl file already exists, load relevant parameters
     if Path('plotParams.pkl').exists():
@@ -140,7 +143,7 @@ def cli():
             
         # Check for source-receiver reciprocity
         reciprocalNumbers = get_unique_indices(sourcePoints, receiverPoints)
-        reciprocalNumbers = np.asarray(reciprocalNumbers, dtype=np.int)
+        reciprocalNumbers = np.asarray(reciprocalNumbers, dtype=int)
             
         if len(reciprocalNumbers) > 0:
             newReceivers = sourcePoints[reciprocalNumbers, :]
@@ -200,8 +203,10 @@ def cli():
         # Update time to convolution times
         T = time[-1] - time[0]
         time = np.linspace(-T, T, 2 * len(time) - 1)
+        # traces are densified one search point at a time as they are plotted
         X, sourcePoints = load_impulse_responses(domain='time', medium=args.medium,
-                                                 verbose=True, return_search_points=True)
+                                                 verbose=True, return_search_points=True,
+                                                 compact=True)
         
         # Update sourceNumbers to match search points
         sourceNumbers = np.arange(sourcePoints.shape[0])
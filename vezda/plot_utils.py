@@ -13,11 +13,16 @@
 # limitations under the License.
 #==============================================================================
 import numpy as np
+import os
 import matplotlib
-matplotlib.use('Qt5Agg')
+# respect a backend chosen through the environment (e.g., MPLBACKEND=Agg
+# when running headless from 'vezda run')
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import matplotlib.patches as patches
+import matplotlib.animation as animation
 from mpl_toolkits.mplot3d import Axes3D
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.ticker import FormatStrFormatter, MaxNLocator
@@ -118,6 +123,7 @@ def default_params():
     plotParams['fu'] = ''
     plotParams['fmin'] = 0
     plotParams['fmax'] = None
+    plotParams['frequencies'] = None    # selected frequencies (see 'vezda frequencies')
     plotParams['freq_title'] = 'Mean Amplitude Spectrum'
     plotParams['freq_ylabel'] = 'Amplitude'
     
@@ -812,8 +818,15 @@ def image_viewer(ax, volume, method, alpha, atol, btol, plotParams, X, Y, Z=None
     if Z is None:
         image_colormap = plt.get_cmap(plotParams['image_colormap'])
         volume[volume > plotParams['vmax']] = plotParams['vmin']
-        im = ax.pcolormesh(X, Y, volume, vmin=plotParams['vmin'], vmax=plotParams['vmax'],
-                           cmap=image_colormap, shading=plotParams['shading'])
+        if X.ndim == 1:
+            # unstructured search points
+            im = ax.scatter(X, Y, c=volume, vmin=plotParams['vmin'], vmax=plotParams['vmax'],
+                            cmap=image_colormap, marker='s')
+        else:
+            # search points outside of the region of interest are not plotted
+            im = ax.pcolormesh(X, Y, np.ma.masked_invalid(volume), vmin=plotParams['vmin'],
+                               vmax=plotParams['vmax'], cmap=image_colormap,
+                               shading=plotParams['shading'])
         if plotParams['colorbar']:
             divider = make_axes_locatable(ax)
             cax = divider.append_axes('right', size='5%', pad=0.05)
@@ -831,22 +844,30 @@ def image_viewer(ax, volume, method, alpha, atol, btol, plotParams, X, Y, Z=None
         #if method != 'svd':
         #    title += ', tol = %01.e' %(tol)
     
-        #if tau is not None:
-        #    if tu != '':
-        #        title += r', $\tau = %0.2f$ %s' %(tau, tu)
-        #    else:
-        #        title += r', $\tau = %0.2f$' %(tau)
+        if tau is not None:
+            if tu != '':
+                title += r', $\tau = %0.2f$ %s' %(tau, tu)
+            else:
+                title += r', $\tau = %0.2f$' %(tau)
                 
     else:
-        x = X[:, 0, 0]
-        y = Y[0, :, 0]
-        z = Z[0, 0, :]
-        
         isolevel = plotParams['isolevel']
         
-        # Plot isosurface of support of source function in space
-        verts, faces = isosurface(volume, isolevel, x, y, z)
-        ax.plot_trisurf(verts[:, 0], verts[:, 1], faces, verts[:, 2], color=ax.surfacecolor)
+        if X.ndim == 1:
+            # unstructured search points: plot the points above the isolevel
+            support = volume >= isolevel
+            ax.scatter(X[support], Y[support], Z[support], c=volume[support],
+                       cmap=plt.get_cmap(plotParams['image_colormap']),
+                       vmin=plotParams['vmin'], vmax=plotParams['vmax'])
+        else:
+            x = X[:, 0, 0]
+            y = Y[0, :, 0]
+            z = Z[0, 0, :]
+            
+            # Plot isosurface of support of source function in space
+            # (search points outside of the region of interest are set to zero)
+            verts, faces = isosurface(np.nan_to_num(volume), isolevel, x, y, z)
+            ax.plot_trisurf(verts[:, 0], verts[:, 1], faces, verts[:, 2], color=ax.surfacecolor)
                 
         zu = plotParams['zu']
         zlabel = plotParams['zlabel']
@@ -857,15 +878,15 @@ def image_viewer(ax, volume, method, alpha, atol, btol, plotParams, X, Y, Z=None
             ax.set_zlabel(zlabel, color=ax.labelcolor)
         
         if alpha != 0:
-            title += r'Isosurface @ %s [$\alpha = %0.1e$]' %(isolevel, alpha)
+            title = r'Isosurface @ %s [$\alpha = %0.1e$]' %(isolevel, alpha)
         else:
-            title += r'Isosurface @ %s [$\alpha = %s$]' %(isolevel, alpha)
+            title = r'Isosurface @ %s [$\alpha = %s$]' %(isolevel, alpha)
     
         if tau is not None:
             if tu != '':
-                title = title[:-1] + r', $\tau = %0.2f %s]' %(tau, tu)
+                title = title[:-1] + r', $\tau = %0.2f$ %s]' %(tau, tu)
             else:
-                title = title[:-1] + r', $\tau = %0.2f]' %(tau)
+                title = title[:-1] + r', $\tau = %0.2f$]' %(tau)
         
     ax.set_title(title, color=ax.titlecolor)
         
@@ -879,20 +900,51 @@ def plotImage(Dict, X, Y, Z, tau, plotParams, flag, movie=False):
     else:
         fig, ax = setFigure(num_axes=1, mode=plotParams['view_mode'], ax1_dim=3)
     
-    Image = Dict['Image'].reshape(X.shape)
     method = Dict['method']
     alpha = Dict['alpha']
     atol = Dict['atol']
     btol = Dict['btol']
     
-    if Dict['domain'] == 'time':
-        image_viewer(ax, Image, method, alpha, atol, btol, plotParams, X, Y, Z, tau)
+    if 'tau' in Dict:
+        # a stack of images, one for each focusing time
+        # use the left/right arrow keys to step through the stack
+        tau = Dict['tau']
+        ax.volume = Dict['Image'].reshape((len(tau),) + X.shape)
+        ax.index = 0
+        image_viewer(ax, ax.volume[ax.index].copy(), method, alpha, atol, btol,
+                     plotParams, X, Y, Z, tau[ax.index])
+        
+        remove_keymap_conflicts({'left', 'right', 'up', 'down'})
+        fig.canvas.mpl_connect('key_press_event', lambda event: process_key_images(event, method, alpha,
+                               atol, btol, plotParams, X, Y, Z, tau))
+    
     else:
-        image_viewer(ax, Image, method, alpha, atol, btol, plotParams, X, Y, Z)
+        Image = Dict['Image'].reshape(X.shape)
+        if Dict['domain'] == 'time':
+            image_viewer(ax, Image, method, alpha, atol, btol, plotParams, X, Y, Z, tau)
+        else:
+            image_viewer(ax, Image, method, alpha, atol, btol, plotParams, X, Y, Z)
         
     return fig, ax
         
         
+def image_movie(fig, ax, Dict, X, Y, Z, plotParams, filename):
+    '''
+    Saves an animation of a stack of images (one for each focusing time)
+    to an animated gif.
+    '''
+    tau = Dict['tau']
+    
+    def update(i):
+        ax.index = i - 1
+        next_image(ax, Dict['method'], Dict['alpha'], Dict['atol'], Dict['btol'],
+                   plotParams, X, Y, Z, tau)
+    
+    print('Saving animation to file \'%s\'...' %(filename))
+    ani = animation.FuncAnimation(fig, update, frames=range(len(tau)), interval=500)
+    ani.save(filename, writer='pillow')
+    
+    
 #==============================================================================
 # General functions for interactive plotting...
 
@@ -1303,34 +1355,30 @@ def previous_vector(ax, xvals, interval, coordinates, flag, cmplx_part, plotPara
 
 #==============================================================================
 # Specific functions for plotting images...    
-def process_key_images(event, plotParams, alpha, X, Y, Z, Ntau, tau):
+def process_key_images(event, method, alpha, atol, btol, plotParams, X, Y, Z, tau):
     fig = event.canvas.figure
     ax = fig.axes[0]
     
     if event.key == 'left' or event.key == 'down':
-        previous_image(ax, plotParams, alpha, X, Y, Z, Ntau, tau)
+        previous_image(ax, method, alpha, atol, btol, plotParams, X, Y, Z, tau)
     
     elif event.key == 'right' or event.key == 'up':
-        next_image(ax, plotParams, alpha, X, Y, Z, Ntau, tau)
+        next_image(ax, method, alpha, atol, btol, plotParams, X, Y, Z, tau)
     
     fig.canvas.draw()
 
-def previous_image(ax, plotParams, alpha, X, Y, Z, Ntau, tau):
+def previous_image(ax, method, alpha, atol, btol, plotParams, X, Y, Z, tau):
     volume = ax.volume
-    ax.index = (ax.index - 1) % Ntau  # wrap around using %
-    if Z is None:
-        image_viewer(ax, volume[:, :, ax.index], plotParams,
-                     alpha, X, Y, Z, tau[ax.index])
-    else:
-        image_viewer(ax, volume[:, :, :, ax.index], plotParams,
-                     alpha, X, Y, Z, tau[ax.index])
+    ax.index = (ax.index - 1) % len(tau)  # wrap around using %
+    image_viewer(ax, volume[ax.index].copy(), method, alpha, atol, btol,
+                 plotParams, X, Y, Z, tau[ax.index])
+    if hasattr(ax, 'map_args'):
+        plotMap(ax, None, *ax.map_args, 'data', plotParams)
     
-def next_image(ax, plotParams, alpha, X, Y, Z, Ntau, tau):
+def next_image(ax, method, alpha, atol, btol, plotParams, X, Y, Z, tau):
     volume = ax.volume
-    ax.index = (ax.index + 1) % Ntau  # wrap around using %
-    if Z is None:
-        image_viewer(ax, volume[:, :, ax.index], plotParams,
-                     alpha, X, Y, Z, tau[ax.index])
-    else:
-        image_viewer(ax, volume[:, :, :, ax.index], plotParams,
-                     alpha, X, Y, Z, tau[ax.index])
+    ax.index = (ax.index + 1) % len(tau)  # wrap around using %
+    image_viewer(ax, volume[ax.index].copy(), method, alpha, atol, btol,
+                 plotParams, X, Y, Z, tau[ax.index])
+    if hasattr(ax, 'map_args'):
+        plotMap(ax, None, *ax.map_args, 'data', plotParams)
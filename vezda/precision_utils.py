@@ -0,0 +1,86 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import time
+import numpy as np
+from scipy.linalg import norm
+from vezda.math_utils import humanReadable
+
+PRECISIONS = ['single', 'double']
+
+def solve_in_precision(survey, precision, equation, method, alpha, domain, tau, ngs,
+                       atol, btol, k, nproc):
+    '''
+    Solves the problem of a Survey in the given precision and returns the
+    solutions, the image over the active search points, the elapsed time and
+    the memory (in bytes) held by the operator kernel and right-hand sides.
+    '''
+    survey.precision = precision
+    startTime = time.time()
+    X = survey.solve(equation, method, alpha, domain, tau, ngs, atol, btol, k, nproc)
+    p = survey.operator(equation, domain, tau, ngs)
+    Image = p.construct_image(X)
+    elapsed = time.time() - startTime
+
+    return X, Image, elapsed, p.kernel.nbytes + p.B.nbytes
+
+
+def compare_precision(survey, equation='nfe', method='direct', alpha=0.0, domain='freq', tau=None,
+                      ngs=False, atol=1.0e-8, btol=1.0e-8, k=None, nproc=1):
+    '''
+    Solves the problem of a Survey in single and in double precision and
+    returns a report (dictionary) of the accuracy of the single-precision
+    solutions and image relative to the double-precision ones:
+
+        solution_error: relative error of the solutions (2-norm)
+        image_error: relative error of the image (2-norm)
+        image_max_error: largest error of the image relative to its maximum
+        peak_distance: distance between the search points at which the two
+                       images peak (zero if they peak at the same point)
+        time_single, time_double: elapsed solve times (in seconds)
+        memory_single, memory_double: memory of the operator kernel and
+                                      right-hand sides (in bytes)
+    '''
+    results = {}
+    for precision in PRECISIONS:
+        print('Solving in %s precision...' %(precision))
+        results[precision] = solve_in_precision(survey, precision, equation, method, alpha, domain,
+                                                tau, ngs, atol, btol, k, nproc)
+
+    Xs, Is, ts, ms = results['single']
+    Xd, Id, td, md = results['double']
+    eps = np.finfo(float).eps
+    peaks = survey.searchPoints[[np.argmax(Is), np.argmax(Id)], :]
+
+    return {'solution_error': norm(Xs - Xd) / (norm(Xd) + eps),
+            'image_error': norm(Is - Id) / (norm(Id) + eps),
+            'image_max_error': np.max(np.abs(Is - Id)) / (np.max(np.abs(Id)) + eps),
+            'peak_distance': norm(peaks[0] - peaks[1]),
+            'time_single': ts, 'time_double': td,
+            'memory_single': ms, 'memory_double': md}
+
+
+def print_precision_report(report):
+    print('\nAccuracy of single precision relative to double precision:\n')
+    print('    relative error of the solutions: %0.2e' %(report['solution_error']))
+    print('    relative error of the image:     %0.2e' %(report['image_error']))
+    print('    maximum error of the image:      %0.2e (relative to its peak)' %(report['image_max_error']))
+    if report['peak_distance'] == 0:
+        print('    image peak:                      same search point')
+    else:
+        print('    image peak:                      moved by %0.4g' %(report['peak_distance']))
+    print('    solve time (single/double):      %s / %s' %(humanReadable(report['time_single']),
+                                                          humanReadable(report['time_double'])))
+    print('    operator memory (single/double): %0.1f MB / %0.1f MB\n' %(report['memory_single'] / 2**20,
+                                                                       report['memory_double'] / 2**20))
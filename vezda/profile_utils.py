@@ -0,0 +1,293 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import platform
+import textwrap
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of the current process in bytes
+    (None if it cannot be determined on this platform).
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes on macOS and in kilobytes on Linux
+        return rss
+    return rss * 1024
+
+
+def io_bytes():
+    '''
+    Returns the number of bytes read and written by the current process
+    (None if it cannot be determined on this platform).
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+#==============================================================================
+# A class for profiling the stages of a Vezda command
+#
+# Class data objects:
+#   enabled: whether measurements are recorded
+#   stages: list of completed stages and their measurements
+#   counters: running totals of events (e.g., operator matrix-vector products)
+#   samples: per-item statistics (e.g., iterations per search point)
+#
+# Class methods:
+#   time a stage of the computation: stage(name)
+#   increment an event counter: count(name, n)
+#   record per-item statistics: record(name, values)
+#   write the report to a JSON file: write(filename)
+#==============================================================================
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.command = None
+        self.stages = []
+        self.counters = {}
+        self.samples = {}
+        self.path = []
+        self.finish = None
+
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self.path.append(name)
+        counters = dict(self.counters)
+        io = io_bytes()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            entry = {'stage': '/'.join(self.path),
+                     'wall_time': time.perf_counter() - wall,
+                     'cpu_time': time.process_time() - cpu,
+                     'peak_rss': peak_rss()}
+            if io is not None:
+                rchar, wchar = io_bytes()
+                entry['bytes_read'] = rchar - io[0]
+                entry['bytes_written'] = wchar - io[1]
+            entry['counters'] = {key: value - counters.get(key, 0)
+                                 for key, value in self.counters.items()
+                                 if value != counters.get(key, 0)}
+            self.stages.append(entry)
+            self.path.pop()
+
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def record(self, name, values):
+        # Only running totals and a histogram are kept, so the report does not
+        # grow with the number of items. Values below 1 share the bin [0, 1);
+        # bin b >= 0 holds the values in [2^b, 2^(b+1)).
+        if self.enabled:
+            values = np.atleast_1d(values).astype(float)
+            entry = self.samples.setdefault(name, {'count': 0, 'total': 0.0, 'squares': 0.0,
+                                                   'min': np.inf, 'max': -np.inf, 'bins': {}})
+            entry['count'] += len(values)
+            entry['total'] += float(np.sum(values))
+            entry['squares'] += float(np.sum(values**2))
+            entry['min'] = min(entry['min'], float(np.min(values)))
+            entry['max'] = max(entry['max'], float(np.max(values)))
+            bins = np.where(values < 1, -1, np.floor(np.log2(np.maximum(values, 1)))).astype(int)
+            for b, n in zip(*np.unique(bins, return_counts=True)):
+                entry['bins'][int(b)] = entry['bins'].get(int(b), 0) + int(n)
+
+
+    def report(self):
+        samples = {}
+        for name, entry in self.samples.items():
+            mean = entry['total'] / entry['count']
+            histogram = [{'from': 0 if b < 0 else 2**b, 'to': 1 if b < 0 else 2**(b + 1), 'count': n}
+                         for b, n in sorted(entry['bins'].items())]
+            samples[name] = {'count': entry['count'], 'total': entry['total'],
+                             'min': entry['min'], 'mean': mean, 'max': entry['max'],
+                             'std': float(np.sqrt(max(entry['squares'] / entry['count'] - mean**2, 0.0))),
+                             'histogram': histogram}
+
+        try:
+            import pkg_resources  # part of setuptools
+            version = pkg_resources.require('vezda')[0].version
+        except Exception:
+            version = None
+        
+        # totals over all calls of each stage
+        summary = {}
+        for entry in self.stages:
+            total = summary.setdefault(entry['stage'], {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0})
+            total['calls'] += 1
+            total['wall_time'] += entry['wall_time']
+            total['cpu_time'] += entry['cpu_time']
+        
+        return {'command': self.command,
+                'argv': sys.argv,
+                'version': version,
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'summary': summary,
+                'stages': self.stages,
+                'counters': self.counters,
+                'samples': samples}
+
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print('Profiling report saved to \'%s\'.' %(filename))
+
+
+# the profiler shared by all modules of a running command
+profiler = Profiler()
+
+def stage(name):
+    '''
+    Context manager that records wall and CPU time, peak memory, bytes read
+    and written and event counts for a stage of the computation when
+    profiling is enabled (and does nothing otherwise).
+    '''
+    return profiler.stage(name)
+
+def profiled(name):
+    '''
+    Decorator that records every call of a function as a stage.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    profiler.count(name, n)
+
+def record(name, values):
+    profiler.record(name, values)
+
+
+#==============================================================================
+def add_profile_arguments(parser):
+    '''
+    Adds the profiling options shared by all Vezda commands to an
+    argparse parser.
+    '''
+    parser.add_argument('--profile', type=str, default=None, metavar='report.json',
+                        help='''Record the time, memory and I/O of each stage of the computation, along
+                        with solver statistics, and save them to the specified JSON file.''')
+    parser.add_argument('--profiler', type=str, default=None, choices=['cprofile', 'pyinstrument'],
+                        help='''Additionally run a function-level profiler. The output is saved next to
+                        the report (report.prof for cProfile, report.html for pyinstrument).
+                        Requires \'--profile\'.''')
+
+
+def enable_profiling(args, command):
+    '''
+    Enables profiling for the remainder of the command if requested by the
+    '--profile' option. The report is written when the command exits.
+    '''
+    if args.profiler is not None and args.profile is None:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Optional argument \'--profiler\' requires \'--profile=report.json\'.
+                '''))
+
+    if args.profile is None:
+        return
+
+    profiler.enabled = True
+    profiler.command = command
+    base = os.path.splitext(args.profile)[0]
+
+    if args.profiler == 'cprofile':
+        import cProfile
+        hook = cProfile.Profile()
+        hook.enable()
+    elif args.profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler as Instrument
+        except ImportError:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The pyinstrument package is required for \'--profiler=pyinstrument\'.
+                    Install it with \'pip install pyinstrument\' or use \'--profiler=cprofile\'.
+                    '''))
+        hook = Instrument()
+        hook.start()
+    else:
+        hook = None
+
+    # the whole command is recorded as a top-level stage
+    total = profiler.stage(command)
+    total.__enter__()
+
+    def finish():
+        total.__exit__(None, None, None)
+        if args.profiler == 'cprofile':
+            hook.disable()
+            hook.dump_stats(base + '.prof')
+        elif args.profiler == 'pyinstrument':
+            hook.stop()
+            with open(base + '.html', 'w') as f:
+                f.write(hook.output_html())
+        profiler.write(args.profile)
+
+    # the report is written at exit, or earlier by a resident session
+    # server (see session_utils) once the command has completed
+    profiler.finish = finish
+    atexit.register(finish_profiling)
+
+
+def finish_profiling():
+    '''
+    Writes the report of the running command (if profiling is enabled) and
+    resets the profiler.
+    '''
+    if profiler.finish is not None:
+        finish = profiler.finish
+        profiler.finish = None
+        finish()
+    profiler.__init__()
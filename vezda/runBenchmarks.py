@@ -0,0 +1,134 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import sys
+import argparse
+import textwrap
+from vezda.plot_utils import FontColor
+from vezda.benchmarks.suite import (SIZES, CASES, benchmark_cases, environment, append_history,
+                                    load_baseline, save_baseline, compare)
+from vezda.profile_utils import add_profile_arguments, enable_profiling
+
+def info():
+    commandName = FontColor.BOLD + 'vzbench:' + FontColor.END
+    description = ' time the imaging pipeline on synthetic surveys'
+
+    return commandName + description
+
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='small',
+                        help='''Specify a comma-separated list of survey sizes to benchmark: %s.
+                        Default is \'small\'.''' %(', '.join(SIZES)))
+    parser.add_argument('--nr', type=int, default=None,
+                        help='Benchmark a custom survey with the specified number of receivers.')
+    parser.add_argument('--ns', type=int, default=None,
+                        help='Specify the number of sources of a custom survey. Default is \'--nr\'.')
+    parser.add_argument('--nt', type=int, default=64,
+                        help='Specify the number of time samples of a custom survey. Default is 64.')
+    parser.add_argument('--grid', type=int, default=11,
+                        help='''Specify the number of search points along each axis of a custom survey.
+                        Default is 11.''')
+    parser.add_argument('--dim', type=int, default=2, choices=[2, 3],
+                        help='Specify the number of space dimensions. Default is 2.')
+    parser.add_argument('--cases', type=str, default=None,
+                        help='''Specify a comma-separated list of benchmark cases: %s.
+                        Default is all cases.''' %(', '.join(CASES)))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Specify the number of times each case is timed. Default is 3.')
+    parser.add_argument('--nrhs', type=int, default=8,
+                        help='''Specify the number of search points (sources for the Lippmann-Schwinger
+                        cases) solved for by the solvers. Default is 8.''')
+    parser.add_argument('--history', type=str, default='vzbench_history.jsonl',
+                        help='''Specify the file to which the results are appended (one JSON line per run).
+                        Default is \'vzbench_history.jsonl\'.''')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='''Compare the results against a baseline file and exit with status 1 if any
+                        case is slower than the baseline by more than \'--tolerance\'.''')
+    parser.add_argument('--save-baseline', type=str, default=None,
+                        help='Save the results of this run as a baseline file.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='''Specify the relative slowdown allowed before a case counts as a regression.
+                        Default is 0.25 (25%%).''')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    enable_profiling(args, 'vzbench')
+
+    #==========================================================================
+    if args.nr is not None:
+        if args.ns is None:
+            args.ns = args.nr
+        sizes = {'custom': {'Nr': args.nr, 'Ns': args.ns, 'Nt': args.nt, 'grid': args.grid}}
+    else:
+        sizes = {}
+        for name in args.sizes.split(','):
+            if name not in SIZES:
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: Unknown survey size \'%s\'. Available sizes are: %s.
+                        ''' %(name, ', '.join(SIZES))))
+            sizes[name] = SIZES[name]
+
+    if args.cases is not None:
+        cases = args.cases.split(',')
+        for case in cases:
+            if case not in CASES:
+                sys.exit(textwrap.dedent(
+                        '''
+                        Error: Unknown benchmark case \'%s\'. Available cases are:
+                        %s.
+                        ''' %(case, ', '.join(CASES))))
+    else:
+        cases = CASES
+
+    if args.repeat < 1 or args.nrhs < 1:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Optional arguments \'--repeat\' and \'--nrhs\' must be positive integers.
+                '''))
+
+    #==========================================================================
+    run = dict(environment(), results=[])
+    for name, size in sizes.items():
+        print('Benchmarking %s survey (Nr = %d, Ns = %d, Nt = %d, grid = %d^%d)...'
+              %(name, size['Nr'], size['Ns'], size['Nt'], size['grid'], args.dim))
+        for result in benchmark_cases(size, cases, args.repeat, args.nrhs, dim=args.dim):
+            result['name'] = name
+            run['results'].append(result)
+            print('    %-20s min %10.4f s    median %10.4f s' %(result['case'], result['min'], result['median']))
+
+    append_history(args.history, run)
+    print('Results appended to \'%s\'.' %(args.history))
+
+    if args.save_baseline is not None:
+        save_baseline(args.save_baseline, run)
+        print('Baseline saved to \'%s\'.' %(args.save_baseline))
+
+    if args.baseline is not None:
+        comparison = compare(run, load_baseline(args.baseline), args.tolerance)
+        print('\nComparison against baseline \'%s\':' %(args.baseline))
+        regressions = 0
+        for case, name, dim, reference, median, ratio, regressed in comparison:
+            if regressed:
+                regressions += 1
+                flag = FontColor.RED + 'REGRESSION' + FontColor.END
+            else:
+                flag = ''
+            print('    %-20s %-8s %dD %10.4f s -> %10.4f s  (x%0.2f) %s' %(case, name, dim, reference, median,
+                                                                          ratio, flag))
+
+        if regressions > 0:
+            sys.exit('%d benchmark case(s) regressed by more than %d%%.' %(regressions, round(100 * args.tolerance)))
+        else:
+            print('No regressions detected.')
@@ -17,6 +17,7 @@ from scipy.linalg import norm
 from tqdm import trange
 from time import sleep
 import subprocess
+from vezda.profile_utils import profiled
 
 def free_space_ir(receiverPoints, recordingTimes, sourcePoint, velocity, pulseFunc):
     '''
@@ -80,7 +81,9 @@ def call_to_other_func(receiverPoints, recordingTimes, sourcePoints):
     return impulseResponse
 
 
-def compute_impulse_responses(medium, receiverPoints, recordingTimes, searchPoints, velocity, pulse):
+@profiled('impulse response generation')
+def compute_impulse_responses(medium, receiverPoints, recordingTimes, searchPoints, velocity, pulse,
+                              precision='double'):
     '''
     Compute the impulse responses for a specified medium and search grid.
     
@@ -90,7 +93,9 @@ def compute_impulse_responses(medium, receiverPoints, recordingTimes, searchPoin
     searchPoints: an array of search points in 2D or 3D space
     velocity: the velocity of the (constant) medium through which the waves propagate
     pulse: a function of time that describes the shape of the wave
+    precision: 'single' (float32) or 'double' (float64) precision of the output
     '''
+    dtype = np.float32 if precision == 'single' else np.float64
     
     # get the number of receivers, time samples, and sources
     Nr = receiverPoints.shape[0]
@@ -101,31 +106,66 @@ def compute_impulse_responses(medium, receiverPoints, recordingTimes, searchPoin
         # Use source-receiver reciprocity to efficiently compute impulse responses
         
         if medium == 'constant':
-            impulseResponses = np.zeros((Ns, Nt, Nr))
+            impulseResponses = np.zeros((Ns, Nt, Nr), dtype=dtype)
             for i in trange(Nr):
                 impulseResponses[:, :, i] = free_space_ir(searchPoints, recordingTimes,
                                 receiverPoints[i, :], velocity, pulse)
                 sleep(0.001)
         
         else:
-            impulseResponses = call_to_other_func(searchPoints, recordingTimes, receiverPoints)
+            impulseResponses = call_to_other_func(searchPoints, recordingTimes, receiverPoints).astype(dtype)
         
         impulseResponses = np.swapaxes(impulseResponses, 0, 2)
         
     else:
         if medium == 'constant':
-            impulseResponses = np.zeros((Nr, Nt, Ns))
+            impulseResponses = np.zeros((Nr, Nt, Ns), dtype=dtype)
             for i in trange(Ns):
                 impulseResponses[:, :, i] = free_space_ir(receiverPoints, recordingTimes,
                           searchPoints[i, :], velocity, pulse)
                 sleep(0.001)
         
         else:
-            impulseResponses = call_to_other_func(receiverPoints, recordingTimes, searchPoints)
+            impulseResponses = call_to_other_func(receiverPoints, recordingTimes, searchPoints).astype(dtype)
         
     return impulseResponses
 
 
+def get_unique_indices(coordinates1, coordinates2):    
+    N = coordinates1.shape[0]
+    unique_indices = []
+    for n in range(N):
+        if (coordinates1[n, :] != coordinates2).any(axis=1).all():
+            unique_indices.append(n)
+        
+    return unique_indices
+
+
+def add_reciprocal_data(data, indices):
+    '''
+    Uses source-receiver reciprocity to extend a data array (Nr x Nt x Ns): the
+    sources 'indices' that are not co-located with a receiver (see
+    get_unique_indices) are added as receivers, and the receivers are added
+    as sources for them.
+    '''
+    N = len(indices)
+    newData = data[:, :, indices]
+    newData = np.swapaxes(newData, 0, 2)
+    M = newData.shape[2]
+    npad = ((0, N), (0, 0), (0, M))
+    data = np.pad(data, pad_width=npad, mode='constant', constant_values=0)
+    data[-N:, :, -M:] = newData
+    
+    return data
+
+
+def convolution_times(recordingTimes):
+    # the impulse responses are evaluated over the length of the
+    # circular convolution with the recorded data
+    T = recordingTimes[-1] - recordingTimes[0]
+    return np.linspace(-T, T, 2 * len(recordingTimes) - 1)
+
+
 def samplingIsCurrent(Dict, receiverPoints, recordingTimes, searchPoints, tau, velocity, peakFreq=None, peakTime=None):
     if peakFreq is None and peakTime is None:
         
@@ -187,4 +227,117 @@ def samplingIsCurrent(Dict, receiverPoints, recordingTimes, searchPoints, tau, v
         
         else:
             print('Current search grid or focusing time is inconsistent...')
-            return False
\ No newline at end of file
+            return False
+
+def get_search_points(searchGrid):
+    '''
+    Returns the active search points defined by a search grid dictionary.
+    
+    A search grid is either a tensor-product grid defined by the axes 'x', 'y'
+    (and optionally 'z'), possibly restricted to a region of interest by a
+    boolean 'mask', or an unstructured cloud of search 'points'.
+    
+    Output:
+        searchPoints: an array of the active search points (Nsp x 2 or Nsp x 3)
+        mask: a flattened boolean array over the full grid marking the active
+              points (None if the full grid is active or the grid is unstructured)
+        gridShape: the shape of the full tensor-product grid (None if unstructured)
+    '''
+    if 'points' in searchGrid:
+        return searchGrid['points'], None, None
+    
+    x = searchGrid['x']
+    y = searchGrid['y']
+    if 'z' in searchGrid:
+        z = searchGrid['z']
+        gridShape = (len(x), len(y), len(z))
+        searchPoints = np.vstack(np.meshgrid(x, y, z, indexing='ij')).reshape(3, np.prod(gridShape)).T
+    else:
+        gridShape = (len(x), len(y))
+        searchPoints = np.vstack(np.meshgrid(x, y, indexing='ij')).reshape(2, np.prod(gridShape)).T
+    
+    if 'mask' in searchGrid:
+        mask = searchGrid['mask']
+        searchPoints = searchPoints[mask, :]
+    else:
+        mask = None
+    
+    return searchPoints, mask, gridShape
+
+
+def scatter_to_grid(values, mask):
+    '''
+    Scatter values computed at the active search points back into the full
+    search grid. Inactive grid points are set to NaN.
+    
+    values: an array whose last axis indexes the active search points
+    mask: a flattened boolean array over the full grid (or None)
+    '''
+    if mask is None:
+        return values
+    
+    full = np.full(values.shape[:-1] + mask.shape, np.nan)
+    full[..., mask] = values
+    
+    return full
+
+
+def load_points_file(filename):
+    '''
+    Load an array of points (or a boolean mask) from a binary NumPy '.npy'
+    file or a plain-text file.
+    '''
+    if filename.endswith('.npy'):
+        return np.load(filename)
+    else:
+        return np.loadtxt(filename, ndmin=2)
+
+
+def mask_from_file(filename, axes):
+    '''
+    Returns a flattened boolean mask over the tensor-product grid defined by
+    'axes' from a file containing either a boolean volume with the shape of the
+    grid or a list of point coordinates. Listed points are snapped to their
+    nearest grid points.
+    '''
+    gridShape = tuple(len(ax) for ax in axes)
+    array = load_points_file(filename)
+    
+    if array.dtype == bool:
+        if array.size != np.prod(gridShape):
+            raise ValueError('mask has %d elements, but the search grid has %d points'
+                             %(array.size, np.prod(gridShape)))
+        return array.reshape(-1)
+    
+    if array.ndim != 2 or array.shape[1] != len(axes):
+        raise ValueError('expected a list of points of shape N x %d' %(len(axes)))
+    
+    mask = np.zeros(gridShape, dtype=bool)
+    index = []
+    for a, ax in enumerate(axes):
+        index.append(np.argmin(np.abs(array[:, a, None] - ax[None, :]), axis=1))
+    mask[tuple(index)] = True
+    
+    return mask.reshape(-1)
+
+
+def mask_from_polygon(filename, axes):
+    '''
+    Returns a flattened boolean mask over the tensor-product grid defined by
+    'axes' that is True inside a polygon (2D) or polyhedron (3D). The file
+    contains the vertices of the polygon in order, or the vertices of the
+    polyhedron, in which case their convex hull is used.
+    '''
+    vertices = load_points_file(filename)
+    if vertices.ndim != 2 or vertices.shape[1] != len(axes):
+        raise ValueError('expected a list of vertices of shape N x %d' %(len(axes)))
+    
+    gridPoints = np.vstack(np.meshgrid(*axes, indexing='ij')).reshape(len(axes), -1).T
+    if len(axes) == 2:
+        from matplotlib.path import Path
+        mask = Path(vertices).contains_points(gridPoints)
+    else:
+        from scipy.spatial import Delaunay
+        mask = Delaunay(vertices).find_simplex(gridPoints) >= 0
+    
+    return mask
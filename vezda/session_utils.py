@@ -0,0 +1,411 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import json
+import hashlib
+import builtins
+import importlib
+import functools
+import textwrap
+import traceback
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+
+# files in the working directory whose contents determine the loaded data,
+# impulse responses and SVDs
+INPUT_FILES = ['datadir.npz', 'window.npz', 'searchGrid.npz', 'noisyData.npz',
+               'plotParams.pkl', 'pulseFun.py', 'VZImpulseResponses.npz',
+               'NFO_SVD.npz', 'LSO_SVD.npz']
+
+# files that are read when a module is imported (see data_utils)
+MODULE_FILES = ['datadir.npz', 'plotParams.pkl', 'pulseFun.py']
+
+# commands that may be delegated to the session server
+COMMANDS = {'vzsolve': 'vezda.Solve'}
+
+# maximum number of cached results held by the session server
+CACHE_SIZE = 16
+
+def session_directory():
+    return Path(os.environ.get('VEZDA_SESSION_DIR', Path.home() / '.vezda'))
+
+
+def session_file():
+    return session_directory() / 'session.json'
+
+
+#==============================================================================
+# State of the resident session
+#
+# Class data objects:
+#   active: True inside a running session server
+#   cache: least-recently-used cache of loaded and computed objects
+#   modules: signature of the files read at module import time
+#==============================================================================
+class Session(object):
+
+    def __init__(self):
+        self.active = False
+        self.cache = OrderedDict()
+        self.modules = None
+
+session = Session()
+
+def file_signature(filename):
+    '''
+    Returns a signature of a file that changes whenever the file changes:
+    a hash of the contents for small files, the size and modification time
+    for large ones, and None if the file does not exist.
+    '''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if stat.st_size < 2**20:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def referenced_files(directory='.'):
+    '''
+    Returns the files whose paths are kept in 'datadir.npz' (recorded data,
+    receivers, sources, ...) and in 'noisyData.npz' (memory-mapped noisy
+    data) of the given directory.
+    '''
+    files = []
+    for name in ['datadir.npz', 'noisyData.npz']:
+        try:
+            with np.load(str(Path(directory) / name)) as Dict:
+                # ('path' is the data directory and 'files' lists the
+                # others again)
+                for key in Dict.files:
+                    if (name == 'datadir.npz' and key not in ['path', 'files']) or key == 'noisyFile':
+                        files.append(str(Path(directory) / str(Dict[key])))
+        except (OSError, ValueError):
+            continue
+    return files
+
+
+def file_state(files=INPUT_FILES):
+    # the working directory, its input files and the files they refer to
+    return ((os.getcwd(),) + tuple(file_signature(f) for f in files) +
+            tuple((f, file_signature(f)) for f in referenced_files()))
+
+
+def cached_origin(value):
+    '''
+    Returns the key of the cached call whose result is (or holds) the given
+    object, together with its position in the result, or None.
+    '''
+    for key, result in session.cache.items():
+        if result is value:
+            return (key,)
+        if isinstance(result, tuple):
+            for i, item in enumerate(result):
+                if item is value:
+                    return (key, i)
+    return None
+
+
+def argument_key(value):
+    '''
+    Returns a hashable key for a function argument, or None if the argument
+    cannot be identified cheaply. Arrays are identified by the cached call
+    that returned them (cached results are read-only, so their contents
+    cannot have changed), not by their contents.
+    '''
+    if value is None or isinstance(value, (bool, int, float, complex, str, np.generic)):
+        return repr(value)
+    elif isinstance(value, np.ndarray) and value.ndim == 0:
+        return repr(value.item())
+    elif isinstance(value, (list, tuple)):
+        keys = tuple(argument_key(v) for v in value)
+        return None if None in keys else keys
+    elif isinstance(value, dict):
+        keys = tuple(sorted((k, argument_key(v)) for k, v in value.items()))
+        return None if any(k[1] is None for k in keys) else keys
+    origin = cached_origin(value)
+    return None if origin is None else ('cached',) + origin
+
+
+def read_only(value):
+    # cached results are shared by all callers, so their arrays are read-only
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            read_only(item)
+    elif hasattr(value, '__dict__'):
+        # arrays held by an object (e.g., SegmentedTraces)
+        for item in vars(value).values():
+            if isinstance(item, np.ndarray):
+                item.setflags(write=False)
+    return value
+
+
+def cached(function):
+    '''
+    Decorator that keeps the results of a function in memory while running
+    inside a session server. A result is reused only if the arguments and
+    the input files in the working directory (see INPUT_FILES) and the files
+    they refer to (see referenced_files) are unchanged. Array arguments must
+    be results of cached calls (see argument_key); otherwise the function is
+    called as usual.
+    Callers receive the cached result itself, with its arrays made read-only,
+    so they must copy an array before modifying it. Outside of a session
+    server the function is called as usual.
+    '''
+    name = function.__module__ + '.' + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not session.active:
+            return function(*args, **kwargs)
+
+        arguments = argument_key((args, kwargs))
+        if arguments is None:
+            return function(*args, **kwargs)
+        key = (name, arguments, file_state())
+        if key in session.cache:
+            print('Reusing %s from the session...' %(function.__name__))
+            session.cache.move_to_end(key)
+            return session.cache[key]
+
+        result = read_only(function(*args, **kwargs))
+        # the function may have written some of the input files
+        # (e.g., impulse responses), so the state is taken afterwards
+        session.cache[(name, arguments, file_state())] = result
+        while len(session.cache) > CACHE_SIZE:
+            session.cache.popitem(last=False)
+
+        return result
+
+    return wrapper
+
+
+#==============================================================================
+# Client side
+def delegate(command):
+    '''
+    Runs the current command in a resident session server if one is running
+    (see 'vezda serve'), relaying its output and any prompts, and exits with
+    the status of the command. Returns without doing anything if no server
+    is running, if VEZDA_SESSION=off, or inside the server itself.
+    '''
+    if session.active or os.environ.get('VEZDA_SESSION', '').lower() in ['0', 'off', 'no', 'false']:
+        return
+
+    info = read_session_file()
+    if info is None:
+        return
+
+    try:
+        conn = connect(info)
+    except (OSError, EOFError):
+        # stale session file
+        return
+
+    with conn:
+        conn.send({'request': 'run', 'command': command, 'argv': sys.argv[1:], 'cwd': os.getcwd()})
+        while True:
+            kind, value = conn.recv()
+            if kind == 'stdout':
+                sys.stdout.write(value)
+                sys.stdout.flush()
+            elif kind == 'stderr':
+                sys.stderr.write(value)
+                sys.stderr.flush()
+            elif kind == 'input':
+                try:
+                    conn.send(input(value))
+                except (EOFError, KeyboardInterrupt):
+                    conn.send(None)
+            elif kind == 'exit':
+                sys.exit(value)
+
+
+def connect(info):
+    address = info['address']
+    if info['family'] == 'AF_INET':
+        address = tuple(address)
+    return Client(address, family=info['family'], authkey=bytes.fromhex(info['authkey']))
+
+
+def read_session_file():
+    try:
+        with open(session_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def request(message):
+    '''
+    Sends a control message ('status' or 'stop') to the session server and
+    returns its reply (None if no server is running).
+    '''
+    info = read_session_file()
+    if info is None:
+        return None
+    try:
+        with connect(info) as conn:
+            conn.send({'request': message})
+            return conn.recv()
+    except (OSError, EOFError):
+        return None
+
+
+#==============================================================================
+# Server side
+class Stream(object):
+    '''
+    File-like object that relays text written by a command to the client.
+    '''
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.conn.send((self.kind, text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def reload_modules(command):
+    '''
+    Imports the module of a command, reloading the modules that read input
+    files at import time if those files have changed since they were loaded.
+    '''
+    state = file_state(MODULE_FILES)
+    if state != session.modules:
+        if session.modules is not None:
+            print('Input files have changed. Reloading...')
+        # pulseFun.py is imported from the working directory
+        if os.getcwd() in sys.path:
+            sys.path.remove(os.getcwd())
+        sys.path.insert(0, os.getcwd())
+        sys.modules.pop('pulseFun', None)
+        for name in ['vezda.data_utils'] + list(COMMANDS.values()):
+            if name in sys.modules:
+                importlib.reload(sys.modules[name])
+        session.modules = state
+
+    return importlib.import_module(COMMANDS[command])
+
+
+def run_command(conn, message):
+    from vezda.profile_utils import finish_profiling
+
+    stdout, stderr, argv, stdin = sys.stdout, sys.stderr, sys.argv, builtins.input
+    sys.stdout = Stream(conn, 'stdout')
+    sys.stderr = Stream(conn, 'stderr')
+
+    def remote_input(prompt=''):
+        conn.send(('input', prompt))
+        answer = conn.recv()
+        if answer is None:
+            raise EOFError
+        return answer
+    builtins.input = remote_input
+
+    status = 0
+    cwd = os.getcwd()
+    try:
+        os.chdir(message['cwd'])
+        module = reload_modules(message['command'])
+        sys.argv = [message['command']] + message['argv']
+        module.cli()
+    except SystemExit as e:
+        status = e.code
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            finish_profiling()
+        except Exception:
+            traceback.print_exc()
+        sys.stdout, sys.stderr, sys.argv, builtins.input = stdout, stderr, argv, stdin
+        os.chdir(cwd)
+
+    conn.send(('exit', status))
+
+
+def serve():
+    '''
+    Runs the session server until it receives a 'stop' request.
+    '''
+    if request('status') is not None:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: A Vezda session is already running. Stop it with \'vezda serve --stop\'.
+                '''))
+
+    directory = session_directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    authkey = os.urandom(32)
+    if hasattr(os, 'fork') and sys.platform != 'win32':
+        family = 'AF_UNIX'
+        address = str(directory / ('session-%d.sock' %(os.getpid())))
+    else:
+        family = 'AF_INET'
+        address = ('localhost', 0)
+    listener = Listener(address, family=family, authkey=authkey)
+
+    # only the current user may read the session file (it holds the key)
+    info = {'family': family, 'address': listener.address, 'authkey': authkey.hex(), 'pid': os.getpid()}
+    fd = os.open(str(session_file()), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(info, f)
+
+    session.active = True
+    print('Vezda session server running (pid %d). Stop it with \'vezda serve --stop\'...' %(os.getpid()))
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError):
+                # failed authentication or a dropped connection
+                continue
+            with conn:
+                try:
+                    message = conn.recv()
+                    if message['request'] == 'run':
+                        print('Running \'%s %s\' in %s...' %(message['command'], ' '.join(message['argv']),
+                                                          message['cwd']))
+                        run_command(conn, message)
+                    elif message['request'] == 'status':
+                        conn.send({'pid': os.getpid(), 'cached': len(session.cache)})
+                    elif message['request'] == 'stop':
+                        conn.send({'pid': os.getpid()})
+                        break
+                except (OSError, EOFError):
+                    # the client went away
+                    continue
+    finally:
+        listener.close()
+        if read_session_file() == info:
+            session_file().unlink()
+        print('Vezda session server stopped.')
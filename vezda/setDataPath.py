@@ -20,6 +20,7 @@ import textwrap
 import numpy as np
 from pathlib import Path
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzdata:' + FontColor.END
@@ -32,7 +33,9 @@ def cli():
     parser.add_argument('--path', type=str, default=None,
                         help='''specify the path to the directory containing the
                         experimental data.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzdata')
     
     if args.path is None:
         if not Path('datadir.npz').exists():
@@ -18,6 +18,8 @@ import argparse
 import textwrap
 import numpy as np
 from vezda.plot_utils import FontColor
+from vezda.sampling_utils import load_points_file, mask_from_file, mask_from_polygon
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzgrid:' + FontColor.END
@@ -63,16 +65,107 @@ def cli():
                         help='Specify how the number of search points along the z-axis.')
     
     
-    parser.add_argument('--tau', type=float, default=None,
-                        help='''Specify the focusing time. (Default is zero.)
-                        Syntax: --tau=value.''')
+    parser.add_argument('--tau', type=str, default=None,
+                        help='''Specify the focusing time. (Default is zero.) A comma-separated
+                        list of focusing times produces one image per focusing time in a single
+                        \'vzsolve\' run. Syntax: --tau=value or --tau=value1,value2,...''')
+    
+    
+    parser.add_argument('--mask', type=str, default=None,
+                        help='''Restrict the search grid to a region of interest. Specify a file
+                        containing either a boolean volume with the shape of the search grid or
+                        a list of point coordinates (snapped to the nearest grid points). Files
+                        may be binary NumPy \'.npy\' or plain text. Use --mask=none to remove
+                        the region of interest. Syntax: --mask=file.''')
+    parser.add_argument('--polygon', type=str, default=None,
+                        help='''Restrict the search grid to the interior of a polygon (2D) or the
+                        convex hull of a polyhedron (3D). Specify a file containing the vertices
+                        as an N x 2 or N x 3 array. Syntax: --polygon=file.''')
+    parser.add_argument('--points', type=str, default=None,
+                        help='''Use an unstructured cloud of search points instead of a grid.
+                        Specify a file containing an N x 2 or N x 3 array of point coordinates.
+                        Syntax: --points=file.''')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    enable_profiling(args, 'vzgrid')
+    
+    if args.tau is not None:
+        try:
+            tau = np.array([float(t) for t in args.tau.split(',')])
+        except ValueError:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Focusing times must be real numbers.
+                    Syntax: --tau=value or --tau=value1,value2,...
+                    '''))
+        if len(tau) == 1:
+            args.tau = tau[0]
+        else:
+            args.tau = tau
     
     try:
         searchGrid = np.load('searchGrid.npz')
     except FileNotFoundError:
         searchGrid = None
     
+    #==============================================================================
+    # set up an unstructured cloud of search points
+    if args.points is not None and args.points != 'none':
+        if any(v is not None for v in [args.xaxis, args.xstart, args.xstop, args.nx,
+                                       args.yaxis, args.ystart, args.ystop, args.ny,
+                                       args.zaxis, args.zstart, args.zstop, args.nz,
+                                       args.mask, args.polygon]):
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Cannot use --points together with the grid or region-of-interest
+                    arguments. An unstructured cloud of search points replaces the grid.
+                    '''))
+        try:
+            points = load_points_file(args.points)
+        except OSError as err:
+            sys.exit('\nError: %s\n' %(err))
+        if points.ndim != 2 or points.shape[1] not in [2, 3]:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The file of search points must contain an N x 2 or N x 3 array
+                    of point coordinates.
+                    '''))
+        if args.tau is not None:
+            tau = args.tau
+        elif searchGrid is not None:
+            tau = searchGrid['tau']
+        else:
+            tau = 0
+        
+        print('\nSetting up unstructured %dD search points:\n' %(points.shape[1]))
+        print('number of search points =', points.shape[0], '\n')
+        print('focusing time : tau =', tau, '\n')
+        np.savez('searchGrid.npz', points=points, tau=tau)
+        sys.exit()
+    
+    elif searchGrid is not None and 'points' in searchGrid:
+        if not len(sys.argv) > 1:
+            points = searchGrid['points']
+            print('\nCurrent search points:\n')
+            print('*** %dD space, unstructured ***\n' %(points.shape[1]))
+            print('number of search points =', points.shape[0], '\n')
+            print('focusing time : tau =', searchGrid['tau'], '\n')
+            sys.exit()
+        
+        elif all(v is None for v in [args.xaxis, args.xstart, args.xstop, args.nx,
+                                     args.yaxis, args.ystart, args.ystop, args.ny,
+                                     args.zaxis, args.zstart, args.zstop, args.nz,
+                                     args.mask, args.polygon]):
+            # only the focusing time is updated
+            tau = args.tau if args.tau is not None else searchGrid['tau']
+            print('focusing time : tau =', tau, '\n')
+            np.savez('searchGrid.npz', points=searchGrid['points'], tau=tau)
+            sys.exit()
+        
+        else:
+            # the unstructured points are replaced by a new search grid
+            searchGrid = None
+    
     #==============================================================================
     if not len(sys.argv) > 1:   # no arguments were passed...
         if searchGrid is None:    # and a search grid doesn't exist...
@@ -117,6 +210,9 @@ def cli():
                 print('grid @ z-axis : num =', znum, '\n')
                 
                 print('focusing time : tau =', tau, '\n')
+                if 'mask' in searchGrid:
+                    print('region of interest :', np.count_nonzero(searchGrid['mask']),
+                          'of', xnum * ynum * znum, 'search points\n')
                 sys.exit()
             
             else:
@@ -133,6 +229,9 @@ def cli():
                 print('grid @ y-axis : num =', ynum, '\n')
                 
                 print('focusing time : tau =', tau, '\n')
+                if 'mask' in searchGrid:
+                    print('region of interest :', np.count_nonzero(searchGrid['mask']),
+                          'of', xnum * ynum, 'search points\n')
                 sys.exit()
                 
     else:   # arguments were passed with 'vzgrid' call
@@ -635,6 +734,40 @@ def cli():
     except NameError:
         z = None
     
+    #==============================================================================
+    # set/update the region of interest
+    if z is None:
+        axes = [x, y]
+    else:
+        axes = [x, y, z]
+    
+    mask = None
+    if args.mask == 'none' or args.polygon == 'none':
+        print('\nRemoving region of interest...')
+    
+    elif args.mask is not None or args.polygon is not None:
+        mask = np.ones(np.prod([len(ax) for ax in axes]), dtype=bool)
+        try:
+            if args.mask is not None:
+                mask &= mask_from_file(args.mask, axes)
+            if args.polygon is not None:
+                mask &= mask_from_polygon(args.polygon, axes)
+        except (OSError, ValueError) as err:
+            sys.exit('\nError: %s\n' %(err))
+        
+        if not np.any(mask):
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The region of interest does not contain any search points.
+                    '''))
+    
+    elif searchGrid is not None and 'mask' in searchGrid:
+        if len(searchGrid['mask']) == np.prod([len(ax) for ax in axes]):
+            mask = searchGrid['mask']
+        else:
+            print('''\nWarning: The search grid has changed size. The previous region of
+                  interest no longer applies and has been removed.''')
+    
     if z is None:
         print('\nSetting up 2D search grid:\n')
         print('grid @ x-axis : start =', xstart)
@@ -646,7 +779,11 @@ def cli():
         print('grid @ y-axis : num =', ynum, '\n')
         
         print('focusing time : tau =', tau, '\n')
-        np.savez('searchGrid.npz', x=x, y=y, tau=tau)
+        if mask is not None:
+            print('region of interest :', np.count_nonzero(mask), 'of', len(mask), 'search points\n')
+            np.savez('searchGrid.npz', x=x, y=y, tau=tau, mask=mask)
+        else:
+            np.savez('searchGrid.npz', x=x, y=y, tau=tau)
     
     else:                    
         print('\nSetting up 3D search grid:\n')
@@ -663,4 +800,8 @@ def cli():
         print('grid @ z-axis : num =', znum, '\n')
         
         print('focusing time : tau =', tau, '\n')
-        np.savez('searchGrid.npz', x=x, y=y, z=z, tau=tau)
\ No newline at end of file
+        if mask is not None:
+            print('region of interest :', np.count_nonzero(mask), 'of', len(mask), 'search points\n')
+            np.savez('searchGrid.npz', x=x, y=y, z=z, tau=tau, mask=mask)
+        else:
+            np.savez('searchGrid.npz', x=x, y=y, z=z, tau=tau)
\ No newline at end of file
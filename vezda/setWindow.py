@@ -14,11 +14,13 @@
 #==============================================================================
 
 import sys
+import pickle
 import argparse
 import textwrap
 import numpy as np
 from pathlib import Path
 from vezda.plot_utils import FontColor
+from vezda.profile_utils import add_profile_arguments, enable_profiling
 
 def info():
     commandName = FontColor.BOLD + 'vzwindow:' + FontColor.END
@@ -73,7 +75,9 @@ def cli():
                         Must be a positive integer greater than or equal to 1 (default).
                         (e.g., --step=2 will use every other source in the window.''')
                         
-    args = parser.parse_args()    
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    enable_profiling(args, 'vzwindow')
         
     if Path('datadir.npz').exists():
         datadir = np.load('datadir.npz')
@@ -1198,6 +1202,29 @@ def cli():
         print('window @ %s : stop = %s' %(slabel, sstop))
         print('window @ %s : step = %s\n' %(slabel, sstep))
             
+        # A selection of frequencies (see 'vezda frequencies') is made among the
+        # frequency bins of the time window, so it is cleared when that changes.
+        # A coarser time step also lowers the Nyquist frequency, so the upper
+        # end of the frequency window is clamped to it.
+        if windowDict is None:
+            previous = (recordingTimes[0], recordingTimes[-1], 1)
+        else:
+            previous = (windowDict['tstart'], windowDict['tstop'], windowDict['tstep'])
+        if (tstart, tstop, tstep) != previous and Path('plotParams.pkl').exists():
+            plotParams = pickle.load(open('plotParams.pkl', 'rb'))
+            changed = False
+            if plotParams.get('frequencies') is not None:
+                plotParams['frequencies'] = None
+                changed = True
+                print('The time window changed: cleared the selection of frequencies...\n')
+            nyquist = 1.0 / (2 * tstep * (recordingTimes[1] - recordingTimes[0]))
+            if plotParams.get('fmax') is not None and plotParams['fmax'] > nyquist:
+                plotParams['fmax'] = nyquist
+                changed = True
+                print('The time step changed: lowered the maximum frequency to the Nyquist frequency %0.2f...\n' %(nyquist))
+            if changed:
+                pickle.dump(plotParams, open('plotParams.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+        
         np.savez('window.npz',
                  tstart=tstart,
                  tstop=tstop,
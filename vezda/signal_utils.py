@@ -14,8 +14,10 @@
 #==============================================================================
 
 import numpy as np
+from scipy.fft import irfft
 from scipy.signal import butter, sosfiltfilt, tukey, welch
-from vezda.math_utils import nextPow2
+from vezda.math_utils import nextPow2, complex_dtype
+from vezda.outofcore_utils import BLOCK_BYTES
 
 def butter_bandpass(lowcut, highcut, fs, order=1):
     nyq = 0.5 * fs
@@ -48,7 +50,7 @@ def band_limited_noise(min_freq, max_freq, samples=1024, samplerate=1):
     return fftnoise(f)
 
 
-def add_noise(data, dt, min_freq, max_freq, snr=2):
+def add_noise(data, dt, min_freq, max_freq, snr=2, seed=None, out=None, blockSize=None):
     '''
     data: 3D input array of shape Nr x Nt x Ns
     Nr: number of receivers
@@ -58,21 +60,54 @@ def add_noise(data, dt, min_freq, max_freq, snr=2):
     min_freq: minimum frequency component of the generated noise
     max_freq: maximum frequency component of the generated noise
     snr: specified signal-to-noise ratio
+    seed: seed of the random number generator (see numpy.random.default_rng)
+    out: array (e.g., memory-mapped) to which the noisy data are written
+    blockSize: number of sources for which noise is generated at a time
+    
+    The noise of each trace has unit spectral magnitude in the frequency band
+    and uniformly random phases (as band_limited_noise). It is synthesized for
+    blocks of sources with one batched inverse FFT per block. The random
+    phases are drawn source by source, so the noise depends only on the seed
+    and not on the block size.
     '''
     
     Nr, Nt, Ns = data.shape
+    rng = np.random.default_rng(seed)
+    
+    # frequency bins of the band (the zero and Nyquist frequencies are real)
+    freqs = np.fft.rfftfreq(Nt, dt)
+    band = np.flatnonzero((freqs >= min_freq) & (freqs <= max_freq))
+    real = (band == 0) | ((Nt % 2 == 0) & (band == Nt // 2))
+    
+    # power of each noise trace (the same for all traces by Parseval's
+    # theorem, as the spectral magnitudes are fixed)
+    noisePower = (2 * len(band) - np.count_nonzero(real)) / Nt
+    
+    if out is None:
+        out = np.zeros((Nr, Nt, Ns), dtype=data.dtype)
+    if blockSize is None:
+        itemsize = np.dtype(complex_dtype(data.dtype)).itemsize
+        blockSize = max(1, BLOCK_BYTES // (Nr * len(freqs) * itemsize))
     
-    # average signal power per recording
-    signalPower = np.sum(data**2, axis=(0, 1)) / Nr
-    noisyData = np.zeros((Nr, Nt, Ns), dtype=data.dtype)
-    for r in range(Nr):
-        for s in range(Ns):
-            noise = band_limited_noise(min_freq, max_freq, Nt, 1 / dt)
-            noisePower = np.sum(noise**2)
-            scale = np.sqrt(signalPower[s] / (noisePower * snr))
-            noisyData[r, :, s] = data[r, :, s] + scale * noise
+    for start in range(0, Ns, blockSize):
+        stop = min(start + blockSize, Ns)
+        block = np.asarray(data[:, :, start:stop])
+        
+        # the noise is synthesized in the layout of the data (Nr x Nt x b)
+        phases = np.transpose(rng.random((stop - start, Nr, len(band))), (1, 2, 0))
+        spectrum = np.zeros((Nr, len(freqs), stop - start), dtype=complex)
+        spectrum[:, band, :] = np.exp(2j * np.pi * phases)
+        spectrum[:, band[real], :] = 1
+        noise = irfft(spectrum, n=Nt, axis=1, workers=-1)
+        del spectrum
+        
+        # average signal power per recording
+        signalPower = np.sum(block**2, axis=(0, 1)) / Nr
+        noise *= np.sqrt(signalPower / (noisePower * snr))
+        noise += block
+        out[:, :, start:stop] = noise
     
-    return noisyData
+    return out
 
 
 def compute_spectra(data, dt, scaling='amp', nseg=1):
@@ -112,3 +147,102 @@ def tukey_taper(X, dt, peakFreq):
     X *= TukeyWindow[None, :, None]
     
     return X
+
+
+def frequency_window(N, dt, fmin, fmax, frequencies=None):
+    '''
+    Returns the indices of the rfft frequency bins (for a transform of length N
+    and sampling interval dt) that lie inside the frequency window [fmin, fmax).
+    If a selection of frequencies is given (see select_frequencies), only
+    the bins of the selected frequencies are kept.
+    '''
+    df = 1.0 / (N * dt)
+    startIndex = int(round(fmin / df))
+    # the last rfft bin (the Nyquist frequency) is N // 2
+    stopIndex = min(int(round(fmax / df)), N // 2 + 1)
+    finterval = np.arange(startIndex, stopIndex, 1)
+    
+    if frequencies is not None:
+        selected = np.round(np.asarray(frequencies) / df).astype(int)
+        finterval = finterval[np.isin(finterval, selected)]
+    
+    return finterval
+
+
+def select_frequencies(energy, step=1, fraction=None, count=None):
+    '''
+    Selects an informative subset of the frequencies of a frequency window.
+    
+    energy: energy of the data at each frequency of the window (the sum of the
+            squared singular values of each frequency block of the near-field
+            operator)
+    step: keep every step-th frequency only (decimation)
+    fraction: keep the fewest (decimated) frequencies that hold this fraction
+              of the energy
+    count: keep at most this many frequencies, those of the largest energy
+    
+    Returns the sorted indices of the selected frequencies in the window.
+    '''
+    candidates = np.arange(0, len(energy), step)
+    # candidates in order of decreasing energy
+    candidates = candidates[np.argsort(energy[candidates], kind='stable')[::-1]]
+    
+    if fraction is not None:
+        cumulative = np.cumsum(energy[candidates])
+        n = np.searchsorted(cumulative, fraction * cumulative[-1]) + 1
+        candidates = candidates[:n]
+    if count is not None:
+        candidates = candidates[:count]
+    
+    return np.sort(candidates)
+
+
+def fft_window(X, dt, fmin, fmax, double_length=False, frequencies=None):
+    '''
+    Transforms X (time on axis=1) into the frequency domain and keeps the
+    frequencies inside the window [fmin, fmax) (only the selected ones if a
+    selection of frequencies is given). The transform is zero-padded
+    to a power of 2 (of at least twice the length of X if double_length).
+    The transform has the precision of X.
+    '''
+    if double_length:
+        N = nextPow2(2 * X.shape[1])
+    else:
+        N = nextPow2(X.shape[1])
+    
+    dtype = complex_dtype(X.dtype)
+    X = np.fft.rfft(X, n=N, axis=1)[:, frequency_window(N, dt, fmin, fmax, frequencies), :]
+    
+    return X.astype(dtype, copy=False)
+
+
+ENCODINGS = ['rademacher', 'gaussian']
+
+def encode_sources(X, Ne, encoding='rademacher', per_frequency=False, seed=None):
+    '''
+    Simultaneous-source encoding: replaces the Ns source gathers of X (Nr x Nm
+    x Ns, sources on axis=2) by Ne < Ns random combinations of them, so that
+    the near-field operator formed by X has Ne instead of Ns columns.
+    
+    encoding: 'rademacher' (random signs) or 'gaussian' weights, scaled by
+              1/sqrt(Ne) so that the encoded operator N W satisfies
+              E[N W W^T N^H] = N N^H
+    per_frequency: draw a different encoding for each frequency (frequency
+                   domain only)
+    seed: seed of the random number generator (for reproducible encodings)
+    
+    The encoding has the precision of X.
+    '''
+    Nr, Nm, Ns = X.shape
+    rng = np.random.default_rng(seed)
+    shape = (Nm, Ns, Ne) if per_frequency else (Ns, Ne)
+    if encoding == 'rademacher':
+        W = rng.choice([-1.0, 1.0], size=shape)
+    elif encoding == 'gaussian':
+        W = rng.standard_normal(shape)
+    W = (W / np.sqrt(Ne)).astype(np.finfo(X.dtype).dtype)
+    
+    if per_frequency:
+        # one Nr x Ns block per frequency, encoded by its own weights
+        return np.ascontiguousarray(np.transpose(np.matmul(np.transpose(X, (1, 0, 2)), W), (1, 0, 2)))
+    return np.matmul(X, W)
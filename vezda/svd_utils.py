@@ -2,10 +2,14 @@ import sys
 import time
 import numpy as np
 import scipy.sparse as sp
-from vezda.math_utils import humanReadable
+from vezda.math_utils import humanReadable, convolution_length
+from vezda.checkpoint_utils import fingerprint
 from vezda.LinearOperators import asConvolutionalOperator
+from vezda.profile_utils import profiled
+from vezda.session_utils import cached
 
-def compute_svd(kernel, k, operatorName):
+@profiled('svd')
+def compute_svd(kernel, k, operatorName, save=True):
     A = asConvolutionalOperator(kernel)
     
     if k_is_valid(k, min(A.shape)):
@@ -20,24 +24,26 @@ def compute_svd(kernel, k, operatorName):
             print('Computing SVD of the %s for %s singular values/vectors...' %(name, k))
         
         startTime = time.time()
-        U, s, Vh = sp.linalg.svds(A, k, which='LM')
+        if np.issubdtype(kernel.dtype, np.complexfloating):
+            # In the frequency domain the operator is block diagonal, so its
+            # singular system is assembled exactly from the block SVDs
+            # (already sparse for efficient storage)
+            U, s, Vh = assemble_svd(*compute_block_svd(kernel), k)
+        
+        else:
+            U, s, Vh = sp.linalg.svds(A, k, which='LM')
+            
+            # sort the singular values and corresponding vectors in descending order
+            # (i.e., largest to smallest)
+            index = s.argsort()[::-1]   
+            s = s[index]
+            U = U[:, index]
+            Vh = Vh[index, :]
         endTime = time.time()
         print('Elapsed time:', humanReadable(endTime - startTime))
-        
-        # sort the singular values and corresponding vectors in descending order
-        # (i.e., largest to smallest)
-        index = s.argsort()[::-1]   
-        s = s[index]
-        U = U[:, index]
-        Vh = Vh[index, :]
-        
-        if np.issubdtype(U.dtype, np.complexfloating):
-            # Exploit sparseness of SVD in frequency domain for efficient storage
-            Nr, Ns = kernel.shape[0], kernel.shape[2]
-            U = make_sparse(U, Nr, 'csc')
-            Vh = make_sparse(Vh, Ns, 'csr')
     
-        save_svd(U, s, Vh, operatorName)
+        if save:
+            save_svd(U, s, Vh, operatorName, kernel)
         
         return U, s, Vh
     
@@ -45,13 +51,116 @@ def compute_svd(kernel, k, operatorName):
         sys.exit()
 
 
-def save_svd(U, s, Vh, operatorName):
+@profiled('block svd')
+@cached
+def compute_block_svd(kernel):
+    '''
+    Compute the singular-value decomposition of a frequency-domain operator
+    block by block. In the frequency domain the convolutional operator is
+    block diagonal, with one Nr x Ns block per frequency, so its singular
+    system is the union of the singular systems of the (small) blocks.
+    
+    kernel: a complex 3D array of shape Nr x Nm x Ns
+    
+    Output: U (Nm x Nr x r), s (Nm x r), Vh (Nm x r x Ns), where r = min(Nr, Ns)
+    and the first axis indexes the frequency blocks.
+    '''
+    print('Computing SVD of each frequency block of the operator...')
+    startTime = time.time()
+    U, s, Vh = np.linalg.svd(np.transpose(kernel, (1, 0, 2)), full_matrices=False)
+    endTime = time.time()
+    print('Elapsed time:', humanReadable(endTime - startTime))
+    
+    return U, s, Vh
+
+
+def assemble_svd(Ub, sb, Vhb, k):
+    '''
+    Assemble the k largest singular values/vectors of a frequency-domain
+    operator from the SVDs of its frequency blocks (see compute_block_svd).
+    Each singular vector is nonzero on a single frequency block only, so the
+    singular vectors are returned as sparse matrices in the same form as
+    compute_svd.
+    
+    Output: U (sparse csc, Nm*Nr x k), s (k), Vh (sparse csr, k x Nm*Ns)
+    with the singular values in descending order.
+    '''
+    Nm, Nr, r = Ub.shape
+    Ns = Vhb.shape[2]
+    
+    # frequency block and index within the block of the k largest values
+    index = np.argsort(-sb, axis=None, kind='stable')[:k]
+    m, j = np.divmod(index, r)
+    s = sb[m, j]
+    
+    # operator rows/columns are ordered time/frequency-fastest (order='F')
+    rows = (m[None, :] + Nm * np.arange(Nr)[:, None]).reshape(-1, order='F')
+    cols = np.repeat(np.arange(k), Nr)
+    U = sp.csc_matrix((Ub[m, :, j].reshape(-1), (rows, cols)), shape=(Nm * Nr, k))
+    
+    rows = np.repeat(np.arange(k), Ns)
+    cols = (m[:, None] + Nm * np.arange(Ns)[None, :]).reshape(-1)
+    Vh = sp.csr_matrix((Vhb[m, j, :].reshape(-1), (rows, cols)), shape=(k, Nm * Ns))
+    
+    return U, s, Vh
+
+
+@profiled('block tikhonov inverse')
+@cached
+def block_tikhonov_inverse(U, s, Vh, alpha):
+    '''
+    Assemble the Tikhonov-regularized inverse (A^H A + alpha I)^(-1) A^H of each
+    frequency block from its singular-value decomposition:
+        
+        V diag(s / (s**2 + alpha)) U^H
+    
+    Singular values that vanish to machine precision are discarded, so that
+    alpha = 0 yields the pseudoinverse of each block.
+    
+    Output: a 3D array of shape Nm x Ns x Nr
+    '''
+    tol = np.finfo(s.dtype).eps * max(U.shape[1], Vh.shape[2]) * np.max(s)
+    filterFactors = np.divide(s, alpha + s**2, out=np.zeros_like(s), where=s > tol)
+    
+    return np.matmul(Vh.conj().transpose(0, 2, 1) * filterFactors[:, None, :],
+                     U.conj().transpose(0, 2, 1))
+
+
+def svd_fingerprint(kernel, operatorName):
+    '''
+    Returns a hash identifying the operator with the given kernel: its
+    contents, precision and the length of the FFTs of the (time-domain)
+    operator (see asConvolutionalOperator).
+    '''
+    if np.issubdtype(kernel.dtype, np.floating):
+        fftLength = convolution_length(kernel.shape[1])
+    else:
+        fftLength = None
+    return fingerprint({'operator': operatorName, 'fft': fftLength}, kernel)
+
+
+def svd_matches(filename, kernel, operatorName):
+    '''
+    Checks whether the SVD saved to a file was computed for the operator with
+    the given kernel (SVDs saved without a fingerprint never match).
+    '''
+    with np.load(filename) as loader:
+        if 'fingerprint' not in loader.files:
+            return False
+        return str(loader['fingerprint']) == svd_fingerprint(kernel, operatorName)
+
+
+def save_svd(U, s, Vh, operatorName, kernel):
     
     if operatorName == 'nfo':
         filename = 'NFO_SVD.npz'
     elif operatorName == 'lso':
         filename = 'LSO_SVD.npz'
     
+    # identifies the operator, so that the SVD is only reused (or extended)
+    # for the same one
+    key = svd_fingerprint(kernel, operatorName)
+    
     if np.issubdtype(U.dtype, np.complexfloating): 
         # singular vectors are complex
         # store as sparse matrices
@@ -61,14 +170,15 @@ def save_svd(U, s, Vh, operatorName):
                  U_shape=U.shape,
                  Vh_data=Vh.data, Vh_indices=Vh.indices, Vh_indptr=Vh.indptr,
                  Vh_shape=Vh.shape,
-                 s=s, domain=domain)
+                 s=s, domain=domain, fingerprint=key)
     
     else:
         # singular vectors are real
         domain = 'time'
-        np.savez(filename, U=U, s=s, Vh=Vh, domain=domain)        
+        np.savez(filename, U=U, s=s, Vh=Vh, domain=domain, fingerprint=key)
     
 
+@cached
 def load_svd(filename):
     print('Attempting to load SVD...', end='')
     try:
@@ -145,15 +255,111 @@ def k_is_valid(k, maxVals):
         return False
 
 
+def operator_shape(kernel):
+    # shape of the convolutional operator with the given kernel
+    # (see asConvolutionalOperator)
+    Nr, Nm, Ns = kernel.shape
+    if np.issubdtype(kernel.dtype, np.floating):
+        Nm = 2 * Nm - 1
+    return Nr * Nm, Ns * Nm
+
+
 def svd_needs_recomputing(kernel, k, U, s, Vh):
+    if s.dtype == np.float32 and np.finfo(kernel.dtype).bits > 32:
+        # a single-precision SVD cannot be used for a double-precision solve
+        print('SVD was saved in single precision: SVD needs recomputing...')
+        return True
+    
     if k is None:
         return False
     
-    Nr, Nm, Ns = kernel.shape
-    M, N = Nr * Nm, Ns * Nm
+    M, N = operator_shape(kernel)
     if k_is_valid(k, min(M, N)):
         if ((M, k), (k, N)) == (U.shape, Vh.shape) and k == len(s):
             return False
+        elif svd_is_reusable(kernel, U, s, Vh):
+            print('SVD has %s singular values/vectors: SVD needs updating...' %(len(s)))
+            return True
         else:
             print('Inconsistent dimensions: SVD needs recomputing...')
             return True
+
+
+def svd_is_reusable(kernel, U, s, Vh):
+    '''
+    Checks whether a (partial) SVD belongs to an operator of the same shape
+    and precision as the one with the given kernel, so that it can be
+    truncated or extended to a different number of singular values/vectors
+    instead of being recomputed (see update_svd). That it belongs to this
+    very operator is checked with svd_matches.
+    '''
+    if s.dtype == np.float32 and np.finfo(kernel.dtype).bits > 32:
+        return False
+    M, N = operator_shape(kernel)
+    return U.shape[0] == M and Vh.shape[1] == N and U.shape[1] == Vh.shape[0] == len(s)
+
+
+def deflated_operator(A, Vh):
+    '''
+    Returns the operator A P, where P = I - V V^H projects out the known right
+    singular vectors V (rows of Vh). The singular values/vectors of A P are
+    those of A with the known triplets removed, so its largest singular
+    values are the next largest ones of A.
+    '''
+    if sp.issparse(Vh):
+        Vh = Vh.toarray()
+    V = Vh.conj().T
+    
+    def project(X):
+        return X - V @ (Vh @ X)
+    
+    return sp.linalg.LinearOperator(shape=A.shape, dtype=A.dtype,
+                                    matvec=lambda x : A.matvec(project(x.reshape(-1, 1))),
+                                    rmatvec=lambda y : project(A.rmatvec(y).reshape(-1, 1)),
+                                    matmat=lambda X : A.matmat(project(X)),
+                                    rmatmat=lambda Y : project(A.rmatmat(Y)))
+
+
+def update_svd(kernel, k, U, s, Vh, operatorName, save=True):
+    '''
+    Updates a partial SVD (U, s, Vh) of the operator with the given kernel to
+    k singular values/vectors. If k is smaller than the number of singular
+    values already known, the SVD is truncated. Otherwise only the new
+    triplets are computed: in the time domain from the operator with the known
+    triplets deflated (see deflated_operator), and in the frequency domain
+    from the (cached) block SVDs.
+    '''
+    k0 = len(s)
+    if k <= k0:
+        print('Truncating SVD from %s to %s singular values/vectors...' %(k0, k))
+        U, s, Vh = U[:, :k], s[:k], Vh[:k, :]
+    
+    elif np.issubdtype(kernel.dtype, np.complexfloating):
+        # assembling the SVD from the block SVDs costs the same for any k
+        return compute_svd(kernel, k, operatorName, save)
+    
+    else:
+        A = asConvolutionalOperator(kernel)
+        if not k_is_valid(k, min(A.shape)):
+            sys.exit()
+        
+        print('Extending SVD from %s to %s singular values/vectors...' %(k0, k))
+        startTime = time.time()
+        Un, sn, Vhn = sp.linalg.svds(deflated_operator(A, Vh), k - k0, which='LM')
+        endTime = time.time()
+        print('Elapsed time:', humanReadable(endTime - startTime))
+        
+        # merge and sort the singular values and corresponding vectors in
+        # descending order (i.e., largest to smallest)
+        s = np.concatenate((s, sn.astype(s.dtype, copy=False)))
+        U = np.concatenate((U, Un.astype(U.dtype, copy=False)), axis=1)
+        Vh = np.concatenate((Vh, Vhn.astype(Vh.dtype, copy=False)), axis=0)
+        index = s.argsort(kind='stable')[::-1]
+        s = s[index]
+        U = U[:, index]
+        Vh = Vh[index, :]
+    
+    if save:
+        save_svd(U, s, Vh, operatorName, kernel)
+    
+    return U, s, Vh
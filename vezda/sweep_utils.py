@@ -0,0 +1,313 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import io
+import sys
+import time
+import tempfile
+import itertools
+import textwrap
+import numpy as np
+from contextlib import redirect_stdout, redirect_stderr
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.linalg import norm
+from vezda.math_utils import timeShift, humanReadable, nextPow2
+from vezda.signal_utils import fft_window
+from vezda.LinearSamplingClass import LinearSamplingProblem
+
+# parameters that may be swept over and those that determine the operator
+PARAMETERS = ['alpha', 'tau', 'fmin', 'fmax', 'rstep', 'sstep', 'method']
+OPERATOR_PARAMETERS = ['fmin', 'fmax', 'rstep', 'sstep']
+
+def configurations(grid, equation):
+    '''
+    Returns the configurations of a parameter grid (the Cartesian product of
+    the parameter values) grouped by the operator they share. For the
+    near-field equation, configurations that differ only in the focusing time,
+    method or regularization parameter share the operator (data) and any
+    factorization of it. For the Lippmann-Schwinger equation the impulse
+    responses form the operator, so the focusing time is part of the group.
+
+    grid: dictionary mapping the parameter names (see PARAMETERS) to lists of
+          values. The frequency window is given by 'band', a list of
+          (fmin, fmax) pairs.
+    '''
+    keys = OPERATOR_PARAMETERS if equation == 'nfe' else OPERATOR_PARAMETERS + ['tau']
+    groups = OrderedDict()
+    index = 0
+    for (fmin, fmax), rstep, sstep, tau, method, alpha in itertools.product(
+            grid['band'], grid['rstep'], grid['sstep'], grid['tau'], grid['method'], grid['alpha']):
+        config = {'index': index, 'alpha': alpha, 'tau': tau, 'fmin': fmin, 'fmax': fmax,
+                  'rstep': rstep, 'sstep': sstep, 'method': method}
+        groups.setdefault(tuple(config[k] for k in keys), []).append(config)
+        index += 1
+
+    groups = list(groups.values())
+    for g, group in enumerate(groups):
+        for config in group:
+            config['group'] = g
+        # solve all configurations of a focusing time before moving to the next
+        group.sort(key=lambda c : (c['tau'], c['method'], c['alpha']))
+
+    return groups
+
+
+#==============================================================================
+# Inputs are placed in shared memory once and attached by the workers
+def share(array):
+    memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+
+def attach(descriptor):
+    name, shape, dtype = descriptor
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def solve_group(group, inputs, settings):
+    '''
+    Solves the configurations of a group, which share an operator. Runs in a
+    worker process and returns one result per configuration: the image at the
+    active search points and the metrics of the solve.
+
+    inputs: shared-memory descriptors of the windowed (and tapered) time-domain
+            data and impulse responses (for the focusing time settings['tau0'])
+    settings: dictionary with the equation, domain, time step dt, selection of
+              frequencies (see 'vezda frequencies'), tolerances, number of
+              singular values k and impulse response normalization
+    '''
+    memories = []
+    try:
+        memory, data = attach(inputs['data'])
+        memories.append(memory)
+        memory, impulseResponses = attach(inputs['impulseResponses'])
+        memories.append(memory)
+
+        first = group[0]
+        # receiver and source decimation (receivers include any reciprocal receivers)
+        data = np.array(data[::first['rstep'], :, ::first['sstep']])
+        impulseResponses = np.array(impulseResponses[::first['rstep'], :, :])
+    finally:
+        # the decimated arrays are copies
+        for memory in memories:
+            memory.close()
+
+    dt = settings['dt']
+    def transform(X, double_length):
+        if settings['domain'] == 'freq':
+            return fft_window(X, dt, first['fmin'], first['fmax'], double_length,
+                              frequencies=settings['frequencies'])
+        return X
+
+    def rhs(tau):
+        # impulse responses for the focusing time tau
+        X = impulseResponses
+        if tau != settings['tau0']:
+            X = timeShift(X, tau - settings['tau0'], dt)
+        X = transform(X, double_length=False)
+        if settings['ngs'] and settings['equation'] == 'nfe':
+            X = X / norm(X, axis=(0, 1))[None, None, :]
+        return X
+
+    if settings['equation'] == 'nfe':
+        p = LinearSamplingProblem('nfo', transform(data, double_length=True), rhs(first['tau']))
+    else:
+        data = transform(data, double_length=True)
+        if settings['domain'] == 'time':
+            # pad data to the length of the circular convolution (see Solve.py)
+            data = np.pad(data, ((0, 0), (data.shape[1] - 1, 0), (0, 0)), mode='constant')
+        p = LinearSamplingProblem('lso', rhs(first['tau']), data)
+    tau = first['tau']
+
+    results = []
+    cwd = os.getcwd()
+    # the 'svd' method saves the SVD of the operator to the working directory
+    # (progress output of the solvers is discarded)
+    with tempfile.TemporaryDirectory() as tmp, redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        os.chdir(tmp)
+        try:
+            for config in group:
+                if settings['equation'] == 'nfe' and config['tau'] != tau:
+                    tau = config['tau']
+                    p.B = rhs(tau)
+                startTime = time.perf_counter()
+                X = p.solve(config['method'], False, 1, config['alpha'], settings['atol'],
+                            settings['btol'], settings['k'])
+                elapsed = time.perf_counter() - startTime
+                image = p.construct_image(X)
+                norms = p.solution_norms(X)
+                results.append((config['index'], image,
+                                {'time': elapsed,
+                                 'operator': list(p.A.shape),
+                                 'norm_median': float(np.median(norms)),
+                                 'image_mean': float(np.mean(image))}))
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def parse_values(text, kind, name):
+    '''
+    Parses a comma-separated list of values of the given type.
+    '''
+    try:
+        return [kind(v) for v in text.split(',')]
+    except ValueError:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Could not parse the list of values \'%s\' of \'--%s\'.
+                ''' %(text, name)))
+
+
+def run_sweep(args):
+    '''
+    Runs a parameter sweep as specified by the command-line arguments of
+    'vezda sweep' and saves the images and metrics of all configurations
+    to a single results file.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda import data_utils
+    from vezda.data_utils import load_data, load_impulse_responses, load_search_grid, get_user_windows
+    from vezda.sampling_utils import get_search_points, scatter_to_grid
+
+    equation = 'lse' if args.lse else 'nfe'
+    grid = {'alpha': parse_values(args.alpha, float, 'alpha'),
+            'tau': parse_values(args.tau, float, 'tau') if args.tau is not None else None,
+            'rstep': parse_values(args.rstep, int, 'rstep'),
+            'sstep': parse_values(args.sstep, int, 'sstep'),
+            'method': parse_values(args.method, str, 'method')}
+    for method in grid['method']:
+        if method not in ['lsmr', 'lsqr', 'svd', 'direct']:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Unknown method \'%s\'. Choose from lsmr, lsqr, svd and direct.
+                    ''' %(method)))
+        if method == 'direct' and args.domain == 'time':
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: The direct method is only available in the frequency domain.
+                    '''))
+        if method == 'svd' and args.numVals is None:
+            sys.exit(textwrap.dedent(
+                    '''
+                    Error: Sweeping with the svd method requires the number of singular values
+                    and vectors \'--numVals\'.
+                    '''))
+    if min(grid['alpha']) < 0 or min(grid['rstep']) < 1 or min(grid['sstep']) < 1:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The regularization parameters must be nonnegative and the
+                decimation steps \'--rstep\' and \'--sstep\' positive integers.
+                '''))
+    if args.band is not None and args.domain == 'time':
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Frequency windows \'--band\' only apply in the frequency domain.
+                '''))
+
+    #==========================================================================
+    # load the windowed time-domain inputs once
+    data = load_data('time', taper=True, verbose=True)
+    searchGrid = load_search_grid()
+    if grid['tau'] is None:
+        grid['tau'] = [float(np.atleast_1d(searchGrid['tau'])[0])]
+    impulseResponses, searchPoints = load_impulse_responses('time', args.medium, return_search_points=True,
+                                                            tau=grid['tau'][0])
+    rinterval, tinterval, tstep, dt = get_user_windows(skip_sources=True)
+    dt = tstep * dt
+
+    if args.band is not None:
+        grid['band'] = []
+        for band in args.band.split(','):
+            fmin, fmax = parse_values(band.replace(':', ','), float, 'band')
+            grid['band'].append((fmin, fmax))
+    else:
+        # the frequency window of plotParams (see 'vzspectra')
+        data_utils.get_frequency_window(nextPow2(2 * len(tinterval)), dt, verbose=False)
+        grid['band'] = [(data_utils.plotParams['fmin'], data_utils.plotParams['fmax'])]
+
+    groups = configurations(grid, equation)
+    C = sum(len(group) for group in groups)
+    settings = {'equation': equation, 'domain': args.domain, 'dt': dt, 'tau0': grid['tau'][0],
+                'frequencies': data_utils.plotParams.get('frequencies'),
+                'atol': args.atol, 'btol': args.btol, 'k': args.numVals, 'ngs': args.ngs}
+    print('Sweeping %d configurations in %d operator groups...' %(C, len(groups)))
+
+    images = [None] * C
+    metrics = [None] * C
+    memories = []
+    startTime = time.time()
+    try:
+        inputs = {}
+        for name, array in [('data', data), ('impulseResponses', impulseResponses)]:
+            memory, inputs[name] = share(array)
+            memories.append(memory)
+        del data, impulseResponses
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(solve_group, group, inputs, settings) for group in groups]
+            for done, future in enumerate(as_completed(futures)):
+                for index, image, metric in future.result():
+                    images[index] = image
+                    metrics[index] = metric
+                print('Completed operator group %d of %d...' %(done + 1, len(groups)))
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    print('Elapsed time:', humanReadable(time.time() - startTime))
+
+    #==========================================================================
+    # collect the configurations and metrics into a single results file
+    configs = [config for group in groups for config in group]
+    configs.sort(key=lambda c : c['index'])
+    Images = np.stack(images)
+
+    # location of the image peak and, if known, its distance to the scatterer
+    peaks = searchPoints[np.argmax(Images, axis=1)]
+    if 'scatterer' in data_utils.datadir:
+        scatterer = np.load(str(data_utils.datadir['scatterer']))
+        peakErrors = np.min(norm(peaks[:, None, :] - scatterer[None, :, :], axis=2), axis=1)
+    else:
+        peakErrors = np.full(C, np.nan)
+
+    mask = get_search_points(searchGrid)[1]
+    saveArgs = {}
+    if mask is not None:
+        saveArgs['mask'] = mask
+        Images = scatter_to_grid(Images, mask)
+
+    results = {name: np.array([c[name] for c in configs]) for name in PARAMETERS}
+    for name in ['time', 'norm_median', 'image_mean']:
+        results[name] = np.array([m[name] for m in metrics])
+    results['operator'] = np.array([m['operator'] for m in metrics])
+    results['group'] = np.array([c['group'] for c in configs])
+    np.savez(args.output, Images=Images, equation=equation, domain=args.domain,
+             peak=peaks, peak_error=peakErrors, **results, **saveArgs)
+
+    print('\n%6s %10s %8s %8s %8s %6s %6s %7s %10s %10s' %('config', 'alpha', 'tau', 'fmin', 'fmax',
+                                                           'rstep', 'sstep', 'method', 'time (s)',
+                                                           'peak err'))
+    for i, c in enumerate(configs):
+        print('%6d %10.3g %8.4g %8.4g %8.4g %6d %6d %7s %10.4f %10.4g' %(i, c['alpha'], c['tau'], c['fmin'],
+                                                                       c['fmax'], c['rstep'], c['sstep'],
+                                                                       c['method'], results['time'][i],
+                                                                       peakErrors[i]))
+    print('\nResults saved to \'%s\'.' %(args.output))
@@ -0,0 +1,149 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import hashlib
+import numpy as np
+
+#==============================================================================
+# Time traces stored as short segments
+#
+# Impulse responses are causal (zero before the arrival of the wave) and, in
+# three dimensions, a pulse of short duration, so most of the samples of a
+# trace are zero. A trace is stored as the offset of its first sample and a
+# short dense segment of L samples holding its support, where L is the
+# longest support among all traces (shorter supports are padded with the
+# samples that follow them). The segments of an Nr x Nt x K array are an
+# Nr x L x K array, indexed like the dense array.
+#
+# Class data objects:
+#   shape: shape of the dense array (Nr x Nt x K)
+#   dtype: dtype of the dense array
+#   offsets: time index of the first sample of each segment (Nr x K)
+#   segments: the segments (Nr x L x K)
+#
+# Class methods:
+#   compress a dense array: from_dense()
+#   read/write the segments from/to a dictionary of arrays: from_dict(), to_dict()
+#   dense array of a block of traces: densify()
+#   Fourier transform over time: rfft()
+#   index like the dense array: [receivers, :, traces]
+#==============================================================================
+class SegmentedTraces(object):
+
+    def __init__(self, shape, offsets, segments):
+        self.shape = tuple(int(n) for n in shape)
+        self.offsets = offsets
+        self.segments = segments
+        self.dtype = segments.dtype
+
+
+    @classmethod
+    def from_dense(cls, X, rtol=None):
+        '''
+        Compresses a dense array of traces (Nr x Nt x K). The samples before
+        and after the support of a trace whose magnitudes do not exceed rtol
+        times the peak of the trace are dropped. The default rtol is the
+        machine precision of X, so the compression is lossless to rounding.
+        '''
+        Nr, Nt, K = X.shape
+        if rtol is None:
+            rtol = np.finfo(X.dtype).eps
+        absX = np.abs(X)
+        support = absX > rtol * np.max(absX, axis=1, keepdims=True)
+        support &= absX > 0
+        del absX
+
+        nonzero = np.any(support, axis=1)
+        first = np.argmax(support, axis=1)
+        last = Nt - 1 - np.argmax(support[:, ::-1, :], axis=1)
+        del support
+        L = max(int(np.max(np.where(nonzero, last - first + 1, 1))), 1)
+
+        # segments end within the trace
+        offsets = np.where(nonzero, np.minimum(first, Nt - L), 0)
+        segments = np.take_along_axis(X, offsets[:, None, :] + np.arange(L)[None, :, None], axis=1)
+
+        return cls(X.shape, offsets, segments)
+
+
+    @classmethod
+    def from_dict(cls, Dict):
+        return cls(Dict['IRshape'], Dict['IRoffsets'], Dict['IRsegments'])
+
+
+    def to_dict(self):
+        return {'IRshape': self.shape, 'IRoffsets': self.offsets, 'IRsegments': self.segments}
+
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.segments.nbytes
+
+
+    @property
+    def signature(self):
+        # identifies the contents (see checkpoint_utils.fingerprint)
+        h = hashlib.sha1()
+        h.update(str(self.shape).encode())
+        h.update(np.ascontiguousarray(self.offsets).data)
+        h.update(np.ascontiguousarray(self.segments).data)
+        return h.hexdigest()
+
+
+    def astype(self, dtype, copy=True):
+        return SegmentedTraces(self.shape, self.offsets, self.segments.astype(dtype, copy=copy))
+
+
+    def densify(self, start=0, stop=None):
+        '''
+        Returns the dense array (Nr x Nt x (stop - start)) of the traces
+        start, start+1, ..., stop-1.
+        '''
+        offsets = self.offsets[:, start:stop]
+        segments = self.segments[:, :, start:stop]
+        L = segments.shape[1]
+        X = np.zeros((self.shape[0], self.shape[1], segments.shape[2]), dtype=self.dtype)
+        np.put_along_axis(X, offsets[:, None, :] + np.arange(L)[None, :, None], segments, axis=1)
+        return X
+
+
+    def rfft(self, n):
+        '''
+        Returns the real Fourier transform of the traces over time (axis=1),
+        of length n >= Nt (see numpy.fft.rfft). The segments are transformed
+        and shifted to their offsets by a phase factor, without forming the
+        dense traces. The phase is applied in place one receiver at a time,
+        so no more than an Nf x K array of phases is held.
+        '''
+        F = np.fft.rfft(self.segments, n=n, axis=1)
+        omega = (-2j * np.pi / n) * np.arange(F.shape[1])
+        for r in range(F.shape[0]):
+            F[r] *= np.exp(np.outer(omega, self.offsets[r]))
+        return F
+
+
+    def __getitem__(self, key):
+        '''
+        Indexes the traces like the dense array: X[receivers, :, k] is the
+        dense Nr x Nt array of trace k, X[receivers, :, traces] (traces a
+        slice or array) the SegmentedTraces of the selected traces.
+        '''
+        rows, times, traces = key
+        if times != slice(None):
+            raise IndexError('SegmentedTraces are indexed over all times')
+        if np.isscalar(traces):
+            return self[rows, :, [traces]].densify()[:, :, 0]
+        offsets = self.offsets[rows][:, traces]
+        segments = self.segments[rows][:, :, traces]
+        return SegmentedTraces((offsets.shape[0], self.shape[1], offsets.shape[1]), offsets, segments)
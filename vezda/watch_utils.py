@@ -0,0 +1,244 @@
+# Copyright 2017-2019 Aaron C. Prunty
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+import os
+import sys
+import time
+import textwrap
+import numpy as np
+from pathlib import Path
+from scipy.linalg import norm
+from vezda.math_utils import humanReadable, as_precision
+from vezda.signal_utils import tukey_taper
+from vezda.svd_utils import compute_block_svd
+from vezda.LinearSamplingClass import normalize_indicator
+from vezda.checkpoint_utils import atomic_write
+
+#==============================================================================
+# A near-field image updated source by source
+#
+# In the frequency domain the near-field operator is block diagonal, with one
+# Nr x Ns block D per frequency, and the Tikhonov-regularized solution of the
+# near-field equation at a search point with right-hand side b is
+#
+#     g = V diag(s / (s**2 + alpha)) U^H b,
+#
+# so the norm of g (and hence the image) depends only on the left singular
+# vectors U and singular values s of the blocks. A new source adds a column d
+# to each block, and since D D^H + d d^H = L L^H for L = [U diag(s), d], the
+# updated U and s are those of the small Nr x (r + 1) matrix L. The cost of
+# adding a source and refreshing the image is independent of the number of
+# sources already absorbed.
+#
+# Class data objects:
+#   U: left singular vectors of the frequency blocks (Nm x Nr x r)
+#   s: singular values of the frequency blocks (Nm x r)
+#   Ns: number of sources absorbed
+#
+# Class methods:
+#   add the frequency-domain gathers of new sources: append()
+#   norms of the regularized solutions: solution_norms()
+#   image over the search points: image()
+#==============================================================================
+class IncrementalImage(object):
+
+    def __init__(self, data):
+        U, s, Vh = compute_block_svd(data)
+        self.U = U
+        self.s = s
+        self.Ns = data.shape[2]
+
+
+    def append(self, gathers):
+        '''
+        Absorbs new sources. gathers: frequency-domain data of shape Nr x Nm x b
+        '''
+        L = np.concatenate((self.U * self.s[:, None, :], np.transpose(gathers, (1, 0, 2))), axis=2)
+        self.U, self.s, Vh = np.linalg.svd(L, full_matrices=False)
+        self.Ns += gathers.shape[2]
+
+
+    def solution_norms(self, rhs_vectors, alpha=0.0):
+        '''
+        Returns the norms of the Tikhonov-regularized solutions for the
+        right-hand sides (Nr x Nm x K), as computed by the direct solver of
+        LinearSamplingProblem for all sources absorbed so far.
+        '''
+        Nr = self.U.shape[1]
+        # singular values that vanish to machine precision are discarded,
+        # as in block_tikhonov_inverse
+        tol = np.finfo(self.s.dtype).eps * max(Nr, self.Ns) * np.max(self.s)
+        filterFactors = np.divide(self.s, alpha + self.s**2, out=np.zeros_like(self.s),
+                                  where=self.s > tol)
+        C = np.matmul(self.U.conj().transpose(0, 2, 1), np.transpose(rhs_vectors, (1, 0, 2)))
+        return np.sqrt(np.sum(np.abs(filterFactors[:, :, None] * C)**2, axis=(0, 1)))
+
+
+    def image(self, rhs_vectors, alpha=0.0):
+        eps = np.finfo(float).eps
+        return normalize_indicator(1.0 / (self.solution_norms(rhs_vectors, alpha) + eps))
+
+
+#==============================================================================
+def pending_gathers(inbox):
+    # gather files waiting in the inbox, oldest first
+    files = [f for f in Path(inbox).glob('*.npy') if f.is_file()]
+    return sorted(files, key=lambda f : (f.stat().st_mtime, f.name))
+
+
+def read_gather(filename, shape):
+    '''
+    Reads a gather file holding the recorded waves of one (Nr x Nt) or more
+    (Nr x Nt x b) sources. Returns None if the file cannot be read yet (e.g.,
+    it is still being written).
+    '''
+    try:
+        gather = np.load(str(filename))
+    except (ValueError, EOFError, OSError):
+        return None
+    if gather.ndim == 2:
+        gather = gather[:, :, None]
+    if gather.ndim != 3 or gather.shape[:2] != shape:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Gather file \'%s\' has shape %s, but the recorded data have %d
+                receivers and %d time samples.
+                ''' %(filename, gather.shape, shape[0], shape[1])))
+    return gather
+
+
+def run_watch(args):
+    '''
+    Watches a directory for the gathers of new sources, as specified by the
+    command-line arguments of 'vezda watch'. Each new gather is moved to the
+    store directory and absorbed into the near-field operator, and the image
+    (saved to 'imageWatchNFE.npz') is refreshed every 'args.every' gathers.
+    '''
+    # the data utilities read the working directory at import time
+    from vezda import data_utils
+    from vezda.data_utils import (load_data, load_impulse_responses, load_search_grid,
+                                  get_user_windows, shift_impulse_responses, fft_and_window)
+    from vezda.sampling_utils import get_search_points, scatter_to_grid
+
+    if args.alpha < 0.0 or args.every < 1 or args.interval <= 0.0:
+        sys.exit(textwrap.dedent(
+                '''
+                Error: The regularization parameter \'--alpha\' must be nonnegative, \'--every\'
+                a positive integer and \'--interval\' positive.
+                '''))
+
+    #==========================================================================
+    # the image of the recorded data is the starting point
+    data = load_data('freq', taper=True, verbose=True, precision=args.precision)
+    taus = np.atleast_1d(load_search_grid()['tau'])
+    rinterval, tinterval, tstep, dt = get_user_windows(skip_sources=True)
+    if data.shape[0] != len(rinterval):
+        sys.exit(textwrap.dedent(
+                '''
+                Error: Watching for new sources is not available when source-receiver
+                reciprocity adds receivers to the data (new sources would add receivers
+                as well).
+                '''))
+    baseResponses = load_impulse_responses('time', args.medium, tau=taus[0], precision=args.precision)
+
+    # right-hand sides for each focusing time
+    rhs = []
+    for tau in taus:
+        impulseResponses = shift_impulse_responses(baseResponses, tau - taus[0], 'freq')
+        if args.ngs:
+            impulseResponses /= norm(impulseResponses, axis=(0, 1))[None, None, :]
+        rhs.append(impulseResponses)
+    del baseResponses
+
+    raw = np.load(str(data_utils.datadir['recordedData']), mmap_mode='r')
+    shape = raw.shape[:2]
+    del raw
+
+    def transform(gather):
+        # windows, taper and Fourier transform as applied to the recorded data
+        gather = as_precision(gather[rinterval, :, :][:, tinterval, :], args.precision)
+        gather = tukey_taper(gather, tstep * dt, data_utils.pulseFun.peakFreq)
+        return fft_and_window(gather, tstep * dt, double_length=True)
+
+    mask = get_search_points(load_search_grid())[1]
+    def save_image(image):
+        Image = np.stack(image) if len(taus) > 1 else image[0]
+        saveArgs = {}
+        if len(taus) > 1:
+            saveArgs['tau'] = taus
+        if mask is not None:
+            saveArgs['mask'] = mask
+            Image = scatter_to_grid(Image, mask)
+        # written atomically, so the image can be viewed while watching
+        # (a file of its own, so the image of 'vzsolve' is not overwritten)
+        # (with the default tolerances that 'vzsolve' records for the direct method)
+        atomic_write('imageWatchNFE.npz', lambda f : np.savez(f, Image=Image, method='direct', alpha=args.alpha,
+                                                              atol=1.0e-8, btol=1.0e-8, domain='freq',
+                                                              sources=imager.Ns, **saveArgs))
+
+    #==========================================================================
+    imager = IncrementalImage(data)
+    del data
+
+    store = Path(args.store)
+    store.mkdir(parents=True, exist_ok=True)
+    stored = sorted(store.glob('gather*.npy'))
+    if len(stored) > 0:
+        # gathers absorbed by an earlier run
+        print('Absorbing %d stored gathers from \'%s\'...' %(len(stored), store))
+        for filename in stored:
+            imager.append(transform(read_gather(filename, shape)))
+    count = len(stored)
+
+    def refresh(lastArrival):
+        image = [imager.image(B, args.alpha) for B in rhs]
+        save_image(image)
+        print('Image refreshed with %d sources (%s after the last gather)...'
+              %(imager.Ns, humanReadable(time.time() - lastArrival)))
+
+    refresh(time.time())
+    Path(args.inbox).mkdir(parents=True, exist_ok=True)
+    print('Watching \'%s\' for new gathers (Ctrl-C to stop)...' %(args.inbox))
+
+    pending = 0
+    lastArrival = None
+    try:
+        while True:
+            files = pending_gathers(args.inbox)
+            for filename in files:
+                gather = read_gather(filename, shape)
+                if gather is None:
+                    # retried at the next poll
+                    continue
+                lastArrival = time.time()
+                # the gather is kept in the store before it is absorbed
+                target = store / ('gather%06d.npy' %(count))
+                os.replace(str(filename), str(target))
+                count += 1
+                imager.append(transform(gather))
+                pending += gather.shape[2]
+                print('Absorbed \'%s\' (%d sources in total)...' %(filename.name, imager.Ns))
+                if pending >= args.every:
+                    refresh(lastArrival)
+                    pending = 0
+
+            if args.once:
+                break
+            time.sleep(args.interval)
+
+    except KeyboardInterrupt:
+        print('\nStopped watching...')
+
+    if pending > 0:
+        refresh(lastArrival)